@@ -0,0 +1,246 @@
+# 保存済みの ACL と Drive / Slack の最新 ACL のずれ（ドリフト）をまとめて検出する
+#
+# コレクションのメタデータをページングで読み、ACL の単位（Drive はファイル、Slack はチャンネル）ごとに
+# 1回だけ最新の ACL を取得して比較する。Drive は batch HTTP リクエスト、Slack はチャンネル単位で並列に取得する。
+# ずれがあったリソースを1行1件の JSON（JSONL）で出力し、--apply を付けると
+# 埋め込みはそのままでメタデータの ACL だけを最新の値に更新する。
+# 見つからなくなったリソース（削除されたファイル・ボットが抜けたチャンネル）は、--apply のとき
+# --missing に従って ACL を空にする（既定）か、レコードを削除する。
+#
+#   uv run acl_drift.py                          # 標準出力に JSONL
+#   uv run acl_drift.py --output drift.jsonl --apply
+#   uv run acl_drift.py --apply --missing delete
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from googleapiclient.errors import HttpError
+from slack_sdk.errors import SlackApiError
+
+from permission_index import metadata_principals, refresh_permission_index, resource_key
+
+# ACL を保存しているメタデータのキー
+ACL_FIELDS = {"google_drive": "permissions", "slack": "permitted_user_ids"}
+
+# 誰にも見えない ACL（missing のリソースを --missing clear で空にするときの値）
+EMPTY_ACLS = {"google_drive": "[]", "slack": ""}
+
+# --missing の選択肢: keep（何もしない）/ clear（ACL を空にする）/ delete（レコードを削除する）
+MISSING_ACTIONS = ("keep", "clear", "delete")
+
+_UPDATE_CHUNK = 500
+
+
+def stored_acls(collection, sources: Iterable[str] = ACL_FIELDS, page_size: int = 1000) -> Dict[str, Dict]:
+    """リソース -> {source, id, 保存されている ACL ごとのレコード ID}"""
+    resources = {}
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        for id_, meta in zip(page["ids"], page["metadatas"]):
+            source = meta.get("source")
+            if source not in sources:
+                continue
+            key = resource_key(meta)
+            entry = resources.setdefault(key, {
+                "source": source,
+                "id": meta["file_id"] if source == "google_drive" else meta["channel_id"],
+                "stored": {},
+            })
+            entry["stored"].setdefault(meta.get(ACL_FIELDS[source], ""), []).append(id_)
+        offset += len(page["ids"])
+    return resources
+
+
+def live_drive_acls(crawler, file_ids: List[str], batch_size: int = 100) -> Dict[str, object]:
+    """file_id -> 保存形式の permissions JSON（取得できなければ例外）"""
+    from googledrive_embedding_documents import permissions_json
+
+    batches = [file_ids[i:i + batch_size] for i in range(0, len(file_ids), batch_size)]
+    results = {}
+    with ThreadPoolExecutor(max_workers=crawler.max_workers) as executor:
+        for batch in executor.map(lambda ids: crawler.list_permissions_batch(ids, batch_size), batches):
+            for file_id, permissions in batch.items():
+                results[file_id] = permissions if isinstance(permissions, Exception) else permissions_json(permissions)
+    return results
+
+
+def live_slack_acls(scheduler, channel_ids: List[str], max_workers: int = 4) -> Dict[str, object]:
+    """channel_id -> 保存形式の permitted_user_ids（取得できなければ例外）"""
+    from slack_export import fetch_members
+
+    def fetch(channel_id):
+        try:
+            return ",".join(fetch_members(scheduler, channel_id))
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(channel_ids, executor.map(fetch, channel_ids)))
+
+
+def is_missing(error: Exception) -> bool:
+    """ファイルが削除された・チャンネルから外れたなど、リソースそのものが見えなくなったエラーか"""
+    if isinstance(error, HttpError):
+        return error.resp.status == 404
+    if isinstance(error, SlackApiError):
+        return error.response.get("error") in ("channel_not_found", "not_in_channel")
+    return False
+
+
+def _principals(source: str, value: str) -> set:
+    return set(metadata_principals({"source": source, ACL_FIELDS[source]: value}))
+
+
+def _stale_values(source: str, stored: Dict[str, List[str]], live_principals: set) -> List[str]:
+    """保存されている ACL の値のうち、プリンシパルの集合が最新と違うもの"""
+    return [v for v in stored if _principals(source, v) != live_principals]
+
+
+def diff_acls(resources: Dict[str, Dict], live: Dict[str, object]) -> List[Dict]:
+    """ずれのあるリソースだけを返す
+
+    status は changed（ACL が変わった）/ missing（リソースが見つからない）/ error（取得に失敗）。
+    保存値と最新値は文字列ではなくプリンシパルの集合で比べる（Slack のメンバー順の違いなどはずれにしない）。
+    """
+    drift = []
+    for key, entry in sorted(resources.items()):
+        source = entry["source"]
+        value = live.get(key)
+        record = {"resource": key, "source": source, "id": entry["id"],
+                  "records": sum(len(ids) for ids in entry["stored"].values())}
+        if isinstance(value, Exception):
+            drift.append({**record, "status": "missing" if is_missing(value) else "error", "error": str(value)})
+            continue
+        if value is None:
+            continue
+        live_principals = _principals(source, value)
+        stale = _stale_values(source, entry["stored"], live_principals)
+        if not stale:
+            continue
+        stored_principals = set().union(*(_principals(source, v) for v in entry["stored"]))
+        drift.append({
+            **record,
+            "status": "changed",
+            "stale_records": sum(len(entry["stored"][v]) for v in stale),
+            "added": sorted(live_principals - stored_principals),
+            "removed": sorted(stored_principals - live_principals),
+            "live": value,
+        })
+    return drift
+
+
+def _update_acl(collection, ids: List[str], field: str, value: str):
+    for i in range(0, len(ids), _UPDATE_CHUNK):
+        chunk = ids[i:i + _UPDATE_CHUNK]
+        collection.update(ids=chunk, metadatas=[{field: value}] * len(chunk))
+
+
+def apply_fixes(collection, resources: Dict[str, Dict], drift: List[Dict], missing: str = "clear") -> Dict[str, int]:
+    """ずれを反映し、状態ごとのレコード数を返す（埋め込みは再計算しない）
+
+    changed のリソースは、プリンシパルが最新と違うレコードの ACL だけを更新する。
+    missing のリソースは missing="clear" なら ACL を空にし、"delete" ならレコードを削除する。
+    """
+    counts = {"updated": 0, "cleared": 0, "deleted": 0}
+    for item in drift:
+        source = item["source"]
+        stored = resources[item["resource"]]["stored"]
+        if item["status"] == "changed":
+            stale = _stale_values(source, stored, _principals(source, item["live"]))
+            ids = [id_ for value in stale for id_ in stored[value]]
+            _update_acl(collection, ids, ACL_FIELDS[source], item["live"])
+            counts["updated"] += len(ids)
+        elif item["status"] == "missing" and missing != "keep":
+            ids = [id_ for ids in stored.values() for id_ in ids]
+            if missing == "delete":
+                for i in range(0, len(ids), _UPDATE_CHUNK):
+                    collection.delete(ids=ids[i:i + _UPDATE_CHUNK])
+                counts["deleted"] += len(ids)
+            else:
+                _update_acl(collection, ids, ACL_FIELDS[source], EMPTY_ACLS[source])
+                counts["cleared"] += len(ids)
+    return counts
+
+
+def fixed_resources(drift: List[Dict], missing: str = "clear") -> List[str]:
+    """apply_fixes でレコードが変わるリソース（権限インデックスを更新する対象）"""
+    statuses = ("changed",) if missing == "keep" else ("changed", "missing")
+    return [d["resource"] for d in drift if d["status"] in statuses]
+
+
+def scan(collection, crawler=None, scheduler=None, apply: bool = False, output=None,
+         missing: str = "clear") -> List[Dict]:
+    """crawler / scheduler を渡したソースだけを検査する"""
+    sources = [s for s, client in (("google_drive", crawler), ("slack", scheduler)) if client is not None]
+    resources = stored_acls(collection, sources)
+    live: Dict[str, object] = {}
+    if crawler is not None:
+        file_ids = [e["id"] for e in resources.values() if e["source"] == "google_drive"]
+        live.update({f"drive:{k}": v for k, v in live_drive_acls(crawler, file_ids).items()})
+    if scheduler is not None:
+        channel_ids = [e["id"] for e in resources.values() if e["source"] == "slack"]
+        live.update({f"slack:{k}": v for k, v in live_slack_acls(scheduler, channel_ids).items()})
+
+    drift = diff_acls(resources, live)
+    output = output or sys.stdout
+    for item in drift:
+        output.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    counts = {status: sum(1 for d in drift if d["status"] == status) for status in ("changed", "missing", "error")}
+    print(f"{len(resources)}リソースを検査: 変更 {counts['changed']}件 / 見つからない {counts['missing']}件"
+          f" / 取得失敗 {counts['error']}件", file=sys.stderr)
+    if apply and fixed_resources(drift, missing):
+        fixed = apply_fixes(collection, resources, drift, missing)
+        print(f"{fixed['updated']}レコードの ACL を更新、{fixed['cleared']}レコードの ACL を空に、"
+              f"{fixed['deleted']}レコードを削除しました", file=sys.stderr)
+    return drift
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="保存済み ACL と最新 ACL のドリフト検出")
+    parser.add_argument("--source", choices=["drive", "slack", "all"], default="all")
+    parser.add_argument("--output", help="JSONL の出力先（省略時は標準出力）")
+    parser.add_argument("--apply", action="store_true", help="ずれていた ACL をメタデータのみ更新する")
+    parser.add_argument("--missing", choices=MISSING_ACTIONS, default="clear",
+                        help="--apply のとき、見つからないリソースの ACL を空にする（clear）か、"
+                             "レコードを削除する（delete）か、そのままにする（keep）")
+    parser.add_argument("--persist-directory", default=".chroma")
+    args = parser.parse_args(argv)
+
+    import chromadb
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    collection = chromadb.PersistentClient(path=args.persist_directory).get_or_create_collection("default")
+
+    crawler = scheduler = None
+    if args.source in ("drive", "all"):
+        from googledrive_embedding_documents import create_crawler
+
+        crawler = create_crawler()
+    if args.source in ("slack", "all"):
+        from slack_sdk import WebClient
+
+        from slack_export import SlackScheduler
+
+        scheduler = SlackScheduler(WebClient(token=os.getenv("SLACK_BOT_TOKEN")))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            drift = scan(collection, crawler, scheduler, apply=args.apply, output=f, missing=args.missing)
+    else:
+        drift = scan(collection, crawler, scheduler, apply=args.apply, missing=args.missing)
+    fixed = fixed_resources(drift, args.missing)
+    if args.apply and fixed:
+        refresh_permission_index(collection, fixed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+# AccessControlledVectorDB の文書を ACL ごとのシャード（Chroma のコレクション）に分けて持つ
+#
+#   public          other が読める文書（全員が検索する）
+#   group:<group>   other は読めず group が読める文書（そのグループの所属者と、文書の所有者が検索する）
+#   owner:<owner>   owner だけが読める文書と、誰も読めない文書（所有者だけが検索する）
+#
+# 検索では、ユーザーが読める可能性のあるシャードだけを並列に検索し、距離順にマージする。
+# 検索対象はコーパス全体ではなく、ユーザーが読める範囲（とその近く）になる。
+#
+# Chroma の where 句はシャードの大きさではなくストア全体の件数に比例して遅いので、シャードの検索には使わない。
+# 代わりに、シャードの中でユーザーが読めない文書の数（の上限）を数えておき、その分だけ多く取得する。
+# 最終的な判定はこれまでどおり PermissionColumns.mask で行うので、多めに取った分は捨てられ、
+# 各シャードから閲覧可能な上位 n 件が必ず残る（事前フィルタと同じ結果になる）。
+#
+# ShardedCollection は AccessControlledVectorDB が使う範囲で chromadb の Collection と同じ形の
+# 引数・戻り値を持つので、self.collection をそのまま置き換えられる。
+
+import hashlib
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+PUBLIC = "public"
+
+# シャードのコレクションのメタデータに書くキー（開き直したときにシャードを見つけるため）
+SHARD_METADATA_KEY = "acl_shard"
+
+
+def shard_key(owner: str, group: str, perm_group: bool, perm_other: bool) -> str:
+    if perm_other:
+        return PUBLIC
+    if perm_group:
+        return f"group:{group}"
+    return f"owner:{owner}"
+
+
+def metadata_shard(meta: Dict) -> str:
+    return shard_key(meta["owner"], meta["group"], meta["perm_group"], meta["perm_other"])
+
+
+def shard_collection_name(base: str, key: str) -> str:
+    """Chroma のコレクション名（英数字と . _ - のみ、63文字まで）。グループ名・ユーザー名はハッシュにする"""
+    if key == PUBLIC:
+        return f"{base}--public"
+    kind, _, value = key.partition(":")
+    return f"{base}--{kind[0]}-{hashlib.sha1(value.encode('utf-8')).hexdigest()[:16]}"
+
+
+def _empty(include: Iterable[str]) -> Dict[str, list]:
+    return {"ids": [], **{name: [] for name in include}}
+
+
+class ShardedCollection:
+    """ACL ごとのシャードに分けた Chroma のコレクション群
+
+    書き込みはロックで直列化する。シャード間の移動は「移動先に書いてから移動元を消す」順で行い、
+    検索は doc_id で重複を除くので、移動中の文書が検索から消えたり二重に返ったりしない。
+    """
+
+    def __init__(self, client, name: str, max_workers: int = 8, scan: bool = True):
+        self.client = client
+        self.name = name
+        self.max_workers = max_workers
+        self.collections: Dict[str, object] = {}
+        self.shard_of: Dict[str, str] = {}  # doc_id -> シャード
+        self.sizes: Counter = Counter()
+        self._acl: Dict[str, tuple] = {}  # doc_id -> (owner, group, perm_owner, perm_group)
+        # (シャード, owner) -> owner が読めない文書（perm_owner=False）の数
+        self.owner_blind: Counter = Counter()
+        # group -> public シャードにある、そのグループの所属者が読めない文書（perm_group=False）の数
+        self.group_blind: Counter = Counter()
+        # owner -> {group シャード -> そこにある owner が読める文書の doc_id}。所属していないグループの文書を探すため
+        self.owned: Dict[str, Dict[str, Set[str]]] = defaultdict(lambda: defaultdict(set))
+        self._lock = threading.RLock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._open_existing(scan)
+
+    def _open_existing(self, scan: bool):
+        """既存のシャードを開く。scan=True なら doc_id -> シャードの対応もメタデータから作り直す
+
+        scan=False の場合、対応は restore() で渡す（永続化モードではサイドカーに保存してあるので読み直さない）。
+        """
+        for collection in self.client.list_collections():
+            key = (collection.metadata or {}).get(SHARD_METADATA_KEY)
+            if key is None or collection.name != shard_collection_name(self.name, key):
+                continue
+            self.collections[key] = collection
+        if scan:
+            self.rescan()
+
+    def stored_count(self) -> int:
+        """Chroma の各シャードにある文書数の合計（restore() / rescan() の前でも数えられる）"""
+        return sum(collection.count() for collection in self.collections.values())
+
+    def _reset(self):
+        self.shard_of.clear()
+        self.sizes.clear()
+        self._acl.clear()
+        self.owner_blind.clear()
+        self.group_blind.clear()
+        self.owned.clear()
+
+    def restore(self, shards: Dict[str, str], acls: Dict[str, tuple]):
+        """保存しておいた doc_id -> シャード と doc_id -> (owner, group, perm_owner, perm_group) から対応を作る"""
+        with self._lock:
+            self._reset()
+            for doc_id, key in shards.items():
+                self._place(doc_id, key, acls[doc_id])
+
+    def rescan(self, page_size: int = 10000):
+        """各シャードのメタデータを読み、doc_id -> シャードの対応を作り直す（件数に比例して時間がかかる）"""
+        with self._lock:
+            self._reset()
+            for key, collection in self.collections.items():
+                offset = 0
+                while True:
+                    page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+                    if not page["ids"]:
+                        break
+                    for doc_id, meta in zip(page["ids"], page["metadatas"]):
+                        self._assign(doc_id, key, meta)
+                    offset += len(page["ids"])
+
+    def drop(self):
+        """すべてのシャードを削除する"""
+        with self._lock:
+            for collection in self.collections.values():
+                self.client.delete_collection(collection.name)
+            self.collections.clear()
+            self._reset()
+
+    def _collection(self, key: str):
+        collection = self.collections.get(key)
+        if collection is None:
+            collection = self.client.get_or_create_collection(
+                shard_collection_name(self.name, key), metadata={SHARD_METADATA_KEY: key})
+            self.collections[key] = collection
+        return collection
+
+    def _assign(self, doc_id: str, key: str, meta: Dict):
+        self._place(doc_id, key, (meta["owner"], meta["group"], bool(meta["perm_owner"]), bool(meta["perm_group"])))
+
+    def _place(self, doc_id: str, key: str, acl: tuple):
+        self.shard_of[doc_id] = key
+        self._acl[doc_id] = acl
+        self.sizes[key] += 1
+        self._count(doc_id, key, acl, 1)
+
+    def _unassign(self, doc_id: str):
+        key = self.shard_of.pop(doc_id)
+        self.sizes[key] -= 1
+        self._count(doc_id, key, self._acl.pop(doc_id), -1)
+
+    def _count(self, doc_id: str, key: str, acl: tuple, delta: int):
+        owner, group, perm_owner, perm_group = acl
+        if not perm_owner:
+            self.owner_blind[key, owner] += delta
+            if self.owner_blind[key, owner] <= 0:
+                del self.owner_blind[key, owner]
+        if key == PUBLIC and not perm_group:
+            self.group_blind[group] += delta
+            if self.group_blind[group] <= 0:
+                del self.group_blind[group]
+        if key.startswith("group:") and perm_owner:
+            owned = self.owned[owner]
+            if delta > 0:
+                owned[key].add(doc_id)
+            else:
+                owned[key].discard(doc_id)
+                if not owned[key]:
+                    del owned[key]
+
+    def shards_for(self, user) -> List[str]:
+        """user が読める文書を含みうる、空でないシャード"""
+        keys: Set[str] = {PUBLIC, f"owner:{user.user_id}"}
+        keys.update(f"group:{g}" for g in user.groups)
+        keys.update(self.owned.get(user.user_id, ()))
+        return sorted(k for k in keys if self.sizes.get(k, 0) > 0)
+
+    def scope(self, user) -> Dict[str, Union[int, List[str]]]:
+        """shards_for(user) の各シャード -> 追加で取得する件数、または検索対象の doc_id
+
+        所属グループ・自分の owner シャードで読めないのは、自分が所有していて perm_owner=False の文書だけ。
+        public では、それに加えて所属グループの perm_group=False の文書（所有者の分も数えるので上限）。
+        所属していないグループのシャードで読めるのは自分が所有する文書だけなので、その doc_id に絞る。
+        """
+        scope = {}
+        for key in self.shards_for(user):
+            if key.startswith("group:") and key[len("group:"):] not in user.groups:
+                scope[key] = sorted(self.owned[user.user_id][key])
+                continue
+            extra = self.owner_blind.get((key, user.user_id), 0)
+            if key == PUBLIC:
+                extra += sum(self.group_blind.get(g, 0) for g in user.groups)
+            scope[key] = extra
+        return scope
+
+    def scope_many(self, users) -> List[tuple]:
+        """users 全員の scope() をまとめた (シャード, 指定) の組
+
+        追加で取得する件数はシャードごとに最大値を取る。doc_id の指定は和集合にし、上位 n 件ではなく全件を取る
+        （和集合から上位 n 件だけを取ると、他のユーザーの文書に押し出されることがある）。全件の指定は tuple で表す。
+        同じシャードが件数と doc_id の両方で指定されることがあるので、辞書ではなく組の列にする。
+        """
+        extras: Dict[str, int] = {}
+        ids: Dict[str, List[List[str]]] = defaultdict(list)
+        for user in users:
+            for key, spec in self.scope(user).items():
+                if isinstance(spec, list):
+                    ids[key].append(spec)
+                else:
+                    extras[key] = max(extras.get(key, 0), spec)
+        return sorted(extras.items()) + [
+            (key, specs[0] if len(specs) == 1 else tuple(sorted(set().union(*specs))))
+            for key, specs in sorted(ids.items())
+        ]
+
+    # ===== 書き込み =====
+
+    def _write(self, method: str, ids: List[str], metadatas: List[Dict], **columns):
+        """ids をシャードごとに分けて add / upsert し、シャードが変わった文書は移動元から消す"""
+        by_shard = defaultdict(list)
+        for i, meta in enumerate(metadatas):
+            by_shard[metadata_shard(meta)].append(i)
+        with self._lock:
+            moved = defaultdict(list)  # 移動元のシャード -> doc_id
+            for key, positions in by_shard.items():
+                getattr(self._collection(key), method)(
+                    ids=[ids[i] for i in positions],
+                    metadatas=[metadatas[i] for i in positions],
+                    **{name: [values[i] for i in positions] for name, values in columns.items()},
+                )
+            for key, positions in by_shard.items():
+                for i in positions:
+                    old = self.shard_of.get(ids[i])
+                    if old is not None:
+                        if old != key:
+                            moved[old].append(ids[i])
+                        self._unassign(ids[i])
+                    self._assign(ids[i], key, metadatas[i])
+            for key, doc_ids in moved.items():
+                self.collections[key].delete(ids=doc_ids)
+
+    def add(self, ids, embeddings, documents, metadatas):
+        self._write("add", ids, metadatas, embeddings=embeddings, documents=documents)
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self._write("upsert", ids, metadatas, embeddings=embeddings, documents=documents)
+
+    def update(self, ids, metadatas):
+        """メタデータを更新する。シャードが変わる文書は埋め込みごと移動する"""
+        with self._lock:
+            stay, move = defaultdict(list), []
+            for i, meta in enumerate(metadatas):
+                old = self.shard_of[ids[i]]
+                if metadata_shard(meta) == old:
+                    stay[old].append(i)
+                else:
+                    move.append(i)
+            for key, positions in stay.items():
+                self.collections[key].update(ids=[ids[i] for i in positions],
+                                             metadatas=[metadatas[i] for i in positions])
+                for i in positions:
+                    self._unassign(ids[i])
+                    self._assign(ids[i], key, metadatas[i])
+            if move:
+                records = self.get(ids=[ids[i] for i in move], include=["embeddings", "documents"])
+                by_id = {doc_id: (e, d) for doc_id, e, d in
+                         zip(records["ids"], records["embeddings"], records["documents"])}
+                self._write(
+                    "upsert",
+                    [ids[i] for i in move],
+                    [metadatas[i] for i in move],
+                    embeddings=[by_id[ids[i]][0] for i in move],
+                    documents=[by_id[ids[i]][1] for i in move],
+                )
+
+    def delete(self, ids):
+        with self._lock:
+            by_shard = defaultdict(list)
+            for doc_id in ids:
+                if doc_id in self.shard_of:
+                    by_shard[self.shard_of[doc_id]].append(doc_id)
+            for key, doc_ids in by_shard.items():
+                self.collections[key].delete(ids=doc_ids)
+                for doc_id in doc_ids:
+                    self._unassign(doc_id)
+
+    # ===== 読み出し =====
+
+    def count(self) -> int:
+        return sum(self.sizes.values())
+
+    def get(self, ids: Optional[List[str]] = None, include=("metadatas", "documents"), limit: Optional[int] = None,
+            offset: int = 0) -> Dict[str, list]:
+        """ids を指定すればその文書を、指定しなければシャード名の順に offset から limit 件を返す"""
+        include = list(include)
+        result = _empty(include)
+        if ids is not None:
+            by_shard = defaultdict(list)
+            for doc_id in ids:
+                if doc_id in self.shard_of:
+                    by_shard[self.shard_of[doc_id]].append(doc_id)
+            parts = [self.collections[key].get(ids=doc_ids, include=include) for key, doc_ids in by_shard.items()]
+        else:
+            parts = []
+            remaining = limit if limit is not None else self.count()
+            for key in sorted(k for k, n in self.sizes.items() if n > 0):
+                if remaining <= 0:
+                    break
+                if offset >= self.sizes[key]:
+                    offset -= self.sizes[key]
+                    continue
+                part = self.collections[key].get(include=include, limit=remaining, offset=offset)
+                parts.append(part)
+                remaining -= len(part["ids"])
+                offset = 0
+        for part in parts:
+            for name in result:
+                result[name].extend(part[name])
+        return result
+
+    def _query_shard(self, key: str, query_embeddings, n_results: int, spec: Union[int, List[str]], include):
+        kwargs = {"include": list(include)}
+        if isinstance(spec, tuple):
+            kwargs.update(ids=list(spec), n_results=len(spec))
+        elif isinstance(spec, list):
+            kwargs.update(ids=spec, n_results=min(n_results, len(spec)))
+        else:
+            kwargs.update(n_results=min(n_results + spec, self.sizes[key]))
+        return self.collections[key].query(query_embeddings=query_embeddings, **kwargs)
+
+    def query(self, query_embeddings, n_results: int, shards=None,
+              include=("documents", "metadatas", "distances")) -> Dict[str, list]:
+        """シャードを並列に検索し、クエリごとに距離の近い順に並べて返す
+
+        shards はシャード -> 追加で取得する件数、または検索対象の doc_id（scope() の戻り値）か、
+        その組の列（scope_many() の戻り値）。doc_id が tuple なら n_results によらず全件を返す。
+        省略時は全シャードから n_results 件ずつ取得する。
+        戻り値は n_results 件に切り詰めない（追加で取得した分は呼び出し側のアクセス権の判定で落ちるため）。
+        include には distances を含めること。
+        """
+        if shards is None:
+            shards = {k: 0 for k, n in sorted(self.sizes.items()) if n > 0}
+        items = list(shards.items() if isinstance(shards, dict) else shards)
+        if len(items) <= 1:
+            parts = [self._query_shard(k, query_embeddings, n_results, spec, include) for k, spec in items]
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=f"shards-{self.name}")
+            parts = list(self._executor.map(
+                lambda item: self._query_shard(item[0], query_embeddings, n_results, item[1], include), items))
+        fields = [name for name in include if name != "distances"]
+        merged = {"ids": [], "distances": [], **{name: [] for name in fields}}
+        for q in range(len(query_embeddings)):
+            rows = sorted(
+                ((dist, doc_id, part, j)
+                 for part in parts
+                 for j, (doc_id, dist) in enumerate(zip(part["ids"][q], part["distances"][q]))),
+                key=lambda row: (row[0], row[1]),
+            )
+            seen = set()
+            top = []
+            for row in rows:
+                if row[1] not in seen:
+                    seen.add(row[1])
+                    top.append(row)
+            merged["distances"].append([dist for dist, _, _, _ in top])
+            merged["ids"].append([doc_id for _, doc_id, _, _ in top])
+            for name in fields:
+                merged[name].append([part[name][q][j] for _, _, part, j in top])
+        return merged
@@ -0,0 +1,292 @@
+# Slack / Google Drive 共通コレクションに対するアクセス制御付き検索 API
+#
+# ベクトルストア・埋め込みクライアント・権限インデックスはプロセス起動時に一度だけ用意し、
+# リクエスト間で使い回す。呼び出し元のメールアドレスから Slack のユーザー ID を引き、
+# Drive / Slack 双方の ACL を満たす文書だけを返す。
+#
+# 呼び出し元の認証はこのサービスでは行わない。認証済みのメールアドレスをヘッダー（既定は X-Forwarded-Email）で
+# 渡す認証プロキシ（oauth2-proxy や IAP など）の後ろに置き、プロキシ以外から届かないようにする。
+#   - 既定では 127.0.0.1 で待ち受ける（API_HOST で変更）
+#   - API_PROXY_SECRET を設定すると、プロキシが X-Proxy-Secret に付けた同じ値のリクエストだけを受け付ける
+# 所属グループはクライアントから受け取らず、サーバー側の設定ファイル（API_GROUPS_FILE）で引く。
+#
+#   API_PROXY_SECRET=... uv run --extra api api.py
+#   curl -H "X-Forwarded-Email: alice@example.com" -H "X-Proxy-Secret: ..." "http://localhost:8000/search?q=設計"
+
+import hmac
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import chromadb
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from embedding_backends import create_embeddings
+from embedding_cache import CachedEmbeddings, QueryEmbeddingCache
+from instrumentation import Metrics
+from permission_index import DEFAULT_INDEX_PATH, PermissionIndex, identity_principals
+from shared_collection import COLLECTION_NAME, EMBEDDING_MODEL, PERSIST_DIRECTORY, check_embedding_model
+
+load_dotenv()
+
+# 認証プロキシが認証済みのメールアドレスを入れるヘッダー
+IDENTITY_HEADER = os.getenv("API_IDENTITY_HEADER", "X-Forwarded-Email")
+PROXY_SECRET_HEADER = "X-Proxy-Secret"
+# グループのメールアドレス -> メンバーのメールアドレスの一覧（JSON）
+DEFAULT_GROUPS_PATH = ".api_groups.json"
+
+# 閲覧可能なリソースがこれ以下なら where 句（$in）で絞り込んで検索する。多ければ where 句を使わずに
+# top_k * POOL_FACTOR 件の候補を取り、権限インデックスのマスクで絞り込む（足りなければ POOL_FACTOR 倍に広げる）。
+# 候補が MAX_POOL 件でも足りないユーザーだけは where 句で検索し直す。
+WHERE_MAX_RESOURCES = 200
+POOL_FACTOR = 4
+MAX_POOL = 2000
+
+
+class TrustedProxyAuth:
+    """認証プロキシが付けたヘッダーから呼び出し元のメールアドレスを取り出す
+
+    secret を指定すると、X-Proxy-Secret が一致しないリクエストは 401 にする。
+    """
+
+    def __init__(self, header: str = IDENTITY_HEADER, secret: Optional[str] = None):
+        self.header = header
+        self.secret = secret
+
+    def email(self, request: Request) -> str:
+        if self.secret is not None:
+            presented = request.headers.get(PROXY_SECRET_HEADER, "")
+            if not hmac.compare_digest(presented.encode(), self.secret.encode()):
+                raise HTTPException(status_code=401, detail="request did not come through the trusted proxy")
+        email = request.headers.get(self.header, "").strip()
+        if not email:
+            raise HTTPException(status_code=401, detail=f"missing {self.header} header")
+        return email.lower()
+
+
+class GroupDirectory:
+    """メールアドレス -> 所属グループ（設定ファイルが更新されたら読み直す）
+
+    ファイルは {"eng@example.com": ["alice@example.com", ...]} の形式。ファイルが無ければ所属なし。
+    """
+
+    def __init__(self, path: str = DEFAULT_GROUPS_PATH):
+        self.path = path
+        self._mtime = None
+        self._groups: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    def groups(self, email: str) -> List[str]:
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if mtime != self._mtime:
+                with open(self.path, encoding="utf-8") as f:
+                    members = json.load(f)
+                groups: Dict[str, List[str]] = {}
+                for group, emails in members.items():
+                    for member in emails:
+                        groups.setdefault(member.lower(), []).append(group.lower())
+                self._groups, self._mtime = groups, mtime
+            return list(self._groups.get(email.lower(), []))
+
+
+class IdentityResolver:
+    """メールアドレス -> Slack ユーザー ID（結果はプロセス内でキャッシュ）"""
+
+    def __init__(self, slack_client: Optional[WebClient]):
+        self.slack_client = slack_client
+        self._slack_ids: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    def slack_user_id(self, email: str) -> Optional[str]:
+        if self.slack_client is None:
+            return None
+        with self._lock:
+            if email in self._slack_ids:
+                return self._slack_ids[email]
+        try:
+            user_id = self.slack_client.users_lookupByEmail(email=email)["user"]["id"]
+        except SlackApiError:
+            user_id = None
+        with self._lock:
+            self._slack_ids[email] = user_id
+        return user_id
+
+    def principals(self, email: Optional[str], groups: List[str]) -> List[str]:
+        slack_user_id = self.slack_user_id(email) if email else None
+        return identity_principals(email=email, slack_user_id=slack_user_id, groups=groups)
+
+
+class PermissionIndexLoader:
+    """インデックスファイルが取り込み処理で更新されたら読み直す"""
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        self.path = path
+        self._mtime = None
+        self._index: Optional[PermissionIndex] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[PermissionIndex]:
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if mtime != self._mtime:
+                self._index = PermissionIndex.load(self.path)
+                self._mtime = mtime
+            return self._index
+
+
+class LatencyRecorder:
+    """直近 window 件のレイテンシから p50 / p99 を求める"""
+
+    def __init__(self, window: int = 10000):
+        self._values = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, ms: float):
+        with self._lock:
+            self._values.append(ms)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            values = np.array(self._values)
+        if not len(values):
+            return {"count": 0, "p50_ms": None, "p99_ms": None}
+        return {
+            "count": len(values),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p99_ms": float(np.percentile(values, 99)),
+        }
+
+
+class SearchHit(BaseModel):
+    id: str
+    text: str
+    metadata: Dict
+    similarity: float
+
+
+class SearchResponse(BaseModel):
+    results: List[SearchHit]
+    took_ms: float
+
+
+class QueryService:
+    def __init__(self, persist_directory: str = PERSIST_DIRECTORY, index_path: str = DEFAULT_INDEX_PATH,
+                 embeddings=None, slack_client: Optional[WebClient] = None, groups_path: str = DEFAULT_GROUPS_PATH):
+        self.collection = chromadb.PersistentClient(path=persist_directory).get_or_create_collection(COLLECTION_NAME)
+        self.embeddings = embeddings or create_embeddings(model=EMBEDDING_MODEL)
+        # 取り込み時と違うモデルのクエリでは距離が比べられないので、起動時にエラーにする
+        check_embedding_model(self.collection, self.embeddings)
+        self.query_embeddings = QueryEmbeddingCache(self.embeddings)
+        self.identity = IdentityResolver(slack_client)
+        self.group_directory = GroupDirectory(groups_path)
+        self.index_loader = PermissionIndexLoader(index_path)
+        self.latency = LatencyRecorder()
+        self.metrics = Metrics()
+
+    def search(self, query: str, email: str, top_k: int) -> SearchResponse:
+        """email は認証済みのメールアドレス。所属グループはサーバー側で引く"""
+        start = time.perf_counter()
+        hits = []
+        index = self.index_loader.get()
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="principals"):
+            principals = self.identity.principals(email, self.group_directory.groups(email))
+            visible = index.visible_mask(principals) if index else None
+        if visible is not None and visible.any():
+            with self.metrics.timer("acvdb_search_stage_seconds", stage="embed_query"):
+                query_embedding = self.query_embeddings.embed_query(query)
+            with self.metrics.timer("acvdb_search_stage_seconds", stage="query"):
+                results, allowed = self._candidates(query_embedding, index, visible, top_k)
+            self.metrics.inc("acvdb_search_candidates_fetched_total", len(allowed))
+            self.metrics.inc("acvdb_search_candidates_accepted_total", int(allowed.sum()))
+            for ok, id_, text, meta, dist in zip(
+                allowed, results["ids"][0], results["documents"][0], results["metadatas"][0], results["distances"][0]
+            ):
+                if ok and len(hits) < top_k:
+                    hits.append(SearchHit(id=id_, text=text, metadata=meta, similarity=1 - dist))
+        took_ms = (time.perf_counter() - start) * 1000
+        self.latency.record(took_ms)
+        self.metrics.observe("acvdb_search_stage_seconds", took_ms / 1000, stage="total")
+        return SearchResponse(results=hits, took_ms=took_ms)
+
+    def _candidates(self, query_embedding, index: PermissionIndex, visible: np.ndarray, top_k: int):
+        """検索結果と、その各候補の閲覧可否（権限インデックスで判定）"""
+        if visible.sum() > WHERE_MAX_RESOURCES:
+            n_results = top_k * POOL_FACTOR
+            while True:
+                n_results = min(n_results, MAX_POOL)
+                results = self.collection.query(query_embeddings=[query_embedding], n_results=n_results)
+                allowed = index.candidate_mask(results["metadatas"][0], visible=visible)
+                # 要求より少なく返ったらコレクションの全件を見ている
+                if allowed.sum() >= top_k or len(results["ids"][0]) < n_results:
+                    return results, allowed
+                if n_results >= MAX_POOL:
+                    break
+                n_results *= POOL_FACTOR
+        results = self.collection.query(query_embeddings=[query_embedding], n_results=top_k,
+                                        where=index.where_filter(visible=visible))
+        # where 句で絞り込み済みだが、念のため権限インデックスでも確認する
+        return results, index.candidate_mask(results["metadatas"][0], visible=visible)
+
+
+def create_service() -> QueryService:
+    token = os.getenv("SLACK_BOT_TOKEN")
+    return QueryService(slack_client=WebClient(token=token) if token else None,
+                        groups_path=os.getenv("API_GROUPS_FILE", DEFAULT_GROUPS_PATH))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.service = create_service()
+    app.state.auth = TrustedProxyAuth(secret=os.getenv("API_PROXY_SECRET"))
+    yield
+
+
+app = FastAPI(title="rag-access-control", lifespan=lifespan)
+
+
+def caller_email(request: Request) -> str:
+    return request.app.state.auth.email(request)
+
+
+@app.get("/search", response_model=SearchResponse)
+def search(q: str, k: int = Query(5, ge=1, le=100), email: str = Depends(caller_email)):
+    return app.state.service.search(q, email, k)
+
+
+@app.get("/metrics/prometheus", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return app.state.service.metrics.render()
+
+
+@app.get("/metrics")
+def metrics():
+    service = app.state.service
+    summary = service.latency.summary()
+    summary["query_embedding_cache"] = service.query_embeddings.stats()
+    if isinstance(service.embeddings, CachedEmbeddings):
+        summary["embedding_cache"] = service.embeddings.stats()
+    return summary
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # 認証プロキシからだけ届くよう、既定ではループバックで待ち受ける
+    uvicorn.run(app, host=os.getenv("API_HOST", "127.0.0.1"), port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,546 @@
+# AccessControlledVectorDB のオフラインベンチマーク
+# OpenAI を使わずにローカルの埋め込み（embedding_backends.HashingEmbeddings）で計測する
+#
+#   uv run benchmark.py search
+#   uv run benchmark.py ingest --batch-size 256
+#   uv run benchmark.py suite --sizes 10000 100000 1000000
+#   uv run benchmark.py acl --sizes 1000 10000 100000
+#   uv run benchmark.py coldstart --sizes 10000 100000 1000000
+#   uv run benchmark.py shards --sizes 10000 100000
+#   uv run benchmark.py many --sizes 10000 --users 200
+#   uv run benchmark.py compact --sizes 10000 50000
+
+import argparse
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+from embedding_backends import HashingEmbeddings
+from main import AccessControlledVectorDB, Document, User
+from permission_columns import PermissionColumns
+
+# 検索ごとの候補ログは計測のノイズになるので抑制する
+logging.getLogger("main").setLevel(logging.WARNING)
+
+GROUPS = ["eng", "mkt", "sales", "hr", "all"]
+
+# 権限の出現比率（r-- 個人用 / rr- グループ共有 / rrr 全体公開 / --- 下書き）
+PERMISSION_MIX = [
+    ({'owner': True, 'group': False, 'other': False}, 0.30),
+    ({'owner': True, 'group': True, 'other': False}, 0.645),
+    ({'owner': True, 'group': True, 'other': True}, 0.005),
+    ({'owner': False, 'group': False, 'other': False}, 0.05),
+]
+
+# 検索レイテンシを集計するユーザーの選択率（閲覧可能な文書の割合）の区分
+SELECTIVITY_BUCKETS = [(0.0, 0.01, "<1%"), (0.01, 0.1, "1-10%"), (0.1, 0.5, "10-50%"), (0.5, 1.01, ">=50%")]
+
+WORDS = ["設計", "API", "認証", "レート制限", "マーケ", "施策", "採用", "評価", "予算", "障害", "リリース", "手順",
+         "ガイド", "ポリシー", "議事録", "見積", "契約", "分析", "監視", "移行"]
+
+
+def create_synthetic_users(n_users=50, n_groups=5, seed=0):
+    """create_sample_data と同じ形式のユーザー。グループは大きいものほど所属者が多い（Zipf 分布）"""
+    rng = random.Random(seed)
+    groups = GROUPS[:n_groups] if n_groups <= len(GROUPS) else [f"team{i}" for i in range(n_groups)]
+    weights = [1 / (rank + 1) for rank in range(len(groups))]
+    users = []
+    for i in range(n_users):
+        # 1割はどのグループにも属さない（ゲストなど）
+        n_member = 0 if rng.random() < 0.1 else rng.randint(1, 3)
+        users.append(User(f"user{i}", set(rng.choices(groups, weights, k=n_member))))
+    return users, groups
+
+
+def iter_synthetic_documents(n_docs, users, groups, seed=0):
+    """合成文書を1件ずつ生成する（100万件でもリストを持たずに投入できる）
+
+    文書の所有者は一部のユーザーに偏り（Zipf 分布）、文書のグループは8割が所有者の所属グループ。
+    """
+    rng = random.Random(seed)
+    owner_weights = [1 / (rank + 1) ** 1.1 for rank in range(len(users))]
+    perms, perm_weights = zip(*PERMISSION_MIX)
+    owners = rng.choices(users, owner_weights, k=n_docs)
+    for i, owner in enumerate(owners):
+        if owner.groups and rng.random() < 0.8:
+            group = rng.choice(sorted(owner.groups))
+        else:
+            group = rng.choice(groups)
+        words = " ".join(rng.choices(WORDS, k=4))
+        yield Document(
+            f"doc{i}",
+            f"文書{i} {rng.choice(WORDS)}",
+            f"合成コンテンツ {i} {words} {group}",
+            owner.user_id,
+            group,
+            dict(rng.choices(perms, perm_weights)[0]),
+        )
+
+
+def create_synthetic_data(n_docs, n_users=50, seed=0):
+    """create_sample_data と同じ形式の合成データを生成する"""
+    users, groups = create_synthetic_users(n_users, seed=seed)
+    return list(iter_synthetic_documents(n_docs, users, groups, seed=seed)), users
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def rss_mb():
+    """現在の常駐メモリ（MB）。/proc が無い環境では最大常駐メモリで代用する"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class AccessCounter:
+    """(owner, group, 権限) の組ごとに文書数を数え、ユーザーごとの閲覧可能な文書数を can_access で求める"""
+
+    def __init__(self, db):
+        self.db = db
+        self.counts = Counter()
+
+    def wrap(self, docs):
+        for doc in docs:
+            p = doc.permissions
+            self.counts[(doc.owner, doc.group, p['owner'], p['group'], p['other'])] += 1
+            yield doc
+
+    def selectivity(self, user):
+        total = sum(self.counts.values())
+        visible = sum(
+            n for (owner, group, po, pg, pt), n in self.counts.items()
+            if self.db.can_access(user, Document("", "", "", owner, group, {'owner': po, 'group': pg, 'other': pt}))
+        )
+        return visible / total if total else 0.0
+
+
+def bench_search(sizes, n_queries=200, keep_documents=True):
+    """コーパスサイズを変えたときの search() のレイテンシを計測する"""
+    print(f"▼ search() レイテンシ (keep_documents={keep_documents})")
+    print(f"{'docs':>8} | {'p50 ms':>8} | {'p99 ms':>8} | {'mean ms':>8}")
+    for size in sizes:
+        db = AccessControlledVectorDB(
+            collection_name=f"bench_search_{size}",
+            embeddings=HashingEmbeddings(size=64),
+            keep_documents=keep_documents,
+            result_cache_size=0,
+        )
+        docs, users = create_synthetic_data(size)
+        db.add_documents(docs)
+
+        rng = random.Random(1)
+        latencies = []
+        for i in range(n_queries):
+            user = rng.choice(users)
+            start = time.perf_counter()
+            db.search(f"クエリ {i % 20}", user)
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"{size:>8} | {percentile(latencies, 50):8.3f} | {percentile(latencies, 99):8.3f}"
+              f" | {statistics.mean(latencies):8.3f}")
+        db.chroma_client.delete_collection(db.collection_name)
+    print()
+
+
+def bench_ingest(sizes, batch_size=256):
+    """add_document（1件ずつ）と add_documents（バッチ）の投入スループットを比較する"""
+    print(f"▼ 投入スループット (batch_size={batch_size})")
+    print(f"{'docs':>8} | {'add_document':>14} | {'add_documents':>14}")
+    for size in sizes:
+        docs, _ = create_synthetic_data(size)
+        rates = []
+        for bulk in (False, True):
+            db = AccessControlledVectorDB(
+                collection_name=f"bench_ingest_{size}",
+                embeddings=HashingEmbeddings(size=64),
+            )
+            start = time.perf_counter()
+            if bulk:
+                db.add_documents(docs, batch_size=batch_size)
+            else:
+                for doc in docs:
+                    db.add_document(doc)
+            rates.append(size / (time.perf_counter() - start))
+            db.chroma_client.delete_collection(db.collection_name)
+        print(f"{size:>8} | {rates[0]:>8.1f} doc/s | {rates[1]:>8.1f} doc/s")
+    print()
+
+
+def bench_suite(sizes, n_users=200, n_groups=50, n_queries=200, batch_size=1000, dim=256, keep_documents=False,
+                top_k=3):
+    """コーパスサイズごとに投入スループット・メモリ・選択率別の検索レイテンシをまとめて計測する
+
+    結果キャッシュは無効にし、クエリはすべて異なる文字列にする。
+    """
+    print(f"▼ ベンチマークスイート (users={n_users}, groups={n_groups}, dim={dim}, batch_size={batch_size},"
+          f" keep_documents={keep_documents}, top_k={top_k})")
+    print(f"{'docs':>8} | {'ingest doc/s':>12} | {'RSS MB':>8} | {'selectivity':>11} | {'users':>5}"
+          f" | {'post p50':>8} | {'post p99':>8} | {'pre p50':>8} | {'pre p99':>8}")
+    for size in sizes:
+        users, groups = create_synthetic_users(n_users, n_groups=n_groups)
+        db = AccessControlledVectorDB(
+            collection_name=f"bench_suite_{size}",
+            embeddings=HashingEmbeddings(size=dim),
+            keep_documents=keep_documents,
+            result_cache_size=0,
+        )
+        counter = AccessCounter(db)
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        db.add_documents(counter.wrap(iter_synthetic_documents(size, users, groups)), batch_size=batch_size)
+        ingest_rate = size / (time.perf_counter() - start)
+        rss = rss_mb() - rss_before
+
+        by_bucket = {label: [] for _, _, label in SELECTIVITY_BUCKETS}
+        for user in users:
+            s = counter.selectivity(user)
+            label = next(label for lo, hi, label in SELECTIVITY_BUCKETS if lo <= s < hi)
+            by_bucket[label].append(user)
+
+        rng = random.Random(1)
+        first = True
+        for label, bucket_users in by_bucket.items():
+            if not bucket_users:
+                continue
+            row = []
+            for prefilter in (False, True):
+                latencies = []
+                for i in range(n_queries):
+                    query = f"{' '.join(rng.choices(WORDS, k=2))} {i}"
+                    user = rng.choice(bucket_users)
+                    t = time.perf_counter()
+                    db.search(query, user, top_k=top_k, prefilter=prefilter)
+                    latencies.append((time.perf_counter() - t) * 1000)
+                row += [percentile(latencies, 50), percentile(latencies, 99)]
+            head = (f"{size:>8} | {ingest_rate:>12.1f} | {rss:>8.1f}" if first
+                    else f"{'':>8} | {'':>12} | {'':>8}")
+            print(f"{head} | {label:>11} | {len(bucket_users):>5} | "
+                  + " | ".join(f"{v:8.3f}" for v in row))
+            first = False
+        db.chroma_client.delete_collection(db.collection_name)
+    print()
+
+
+def check_permission_columns(n_docs=2000, n_users=30, rounds=20, seed=0):
+    """PermissionColumns.mask が can_access と一致するかをランダムな文書・ユーザー・更新で確かめる
+
+    一致しなければ AssertionError。tests/test_permission_columns.py と bench_acl から呼ぶ。
+    一致したら (文書数, ユーザー数) を返す。
+    """
+    rng = random.Random(seed)
+    names = [f"u{i}" for i in range(n_users)]
+    groups = [f"g{i}" for i in range(6)]
+    users = [User(name, set(rng.sample(groups, rng.randint(0, 3)))) for name in names]
+    users.append(User("stranger", {"unknown"}))  # 文書に一度も出てこないユーザーとグループ
+
+    def random_doc(doc_id):
+        return Document(doc_id, "", "", rng.choice(names), rng.choice(groups),
+                        {k: rng.random() < 0.5 for k in ("owner", "group", "other")})
+
+    columns = PermissionColumns(capacity=4)
+    docs = {}
+    for r in range(rounds):
+        for _ in range(n_docs // rounds):
+            doc = random_doc(f"d{rng.randrange(n_docs)}")
+            docs[doc.doc_id] = doc
+            columns.set(doc.doc_id, doc.owner, doc.group, doc.permissions)
+        for doc_id in rng.sample(sorted(docs), min(len(docs), 5)):
+            del docs[doc_id]
+            columns.remove(doc_id)
+        doc_ids = sorted(docs) + ["missing"]
+        for user in users:
+            expected = [doc_id in docs and AccessControlledVectorDB.can_access(None, user, docs[doc_id])
+                        for doc_id in doc_ids]
+            actual = columns.mask_for(user, doc_ids).tolist()
+            assert actual == expected, f"mismatch for {user.user_id} in round {r}"
+            rows = columns.row_indices(doc_ids)
+            assert columns.mask_many([user], rows)[0].tolist() == expected
+        readable = [columns.readable_rows(user).tolist() for user in users]
+        assert [len(r) for r in readable] == columns.readable_counts(users).tolist()
+        assert readable == [sorted(columns.rows[d] for d in docs
+                                   if AccessControlledVectorDB.can_access(None, user, docs[d])) for user in users]
+    return len(docs), len(users)
+
+
+def bench_acl(sizes, n_users=200, n_groups=50, repeat=20):
+    """候補文書数ごとに、can_access のループと PermissionColumns.mask の判定時間を比較する"""
+    n_docs, n_users_checked = check_permission_columns()
+    print(f"PermissionColumns と can_access の判定が一致しました（{n_docs}文書 x {n_users_checked}ユーザー）")
+    print("▼ 閲覧可否の判定時間（1ユーザー x 候補文書）")
+    print(f"{'candidates':>10} | {'can_access ms':>13} | {'mask ms':>8} | {'speedup':>7} | {'mask_for ms':>11}")
+    users, groups = create_synthetic_users(n_users, n_groups=n_groups)
+    for size in sizes:
+        docs = list(iter_synthetic_documents(size, users, groups))
+        columns = PermissionColumns()
+        for d in docs:
+            columns.set(d.doc_id, d.owner, d.group, d.permissions)
+        rows = columns.row_indices(d.doc_id for d in docs)
+        rng = random.Random(1)
+        doc_ids = [d.doc_id for d in docs]
+        loop_ms, mask_ms, mask_for_ms = [], [], []
+        for _ in range(repeat):
+            user = rng.choice(users)
+            start = time.perf_counter()
+            expected = [AccessControlledVectorDB.can_access(None, user, d) for d in docs]
+            loop_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            actual = columns.mask(user, rows)
+            mask_ms.append((time.perf_counter() - start) * 1000)
+            assert np.array_equal(actual, expected)
+            # doc_id から行番号を引く分も含めた時間
+            start = time.perf_counter()
+            columns.mask_for(user, doc_ids)
+            mask_for_ms.append((time.perf_counter() - start) * 1000)
+        loop, mask = statistics.median(loop_ms), statistics.median(mask_ms)
+        print(f"{size:>10} | {loop:13.3f} | {mask:8.3f} | {loop / mask:6.1f}x | {statistics.median(mask_for_ms):11.3f}")
+    print()
+
+
+def bench_coldstart(sizes, batch_size=1000, dim=256):
+    """永続化モードで、全件の再投入・開き直し（マニフェストあり / なし）にかかる時間を比較する"""
+    print(f"▼ 起動時間 (dim={dim}, batch_size={batch_size})")
+    print(f"{'docs':>8} | {'re-ingest s':>11} | {'warm open ms':>12} | {'1st query ms':>12} | {'rebuild ACL ms':>14}")
+    users, groups = create_synthetic_users(200, n_groups=50)
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix="acvdb_bench_")
+        try:
+            db = AccessControlledVectorDB("coldstart", embeddings=HashingEmbeddings(size=dim),
+                                          keep_documents=False, persist_directory=directory)
+            start = time.perf_counter()
+            db.add_documents(iter_synthetic_documents(size, users, groups), batch_size=batch_size)
+            ingest = time.perf_counter() - start
+            del db
+
+            start = time.perf_counter()
+            db = AccessControlledVectorDB("coldstart", embeddings=HashingEmbeddings(size=dim),
+                                          keep_documents=False, persist_directory=directory)
+            warm_open = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            db.search("設計 API", users[0])
+            first_query = (time.perf_counter() - start) * 1000
+            del db
+
+            # マニフェストが無い（前回の終了時に保存されなかった）場合は Chroma のメタデータから作り直す
+            os.remove(os.path.join(directory, "coldstart.manifest.json"))
+            start = time.perf_counter()
+            AccessControlledVectorDB("coldstart", embeddings=HashingEmbeddings(size=dim),
+                                     keep_documents=False, persist_directory=directory)
+            rebuild = (time.perf_counter() - start) * 1000
+            print(f"{size:>8} | {ingest:11.1f} | {warm_open:12.1f} | {first_query:12.1f} | {rebuild:14.1f}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    print()
+
+
+def bench_shards(sizes, n_users=200, n_groups=50, n_queries=200, batch_size=1000, dim=256, top_k=3):
+    """単一コレクションと ACL シャード（sharded=True）で、選択率別の検索レイテンシを比較する
+
+    scanned はユーザーの検索対象になる文書数の平均（単一コレクションでは常に全件）。
+    hits は返った件数の平均で、単一コレクションの事後フィルタは候補がフィルタで落ちると top_k に満たない。
+    match はシャード構成の結果が単一コレクションの事前フィルタと一致した割合。
+    """
+    print(f"▼ ACL シャード (users={n_users}, groups={n_groups}, dim={dim}, top_k={top_k})")
+    print(f"{'docs':>8} | {'shards':>6} | {'selectivity':>11} | {'users':>5} | {'scanned':>8}"
+          f" | {'post p50':>8} | {'pre p50':>8} | {'shard p50':>9} | {'post hits':>9} | {'shard hits':>10}"
+          f" | {'match':>5}")
+    for size in sizes:
+        users, groups = create_synthetic_users(n_users, n_groups=n_groups)
+        dbs = []
+        for sharded in (False, True):
+            db = AccessControlledVectorDB(
+                collection_name=f"bench_shards_{size}_{int(sharded)}",
+                embeddings=HashingEmbeddings(size=dim),
+                keep_documents=False,
+                result_cache_size=0,
+                sharded=sharded,
+            )
+            counter = AccessCounter(db)
+            db.add_documents(counter.wrap(iter_synthetic_documents(size, users, groups)), batch_size=batch_size)
+            dbs.append(db)
+        flat, sharded_db = dbs
+        shards = sharded_db.collection
+
+        by_bucket = {label: [] for _, _, label in SELECTIVITY_BUCKETS}
+        for user in users:
+            s = counter.selectivity(user)
+            label = next(label for lo, hi, label in SELECTIVITY_BUCKETS if lo <= s < hi)
+            by_bucket[label].append(user)
+
+        rng = random.Random(1)
+        first = True
+        for label, bucket_users in by_bucket.items():
+            if not bucket_users:
+                continue
+            scanned = statistics.mean(
+                sum(len(spec) if isinstance(spec, list) else shards.sizes[key]
+                    for key, spec in shards.scope(u).items())
+                for u in bucket_users)
+            queries = [(f"{' '.join(rng.choices(WORDS, k=2))} {i}", rng.choice(bucket_users)) for i in range(n_queries)]
+            latencies, results = [], []
+            for db, prefilter in ((flat, False), (flat, True), (sharded_db, False)):
+                times, ids = [], []
+                for query, user in queries:
+                    t = time.perf_counter()
+                    hits = db.search(query, user, top_k=top_k, prefilter=prefilter)
+                    times.append((time.perf_counter() - t) * 1000)
+                    ids.append([h["doc_id"] for h in hits])
+                latencies.append(percentile(times, 50))
+                results.append(ids)
+            post_ids, exact_ids, sharded_ids = results
+            match = sum(a == b for a, b in zip(exact_ids, sharded_ids)) / len(queries)
+            head = f"{size:>8} | {len(shards.collections):>6}" if first else f"{'':>8} | {'':>6}"
+            print(f"{head} | {label:>11} | {len(bucket_users):>5} | {scanned:>8.0f}"
+                  f" | {latencies[0]:8.3f} | {latencies[1]:8.3f} | {latencies[2]:9.3f}"
+                  f" | {statistics.mean(len(r) for r in post_ids):9.2f}"
+                  f" | {statistics.mean(len(r) for r in sharded_ids):10.2f} | {match:5.0%}")
+            first = False
+        flat.chroma_client.delete_collection(flat.collection_name)
+        shards.drop()
+    print()
+
+
+def bench_many(sizes, n_users=200, n_groups=50, n_queries=5, batch_size=1000, dim=256, top_k=3):
+    """n_queries x n_users の検索を、search() のループと search_batch() で比較する
+
+    どちらも結果キャッシュは使わない。identical は search_batch() の結果が search() と一致した割合。
+    """
+    print(f"▼ 一括検索 (users={n_users}, queries={n_queries}, dim={dim}, top_k={top_k})")
+    print(f"{'docs':>8} | {'mode':>10} | {'loop ms':>9} | {'batch ms':>9} | {'speedup':>7} | {'identical':>9}")
+    for size in sizes:
+        users, groups = create_synthetic_users(n_users, n_groups=n_groups)
+        queries = [f"{' '.join(random.Random(i).choices(WORDS, k=2))} {i}" for i in range(n_queries)]
+        for sharded in (False, True):
+            db = AccessControlledVectorDB(
+                collection_name=f"bench_many_{size}_{int(sharded)}",
+                embeddings=HashingEmbeddings(size=dim),
+                keep_documents=False,
+                result_cache_size=0,
+                sharded=sharded,
+            )
+            db.audit.sample_rate = 0
+            db.add_documents(iter_synthetic_documents(size, users, groups), batch_size=batch_size)
+            for prefilter in ((False,) if sharded else (False, True)):
+                start = time.perf_counter()
+                expected = [{u.user_id: db.search(q, u, top_k=top_k, prefilter=prefilter) for u in users}
+                            for q in queries]
+                loop = (time.perf_counter() - start) * 1000
+                start = time.perf_counter()
+                actual = db.search_batch(queries, users, top_k=top_k, prefilter=prefilter)
+                batch = (time.perf_counter() - start) * 1000
+                identical = sum(a[u.user_id] == e[u.user_id] for a, e in zip(actual, expected) for u in users)
+                mode = "sharded" if sharded else ("prefilter" if prefilter else "postfilter")
+                print(f"{size:>8} | {mode:>10} | {loop:9.1f} | {batch:9.1f} | {loop / batch:6.1f}x"
+                      f" | {identical / (len(users) * len(queries)):9.0%}")
+            if sharded:
+                db.collection.drop()
+            else:
+                db.chroma_client.delete_collection(db.collection_name)
+    print()
+
+
+def bench_compact(sizes, n_users=200, n_groups=50, n_queries=100, batch_size=1000, dim=1536, top_k=10,
+                  configs=(("int8", 4), ("int8", 8), ("pq", 8), ("pq", 32))):
+    """量子化インデックス（build_compact_index）の recall@k・メモリ・レイテンシを比較する
+
+    正解は閲覧可能な文書全件の float32 の埋め込みとの距離を numpy で計算した上位 top_k 件。
+    bytes/doc は1文書あたりの埋め込みの大きさ（float32 は dim * 4、int8 は dim + ノルム 4、pq は部分空間数）。
+    基準として Chroma の事前フィルタ（prefilter=True）も計測する。
+    """
+    print(f"▼ 量子化インデックス (users={n_users}, dim={dim}, top_k={top_k}, queries={n_queries})")
+    print(f"{'docs':>8} | {'index':>16} | {'bytes/doc':>9} | {'MB':>8} | {'recall@k':>8} | {'p50 ms':>8}"
+          f" | {'p95 ms':>8}")
+    for size in sizes:
+        users, groups = create_synthetic_users(n_users, n_groups=n_groups)
+        db = AccessControlledVectorDB(
+            collection_name=f"bench_compact_{size}",
+            embeddings=HashingEmbeddings(size=dim),
+            keep_documents=False,
+            result_cache_size=0,
+        )
+        db.audit.sample_rate = 0
+        db.add_documents(iter_synthetic_documents(size, users, groups), batch_size=batch_size)
+
+        # 正解を計算するための float32 の埋め込み（ACL の行番号順）
+        vectors = np.zeros((len(db.acl.row_ids), dim), dtype=np.float32)
+        for offset in range(0, size, batch_size):
+            page = db.collection.get(include=["embeddings"], limit=batch_size, offset=offset)
+            vectors[db.acl.row_indices(page["ids"])] = page["embeddings"]
+        rng = random.Random(1)
+        queries = [(f"{' '.join(rng.choices(WORDS, k=2))} {i}", rng.choice(users)) for i in range(n_queries)]
+        truth = []
+        for query, user in queries:
+            rows = db.acl.readable_rows(user)
+            q = np.asarray(db.query_embeddings.embed_query(query), dtype=np.float32)
+            dists = ((vectors[rows] - q) ** 2).sum(axis=1)
+            truth.append({db.acl.row_ids[r] for r in rows[np.argsort(dists, kind="stable")[:top_k]]})
+
+        def run(label, per_doc):
+            times, found = [], 0
+            for (query, user), expected in zip(queries, truth):
+                t = time.perf_counter()
+                hits = db.search(query, user, top_k=top_k, prefilter=True)
+                times.append((time.perf_counter() - t) * 1000)
+                found += len(expected & {h["doc_id"] for h in hits})
+            recall = found / max(1, sum(len(e) for e in truth))
+            print(f"{size:>8} | {label:>16} | {per_doc:>9} | {size * per_doc / 2**20:8.1f} | {recall:8.3f}"
+                  f" | {percentile(times, 50):8.3f} | {percentile(times, 95):8.3f}")
+
+        run("float32 (chroma)", dim * 4)
+        for kind, rerank in configs:
+            index = db.build_compact_index(kind, rerank=rerank)
+            run(f"{kind} x{rerank}", index.width + (4 if kind == "int8" else 0))
+        db.compact.remove_files()
+        db.chroma_client.delete_collection(db.collection_name)
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AccessControlledVectorDB のベンチマーク")
+    parser.add_argument("target", choices=["search", "ingest", "suite", "acl", "coldstart", "shards", "many", "compact"], help="計測対象")
+    parser.add_argument("--sizes", type=int, nargs="+", default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--users", type=int, default=200, help="suite のユーザー数")
+    parser.add_argument("--queries", type=int, default=200, help="suite の選択率区分ごとのクエリ数")
+    parser.add_argument("--dim", type=int, default=None,
+                        help="埋め込み次元（省略時は compact が 1536、それ以外は 256）")
+    args = parser.parse_args()
+    if args.dim is None:
+        args.dim = 1536 if args.target == "compact" else 256
+
+    if args.target == "search":
+        sizes = args.sizes or [1000, 5000, 20000]
+        bench_search(sizes)
+        bench_search(sizes, keep_documents=False)
+    elif args.target == "ingest":
+        bench_ingest(args.sizes or [1000, 5000, 20000], batch_size=args.batch_size)
+    elif args.target == "suite":
+        bench_suite(args.sizes or [10000, 100000], n_users=args.users, n_queries=args.queries,
+                    batch_size=args.batch_size, dim=args.dim)
+    elif args.target == "acl":
+        bench_acl(args.sizes or [100, 1000, 10000, 100000], n_users=args.users)
+    elif args.target == "coldstart":
+        bench_coldstart(args.sizes or [10000, 100000], batch_size=max(args.batch_size, 1000), dim=args.dim)
+    elif args.target == "shards":
+        bench_shards(args.sizes or [10000, 100000], n_users=args.users, n_queries=args.queries,
+                     batch_size=max(args.batch_size, 1000), dim=args.dim)
+    elif args.target == "many":
+        bench_many(args.sizes or [10000], n_users=args.users, batch_size=max(args.batch_size, 1000), dim=args.dim)
+    elif args.target == "compact":
+        bench_compact(args.sizes or [10000, 50000], n_users=args.users, n_queries=min(args.queries, 100),
+                      batch_size=max(args.batch_size, 1000), dim=args.dim)
+
+
+if __name__ == "__main__":
+    main()
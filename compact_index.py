@@ -0,0 +1,164 @@
+# AccessControlledVectorDB の検索用の、量子化した埋め込みのコンパクトなインデックス
+#
+#   int8  次元ごとのスケールで int8 に量子化する（1次元 1バイト + 行ごとのノルム 4バイト）
+#   pq    直積量子化。次元を m 個の部分空間に分け、部分空間ごとに 256 個の代表ベクトルの番号を持つ（m バイト）
+#
+# 1536 次元の float32（約 6KB/文書）が int8 では約 1.5KB、pq（m=96）では 96 バイトになる。
+# 符号はメモリマップしたファイルに PermissionColumns と同じ行番号で置くので、
+# ACL のマスクで閲覧可能な行を選んでから、その行の符号だけで近似距離を計算できる。
+# 近似距離の上位を候補とし、Chroma に保存された float32 の埋め込みで距離を計算し直して並べ替える。
+# 距離は Chroma（l2）と同じ二乗ユークリッド距離。
+
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+COMPACT_KINDS = ("int8", "pq")
+
+# 近似距離を計算するときに一度に展開する行数（int8 -> float32 の一時配列の大きさを抑える）
+CHUNK_ROWS = 65536
+
+
+def _kmeans(x: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2（||x||^2 は割り当てに影響しない）
+        assign = np.argmin((centroids ** 2).sum(axis=1)[None, :] - 2 * x @ centroids.T, axis=1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class CompactIndex:
+    """行番号 -> 量子化した埋め込み（メモリマップしたファイル）
+
+    train() で量子化のパラメータを学習してから set() で符号化する。
+    path.json に種類とパラメータの概要、path.params.npz にスケールや代表ベクトルを書く。
+    """
+
+    def __init__(self, path: str, dim: int, kind: str = "int8", subspaces: Optional[int] = None):
+        if kind not in COMPACT_KINDS:
+            raise ValueError(f"unknown compact index kind: {kind!r} (choose from {', '.join(COMPACT_KINDS)})")
+        self.path = path
+        self.dim = dim
+        self.kind = kind
+        if kind == "pq":
+            subspaces = subspaces or max(1, dim // 16)
+            if dim % subspaces:
+                raise ValueError(f"dimension {dim} is not divisible by {subspaces} subspaces")
+        self.subspaces = subspaces
+        self.width = dim if kind == "int8" else subspaces  # 1行の符号のバイト数
+        self.scale: Optional[np.ndarray] = None  # int8: 次元ごとのスケール
+        self.centroids: Optional[np.ndarray] = None  # pq: (subspaces, 256, dim / subspaces)
+        self.codes: Optional[np.memmap] = None
+        self.norms: Optional[np.memmap] = None  # int8: 復元したベクトルの二乗ノルム
+        self.capacity = 0
+
+    @property
+    def trained(self) -> bool:
+        return self.scale is not None or self.centroids is not None
+
+    def nbytes(self) -> int:
+        """符号とノルムのファイルの大きさ（バイト）"""
+        return self.capacity * (self.width + (4 if self.kind == "int8" else 0))
+
+    def train(self, sample: np.ndarray, iterations: int = 10, seed: int = 0):
+        sample = np.asarray(sample, dtype=np.float32)
+        if self.kind == "int8":
+            self.scale = np.maximum(np.abs(sample).max(axis=0), 1e-12) / 127
+        else:
+            rng = np.random.default_rng(seed)
+            k = min(256, len(sample))
+            parts = sample.reshape(len(sample), self.subspaces, -1)
+            self.centroids = np.stack([_kmeans(parts[:, j], k, iterations, rng) for j in range(self.subspaces)])
+        self._save_params()
+
+    def _save_params(self):
+        params = {"scale": self.scale} if self.kind == "int8" else {"centroids": self.centroids}
+        np.savez(f"{self.path}.params.npz", **params)
+        with open(f"{self.path}.json", "w", encoding="utf-8") as f:
+            json.dump({"kind": self.kind, "dim": self.dim, "subspaces": self.subspaces}, f)
+
+    def _memmap(self, suffix: str, dtype, shape):
+        path = f"{self.path}{suffix}"
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def reserve(self, rows: int):
+        """rows 行を置けるようにファイルを広げる（倍々に広げる）"""
+        if rows <= self.capacity:
+            return
+        capacity = max(self.capacity, 1024)
+        while capacity < rows:
+            capacity *= 2
+        self.flush()
+        self.codes = self._memmap(".codes", np.uint8 if self.kind == "pq" else np.int8, (capacity, self.width))
+        if self.kind == "int8":
+            self.norms = self._memmap(".norms", np.float32, (capacity,))
+        self.capacity = capacity
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.kind == "int8":
+            return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+        parts = vectors.reshape(len(vectors), self.subspaces, -1)
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for j in range(self.subspaces):
+            c = self.centroids[j]
+            codes[:, j] = np.argmin((c ** 2).sum(axis=1)[None, :] - 2 * parts[:, j] @ c.T, axis=1)
+        return codes
+
+    def set(self, rows, vectors):
+        """rows の行に vectors を符号化して書く"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        self.reserve(int(rows.max()) + 1)
+        codes = self.encode(vectors)
+        self.codes[rows] = codes
+        if self.kind == "int8":
+            decoded = codes.astype(np.float32) * self.scale
+            self.norms[rows] = (decoded ** 2).sum(axis=1)
+
+    def distances(self, query, rows: np.ndarray) -> np.ndarray:
+        """rows の行と query の近似二乗距離"""
+        query = np.asarray(query, dtype=np.float32)
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty(len(rows), dtype=np.float32)
+        if self.kind == "int8":
+            # ||q - x||^2 = ||q||^2 + ||x||^2 - 2 q.x。スケールは q に掛けておく
+            scaled = query * self.scale
+            base = float(query @ query)
+            for start in range(0, len(rows), CHUNK_ROWS):
+                chunk = rows[start:start + CHUNK_ROWS]
+                dots = self.codes[chunk].astype(np.float32) @ scaled
+                out[start:start + len(chunk)] = base + self.norms[chunk] - 2 * dots
+        else:
+            # 部分空間ごとに query と代表ベクトルの距離の表を作り、符号で引いて足す
+            parts = query.reshape(self.subspaces, -1)
+            table = ((self.centroids - parts[:, None, :]) ** 2).sum(axis=2)  # (subspaces, 256)
+            offsets = (np.arange(self.subspaces) * table.shape[1]).astype(np.int64)
+            flat = table.ravel()
+            for start in range(0, len(rows), CHUNK_ROWS):
+                chunk = rows[start:start + CHUNK_ROWS]
+                out[start:start + len(chunk)] = flat[self.codes[chunk].astype(np.int64) + offsets].sum(axis=1)
+        return out
+
+    def flush(self):
+        for array in (self.codes, self.norms):
+            if array is not None:
+                array.flush()
+
+    def remove_files(self):
+        self.codes = self.norms = None
+        for suffix in (".codes", ".norms", ".json", ".params.npz"):
+            if os.path.exists(f"{self.path}{suffix}"):
+                os.remove(f"{self.path}{suffix}")
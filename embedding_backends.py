@@ -0,0 +1,68 @@
+# 埋め込みバックエンドの切り替え
+#
+#   EMBEDDING_BACKEND=openai  OpenAI の埋め込み API（既定。SQLite の埋め込みキャッシュ付き）
+#   EMBEDDING_BACKEND=local   文字 n-gram のハッシュによるローカル埋め込み（ネットワーク不要）
+#
+# どちらも LangChain の Embeddings として扱えるので、AccessControlledVectorDB や Chroma にそのまま渡せる。
+# local は意味的な類似度は粗いが決定的で高速なので、オフラインでの計測や動作確認に使う。
+
+import os
+import zlib
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from embedding_cache import CachedEmbeddings, normalize_query
+
+EMBEDDING_BACKENDS = ("openai", "local")
+
+
+class HashingEmbeddings(Embeddings):
+    """文字 n-gram を crc32 で size 次元に振り分けた、L2 正規化済みのベクトル
+
+    各 n-gram は符号付きで1つの次元に加算する（feature hashing）。
+    同じ文字列からは常に同じベクトルが得られ、n-gram を共有する文字列ほど近くなる。
+    """
+
+    def __init__(self, size: int = 256, ngram_range: tuple = (1, 3), seed: int = 0):
+        self.size = size
+        self.ngram_range = ngram_range
+        self.seed = seed
+        self.model = f"hashing-ngram-{ngram_range[0]}-{ngram_range[1]}-{size}-{seed}"
+
+    def _hashes(self, text: str) -> np.ndarray:
+        text = normalize_query(text).lower()
+        lo, hi = self.ngram_range
+        grams = [text[i:i + n] for n in range(lo, hi + 1) for i in range(len(text) - n + 1)]
+        return np.fromiter((zlib.crc32(g.encode("utf-8"), self.seed) for g in grams),
+                           dtype=np.uint32, count=len(grams))
+
+    def _vector(self, text: str) -> np.ndarray:
+        hashes = self._hashes(text)
+        signs = np.where(hashes & (1 << 31), -1.0, 1.0).astype(np.float32)
+        vector = np.bincount(hashes % self.size, weights=signs, minlength=self.size).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t).tolist() for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text).tolist()
+
+
+def create_embeddings(backend: str = None, cache: bool = True, **openai_kwargs) -> Embeddings:
+    """backend（省略時は環境変数 EMBEDDING_BACKEND、既定は openai）の埋め込みを返す
+
+    openai_kwargs は OpenAIEmbeddings にそのまま渡す（model など）。
+    """
+    backend = backend or os.getenv("EMBEDDING_BACKEND", "openai")
+    if backend == "local":
+        return HashingEmbeddings(size=int(os.getenv("LOCAL_EMBEDDING_SIZE", "256")))
+    if backend == "openai":
+        from langchain_openai import OpenAIEmbeddings
+
+        embeddings = OpenAIEmbeddings(**openai_kwargs)
+        return CachedEmbeddings(embeddings) if cache else embeddings
+    raise ValueError(f"unknown embedding backend: {backend!r} (choose from {', '.join(EMBEDDING_BACKENDS)})")
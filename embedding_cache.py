@@ -0,0 +1,215 @@
+# 埋め込みベクトルのディスクキャッシュ
+# (モデル名, 本文の sha256) をキーに float32 のベクトルを SQLite に保存し、
+# 本文が変わらない限り再起動後も埋め込み API を呼ばない
+
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_CACHE_PATH = ".embedding_cache.sqlite3"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def model_name(embeddings: Embeddings) -> str:
+    return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+
+class CachedEmbeddings(Embeddings):
+    """任意の Embeddings をラップし、結果を SQLite にキャッシュする
+
+    max_entries を超えると最終利用時刻の古いものから削除する（LRU）。
+    """
+
+    _SELECT_CHUNK = 500
+
+    def __init__(self, underlying: Embeddings, path: str = DEFAULT_CACHE_PATH, max_entries: int = 1_000_000):
+        self.underlying = underlying
+        self.model = model_name(underlying)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _lookup(self, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        for i in range(0, len(unique), self._SELECT_CHUNK):
+            chunk = unique[i:i + self._SELECT_CHUNK]
+            rows = self._conn.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                [self.model, *chunk],
+            ).fetchall()
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        if found:
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(now, self.model, h) for h in found],
+            )
+        return found
+
+    def _store(self, items: Dict[str, List[float]]):
+        now = time.time()
+        before = self._conn.total_changes
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+            [(self.model, h, np.asarray(v, dtype=np.float32).tobytes(), now) for h, v in items.items()],
+        )
+        self._size += self._conn.total_changes - before
+        if self._size > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN"
+                " (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (self._size - self.max_entries,),
+            )
+            self._size = self.max_entries
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(t) for t in texts]
+        with self._lock:
+            found = self._lookup(hashes)
+            self._conn.commit()
+        missing = {h: t for h, t in zip(hashes, texts) if h not in found}
+        n_missing = sum(h in missing for h in hashes)
+        self.hits += len(hashes) - n_missing
+        self.misses += n_missing
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            with self._lock:
+                self._store(computed)
+                self._conn.commit()
+            found.update(computed)
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        h = text_hash(text)
+        with self._lock:
+            found = self._lookup([h])
+            self._conn.commit()
+        if h in found:
+            self.hits += 1
+            return found[h]
+        self.misses += 1
+        vector = self.underlying.embed_query(text)
+        with self._lock:
+            self._store({h: vector})
+            self._conn.commit()
+        return vector
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "model": self.model,
+            "entries": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        self._conn.close()
+
+
+def normalize_query(text: str) -> str:
+    """全角・半角や空白の違いだけのクエリを同じキーにする"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class QueryEmbeddingCache:
+    """検索クエリの埋め込みをプロセス内で保持する LRU キャッシュ（TTL 付き）
+
+    同じクエリの埋め込みが同時に要求された場合は、最初の1件だけが埋め込みを計算し、
+    残りはその結果を待つ（リクエストの合流）。
+    正規化したクエリはキャッシュのキーにだけ使い、埋め込むのは受け取ったクエリそのもの。
+    """
+
+    def __init__(self, embeddings: Embeddings, max_entries: int = 1024, ttl: float = 600.0):
+        self.embeddings = embeddings
+        self.model = model_name(embeddings)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._miss_seconds = 0.0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (保存時刻, ベクトル)
+        self._inflight: Dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model, normalize_query(text))
+        owner = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+                owner = True
+        if not owner:
+            return future.result()
+
+        start = time.perf_counter()
+        try:
+            vector = self.embeddings.embed_query(text)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._miss_seconds += time.perf_counter() - start
+            self._entries[key] = (time.monotonic(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            del self._inflight[key]
+        future.set_result(vector)
+        return vector
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses + self.coalesced
+        avg_miss = self._miss_seconds / self.misses if self.misses else 0.0
+        return {
+            "model": self.model,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": (self.hits + self.coalesced) / total if total else 0.0,
+            # キャッシュヒット・合流で省略できた埋め込み時間の推定（平均ミス時間 × 件数）
+            "saved_seconds": avg_miss * (self.hits + self.coalesced),
+        }
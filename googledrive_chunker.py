@@ -0,0 +1,95 @@
+# Google Docs の本文を見出し・段落単位でチャンクに分割する
+# body.content の構造をそのままたどり、トークン数の上限とオーバーラップを守って
+# チャンクを順に yield する（文書全体の文字列は組み立てない）
+
+from typing import Dict, Iterator, List, Tuple
+
+import tiktoken
+
+HEADING_STYLES = {"TITLE", "HEADING_1", "HEADING_2", "HEADING_3", "HEADING_4", "HEADING_5", "HEADING_6"}
+
+
+def iter_paragraphs(content: List[Dict]) -> Iterator[Tuple[bool, str]]:
+    """(見出しかどうか, 段落テキスト) を文書の順に返す。表の中の段落もたどる"""
+    for element in content:
+        paragraph = element.get("paragraph")
+        if paragraph:
+            text = "".join(
+                el["textRun"].get("content", "") for el in paragraph.get("elements", []) if "textRun" in el
+            )
+            style = paragraph.get("paragraphStyle", {}).get("namedStyleType", "")
+            yield style in HEADING_STYLES, text
+        table = element.get("table")
+        if table:
+            for row in table.get("tableRows", []):
+                for cell in row.get("tableCells", []):
+                    yield from iter_paragraphs(cell.get("content", []))
+
+
+class DocsChunker:
+    """トークン数ベースのチャンク分割
+
+    見出しが現れたらチャンクを区切り、max_tokens を超える場合は段落の境界で区切る。
+    直前のチャンク末尾 overlap_tokens トークンを次のチャンクの先頭に重ねる。
+    """
+
+    def __init__(self, max_tokens: int = 500, overlap_tokens: int = 50, encoding_name: str = "cl100k_base"):
+        if overlap_tokens >= max_tokens:
+            raise ValueError("overlap_tokens は max_tokens より小さくしてください")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.encoding_name = encoding_name
+        self._encoding = None
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
+
+    def _decode(self, tokens: List[int]) -> str:
+        # トークン境界で分割すると多バイト文字が途中で切れることがあるため、壊れたバイトは捨てる
+        return self.encoding.decode_bytes(tokens).decode("utf-8", errors="ignore")
+
+    def chunk(self, document: Dict) -> Iterator[Dict]:
+        """{"text", "section", "chunk_index"} を順に yield する"""
+        section = ""
+        tokens: List[int] = []
+        has_new = False  # 直前のチャンクから重ねた分以外のトークンがあるか
+        has_body = False  # 見出しと重ねた分以外（本文の段落）のトークンがあるか
+        index = 0
+
+        def flush(keep_overlap):
+            nonlocal tokens, has_new, has_body, index
+            chunk = {"text": self._decode(tokens).strip(), "section": section, "chunk_index": index}
+            tokens = tokens[-self.overlap_tokens:] if keep_overlap and self.overlap_tokens else []
+            has_new = has_body = False
+            index += 1
+            return chunk
+
+        for is_heading, text in iter_paragraphs(document.get("body", {}).get("content", [])):
+            if not text.strip():
+                continue
+            if is_heading:
+                # 見出しの前でチャンクを区切る（セクションをまたいだオーバーラップはしない）
+                if has_new:
+                    yield flush(keep_overlap=False)
+                tokens = []
+                section = text.strip()
+            paragraph = self.encoding.encode(text)
+            # 見出しや重ねた分だけのチャンクは作らず、次の段落と一緒にする（長ければ下で max_tokens ごとに切る）
+            if has_body and len(tokens) + len(paragraph) > self.max_tokens:
+                yield flush(keep_overlap=True)
+            tokens.extend(paragraph)
+            has_new = True
+            has_body = has_body or not is_heading
+            # 1段落だけで上限を超える場合は max_tokens ごとに切る
+            while len(tokens) > self.max_tokens:
+                rest = tokens[self.max_tokens:]
+                tokens = tokens[:self.max_tokens]
+                yield flush(keep_overlap=True)
+                tokens.extend(rest)
+                # 残りが改行などだけなら、重ねた分だけのチャンクにならないよう新しい内容とみなさない
+                has_new = has_body = bool(self._decode(rest).strip())
+        if has_new:
+            yield flush(keep_overlap=False)
@@ -7,12 +7,23 @@ load_dotenv()
 
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 # ==== LangChain + Chroma 関連 ====
 
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
+from embedding_cache import CachedEmbeddings
+from googledrive_chunker import DocsChunker, iter_paragraphs
+from instrumentation import Metrics
+from permission_index import rebuild_permission_index
+from shared_collection import COLLECTION_NAME, EMBEDDING_MODEL, PERSIST_DIRECTORY, check_embedding_model
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from itertools import islice
 
 
 # ======= Google Drive 関数 =======
@@ -35,104 +46,339 @@ def get_docs_service(creds):
 
 def get_document_text(file_id, docs_service):
     document = docs_service.documents().get(documentId=file_id).execute()
+    return document_text(document)
+
+def document_text(document):
     content = document.get('body', {}).get('content', [])
-    text = ''
-    for element in content:
-        paragraph = element.get('paragraph')
-        if not paragraph:
-            continue
-        for el in paragraph.get('elements', []):
-            text_run = el.get('textRun')
-            if text_run:
-                text += text_run.get('content', '')
-    return text
+    return ''.join(text for _, text in iter_paragraphs(content))
 
-def list_files_and_permissions(folder_id):
-    creds = get_credentials()
-    drive_service = get_drive_service(creds)
-    docs_service = get_docs_service(creds)
-    query = f"'{folder_id}' in parents and trashed = false"
-    results = drive_service.files().list(q=query, fields="files(id, name, mimeType)").execute()
-    files = results.get('files', [])
-
-    data = []
-    for file in files:
-        permissions = drive_service.permissions().list(
-            fileId=file['id'],
-            fields="permissions(id,emailAddress,role,type)"
-        ).execute()
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DOCUMENT_MIME_TYPE = 'application/vnd.google-apps.document'
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def is_retryable(error):
+    status = getattr(error.resp, "status", None)
+    if status in RETRYABLE_STATUS:
+        return True
+    # Drive はレート制限を 403 rateLimitExceeded / userRateLimitExceeded で返すこともある
+    content = error.content or b""
+    return status == 403 and (b"rateLimitExceeded" in content or b"userRateLimitExceeded" in content)
+
+def execute_with_retry(request, max_retries=5, base_delay=1.0):
+    """429 やレート制限のエラーは指数バックオフ（ジッタ付き）で再試行する"""
+    for attempt in range(max_retries + 1):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            time.sleep(base_delay * 2 ** attempt + random.uniform(0, base_delay))
+
+class DriveCrawler:
+    """フォルダを再帰的にたどり、権限と本文を並列に取得する
+
+    googleapiclient のサービスはスレッドセーフではないため、スレッドごとに
+    drive_factory / docs_factory からサービスを生成する。テストではローカルの
+    フェイクを返すファクトリを渡せばよい。
+    """
+
+    def __init__(self, drive_factory, docs_factory, max_workers=8, max_retries=5, chunker=None):
+        self.drive_factory = drive_factory
+        self.docs_factory = docs_factory
+        self.chunker = chunker or DocsChunker()
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.visited_folders = set()
+        # サブフォルダ -> 親フォルダ（フォルダが移動したときに配下のフォルダをたどるため）
+        self.folder_parents = {}
+        self._local = threading.local()
+
+    def _drive(self):
+        if not hasattr(self._local, "drive"):
+            self._local.drive = self.drive_factory()
+        return self._local.drive
+
+    def _docs(self):
+        if not hasattr(self._local, "docs"):
+            self._local.docs = self.docs_factory()
+        return self._local.docs
+
+    def _execute(self, request):
+        return execute_with_retry(request, max_retries=self.max_retries)
+
+    def list_children(self, folder_id):
+        """フォルダ直下のファイルを nextPageToken をたどってすべて返す"""
+        page_token = None
+        while True:
+            response = self._execute(self._drive().files().list(
+                q=f"'{folder_id}' in parents and trashed = false",
+                fields="nextPageToken, files(id, name, mimeType, modifiedTime)",
+                pageSize=1000,
+                pageToken=page_token,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+            ))
+            yield from response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+    def list_permissions(self, file_id):
+        permissions = []
+        page_token = None
+        while True:
+            response = self._execute(self._drive().permissions().list(
+                fileId=file_id,
+                fields="nextPageToken, permissions(id,emailAddress,domain,role,type)",
+                pageToken=page_token,
+                supportsAllDrives=True,
+            ))
+            permissions.extend(response.get('permissions', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        return permissions
+
+    def list_permissions_batch(self, file_ids, batch_size=100):
+        """permissions.list を batch HTTP リクエスト（最大100件/回）でまとめて送る
+
+        file_id -> 権限の一覧を返す。取得できなかったファイルは HttpError が入る。
+        2ページ目以降があるものや一時的なエラーになったものは list_permissions で個別に取り直す。
+        """
+        drive = self._drive()
+        results = {}
+        retry = set()
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                if isinstance(exception, HttpError) and not is_retryable(exception):
+                    results[request_id] = exception
+                else:
+                    retry.add(request_id)
+            elif response.get('nextPageToken'):
+                retry.add(request_id)
+            else:
+                results[request_id] = response.get('permissions', [])
+
+        file_ids = list(file_ids)
+        for i in range(0, len(file_ids), batch_size):
+            batch = drive.new_batch_http_request(callback=callback)
+            for file_id in file_ids[i:i + batch_size]:
+                batch.add(drive.permissions().list(
+                    fileId=file_id,
+                    fields="nextPageToken, permissions(id,emailAddress,domain,role,type)",
+                    supportsAllDrives=True,
+                ), request_id=file_id)
+            self._execute(batch)
+
+        for file_id in retry:
+            try:
+                results[file_id] = self.list_permissions(file_id)
+            except HttpError as e:
+                results[file_id] = e
+        return results
+
+    def fetch_file(self, file):
         file_info = {
             "id": file['id'],
             "name": file['name'],
             "mimeType": file['mimeType'],
-            "permissions": permissions.get('permissions', [])
+            "modifiedTime": file.get('modifiedTime'),
+            "parents": file.get('parents', []),
+            "permissions": self.list_permissions(file['id'])
         }
-        if file['mimeType'] == 'application/vnd.google-apps.document':
+        if file['mimeType'] == DOCUMENT_MIME_TYPE:
+            # 本文の取得・チャンク分割に失敗したファイルは error を付けて返し、embed_to_chroma で保存しない
+            # （保存済みのチャンクと modified_time を残し、次回の同期で取り直す）
             try:
-                content = get_document_text(file['id'], docs_service)
-                file_info["content"] = content
+                document = self._execute(self._docs().documents().get(documentId=file['id']))
+                file_info["chunks"] = list(self.chunker.chunk(document))
             except Exception as e:
-                file_info["content"] = "(本文の取得に失敗しました)"
-        data.append(file_info)
+                file_info["error"] = f"{type(e).__name__}: {e}"
+        return file_info
+
+    def get_start_page_token(self):
+        response = self._execute(self._drive().changes().getStartPageToken(supportsAllDrives=True))
+        return response['startPageToken']
+
+    def list_changes(self, page_token):
+        """page_token 以降の変更をすべて取得し、(changes, 次回の startPageToken) を返す"""
+        changes = []
+        while True:
+            response = self._execute(self._drive().changes().list(
+                pageToken=page_token,
+                fields="nextPageToken, newStartPageToken,"
+                       " changes(fileId, removed, file(id, name, mimeType, modifiedTime, trashed, parents))",
+                pageSize=1000,
+                includeRemoved=True,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+            ))
+            changes.extend(response.get('changes', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return changes, response['newStartPageToken']
+
+    def crawl(self, folder_id):
+        """取得できたファイルから順に file_info を yield する"""
+        max_pending = self.max_workers * 4
+        folders = [folder_id]
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while folders:
+                current = folders.pop()
+                self.visited_folders.add(current)
+                for file in self.list_children(current):
+                    if file['mimeType'] == FOLDER_MIME_TYPE:
+                        self.folder_parents[file['id']] = current
+                        folders.append(file['id'])
+                        continue
+                    pending.add(executor.submit(self.fetch_file, {**file, "parents": [current]}))
+                    # 未処理のタスクが溜まりすぎないよう、完了した分を先に流す
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+            for future in as_completed(pending):
+                yield future.result()
+
+def create_crawler(max_workers=8):
+    creds = get_credentials()
+    return DriveCrawler(
+        lambda: get_drive_service(creds),
+        lambda: get_docs_service(creds),
+        max_workers=max_workers,
+    )
 
-    return data
+def list_files_and_permissions(folder_id):
+    return list(create_crawler().crawl(folder_id))
 
 # ======= Embedding 関数 =======
+def permissions_json(permissions):
+    """メタデータに保存する形式。比較できるよう順序を固定する"""
+    permissions_structured = []
+    for perm in permissions:
+        structured = {
+            "type": perm.get("type"),
+            "email": perm.get("emailAddress", "N/A"),
+            "role": perm.get("role")
+        }
+        if perm.get("domain"):
+            structured["domain"] = perm["domain"]
+        permissions_structured.append(structured)
+    permissions_structured.sort(key=lambda p: (p["type"] or "", p["email"], p["role"] or ""))
+    return json.dumps(permissions_structured, ensure_ascii=False)
+
 def format_for_embedding(file_data):
     documents = []
     metadatas = []
 
     for file in file_data:
-        # Google Docs の本文がある場合はそれを使用
-        content_body = file.get("content", "")
-        content = f"File: {file['name']}\nType: {file['mimeType']}\nContent:\n{content_body}"
-
-        permissions_structured = []
-        for perm in file['permissions']:
-            permissions_structured.append({
-                "type": perm.get("type"),
-                "email": perm.get("emailAddress", "N/A"),
-                "role": perm.get("role")
-            })
-
-        metadata = {
-            "source": "google_drive",
-            "file_id": file["id"],
-            "file_name": file["name"],
-            "mime_type": file["mimeType"],
-            "permissions": json.dumps(permissions_structured, ensure_ascii=False)
-        }
+        # Google Docs はチャンクごとに1件、それ以外はファイル名などだけで1件にする
+        chunks = file.get("chunks") or [{"text": file.get("content", ""), "section": "", "chunk_index": 0}]
+        # 権限はファイル単位なので、すべてのチャンクに同じ ACL と親の file_id を持たせる
+        permissions = permissions_json(file['permissions'])
+        for chunk in chunks:
+            header = f"File: {file['name']}\nType: {file['mimeType']}\n"
+            if chunk["section"]:
+                header += f"Section: {chunk['section']}\n"
+            content = f"{header}Content:\n{chunk['text']}"
+
+            metadata = {
+                "source": "google_drive",
+                "file_id": file["id"],
+                "file_name": file["name"],
+                "mime_type": file["mimeType"],
+                "modified_time": file.get("modifiedTime") or "",
+                # フォルダが対象外に移動したとき、配下のファイルをまとめて削除するため
+                "folder_id": (file.get("parents") or [""])[0],
+                "chunk_index": chunk["chunk_index"],
+                "chunk_count": len(chunks),
+                "section": chunk["section"],
+                "permissions": permissions
+            }
 
-        documents.append(content)
-        metadatas.append(metadata)
+            documents.append(content)
+            metadatas.append(metadata)
 
     return documents, metadatas
 
-def embed_to_chroma(documents, metadatas, persist_directory=".chroma"):
-    embedding_model = OpenAIEmbeddings(model="text-embedding-3-small")
+def retry_entry(file):
+    """本文を取得できなかったファイルを次回の同期で取り直すための情報（googledrive_sync の retry_files）"""
+    return {key: file.get(key) for key in ("id", "name", "mimeType", "modifiedTime", "parents")}
+
+def chunk_id(metadata):
+    return f"{metadata['file_id']}:{metadata['chunk_index']}"
 
-    vectorstore = Chroma.from_texts(
-        collection_name="default",
-        texts=documents,
-        embedding=embedding_model,
-        metadatas=metadatas,
+def open_vectorstore(persist_directory=PERSIST_DIRECTORY):
+    embedding_model = CachedEmbeddings(OpenAIEmbeddings(model=EMBEDDING_MODEL))
+    vectorstore = Chroma(
+        collection_name=COLLECTION_NAME,
+        embedding_function=embedding_model,
         persist_directory=persist_directory
     )
-    vectorstore.persist()
+    check_embedding_model(vectorstore._collection, embedding_model, record=True)
+    return vectorstore
+
+def embed_to_chroma(file_stream, persist_directory=".chroma", batch_size=100, vectorstore=None, metrics=None,
+                    failed=None):
+    """クローラから届いたファイルを batch_size 件ずつ埋め込んで保存する
+
+    チャンクの ID は "file_id:チャンク番号"。ファイルの古いチャンクは先に削除するので、
+    同じファイルを再度取り込んでも重複せず、短くなった文書のチャンクも残らない。
+    本文を取得できなかったファイル（error 付き）は保存済みのチャンクに触れずに飛ばし、
+    failed（リスト）が渡されていれば、再取得用にファイルの情報を追加する。
+    届いたファイル（飛ばしたものを含む）の file_id の集合を返す。
+    """
+    if vectorstore is None:
+        vectorstore = open_vectorstore(persist_directory)
+    metrics = metrics or Metrics.from_env()
+
+    file_ids = set()
+    saved = total_chunks = 0
+    file_stream = iter(file_stream)
+    while True:
+        # クローラから届くのを待っている時間（取得ステージ）
+        with metrics.timer("ingest_stage_seconds", source="google_drive", stage="fetch"):
+            batch = list(islice(file_stream, batch_size))
+        if not batch:
+            break
+        metrics.inc("ingest_records_total", len(batch), source="google_drive", stage="fetch")
+        file_ids.update(file["id"] for file in batch)
+        skipped = [file for file in batch if "error" in file]
+        for file in skipped:
+            print(f"  [!] {file['name']} ({file['id']}) の本文を取得できなかったため、保存済みの内容を残します: {file['error']}")
+            if failed is not None:
+                failed.append(retry_entry(file))
+        batch = [file for file in batch if "error" not in file]
+        if not batch:
+            continue
+        documents, metadatas = format_for_embedding(batch)
+        batch_file_ids = [file["id"] for file in batch]
+        with metrics.timer("ingest_stage_seconds", source="google_drive", stage="embed_write"):
+            vectorstore._collection.delete(where={"file_id": {"$in": batch_file_ids}})
+            ids = [chunk_id(m) for m in metadatas]
+            vectorstore.add_texts(texts=documents, metadatas=metadatas, ids=ids)
+        metrics.inc("ingest_records_total", len(documents), source="google_drive", stage="embed_write")
+        saved += len(batch_file_ids)
+        total_chunks += len(documents)
+        print(f"  {saved}ファイル（{total_chunks}チャンク）を保存しました")
     print(f"Embedding completed and stored to Chroma DB at '{persist_directory}'")
+    embedding_function = getattr(vectorstore, "embeddings", None)
+    if hasattr(embedding_function, "stats"):
+        print(f"Embedding cache: {embedding_function.stats()}")
+    metrics.save()
+    return file_ids
 
 # ======= メイン処理 =======
 
 def main():
     folder_id = input("Google Drive Folder ID を入力してください: ").strip()
-    print("Google Driveからファイルとパーミッションを取得中...")
-    file_data = list_files_and_permissions(folder_id)
-
-    print("Embedding データを整形中...")
-    documents, metadatas = format_for_embedding(file_data)
-
-    print("Chroma に保存中...")
-    embed_to_chroma(documents, metadatas)
+    print("Google Driveからファイルとパーミッションを取得し、Chroma に保存中...")
+    crawler = create_crawler()
+    vectorstore = open_vectorstore()
+    embed_to_chroma(crawler.crawl(folder_id), vectorstore=vectorstore)
+    rebuild_permission_index(vectorstore._collection)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
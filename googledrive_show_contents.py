@@ -2,12 +2,13 @@ import os
 import json
 from dotenv import load_dotenv
 
-from langchain_community.embeddings import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
+import chromadb
 
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
+from show_chromadb import iter_records
+
 # ==== 環境変数ロード ====
 load_dotenv()
 
@@ -48,26 +49,16 @@ def format_permissions(permissions, title="Permissions"):
 
 # ==== Chroma からデータを取得して表示 ====
 def display_chroma_documents(persist_directory=".chroma"):
-    # Chroma 初期化
-    embedding_model = OpenAIEmbeddings(model="text-embedding-3-small")
-    vectorstore = Chroma(
-        collection_name="default",
-        embedding_function=embedding_model,
-        persist_directory=persist_directory
-    )
-
-    # Chroma からデータ取得
-    results = vectorstore.get(include=["documents", "metadatas"])
-    documents = results["documents"]
-    metadatas = results["metadatas"]
-
-    print(f"Total documents: {len(documents)}\n")
+    # 埋め込みは使わないので chromadb で直接開き、Drive のレコードだけをページングで読む
+    collection = chromadb.PersistentClient(path=persist_directory).get_or_create_collection("default")
+    print(f"Total documents: {collection.count()}\n")
 
     # Google Drive 認証（初回のみブラウザ起動）
     print("Authenticating with Google Drive...")
     drive_service = get_drive_service()
 
-    for i, (doc, meta) in enumerate(zip(documents, metadatas)):
+    for i, record in enumerate(iter_records(collection, source="google_drive")):
+        doc, meta = record["document"], record["metadata"]
         file_id = meta.get("file_id")
         print(f"\n--- Document {i + 1} ---")
         print(f"File Name: {meta.get('file_name')}")
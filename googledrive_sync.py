@@ -0,0 +1,240 @@
+# Google Drive の変更フィード（Changes API）を使った差分再インデックス
+#
+#   uv run googledrive_sync.py          # 初回はフォルダ全体を取り込み、以降は差分のみ
+#   uv run googledrive_sync.py --full   # フォルダ全体を取り込み直す
+
+import argparse
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from googledrive_embedding_documents import (
+    FOLDER_MIME_TYPE,
+    create_crawler,
+    embed_to_chroma,
+    open_vectorstore,
+    permissions_json,
+)
+from permission_index import iter_metadatas, rebuild_permission_index, refresh_permission_index
+
+# startPageToken と対象フォルダ（folder_ids と、サブフォルダ -> 親フォルダの folder_parents）を保存するファイル
+SYNC_STATE_PATH = ".drive_sync_state.json"
+
+_GET_CHUNK = 500
+
+
+def load_sync_state(path=SYNC_STATE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_sync_state(state, path=SYNC_STATE_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def stored_metadata(collection, file_ids):
+    """file_id -> [(Chroma の ID, メタデータ), ...]"""
+    stored = {}
+    file_ids = list(file_ids)
+    for i in range(0, len(file_ids), _GET_CHUNK):
+        result = collection.get(
+            where={"file_id": {"$in": file_ids[i:i + _GET_CHUNK]}},
+            include=["metadatas"],
+        )
+        for id_, meta in zip(result["ids"], result["metadatas"]):
+            stored.setdefault(meta["file_id"], []).append((id_, meta))
+    return stored
+
+
+def files_in_folders(collection, folder_ids):
+    """folder_ids 直下のファイルとして保存されている file_id の集合"""
+    folder_ids = list(folder_ids)
+    file_ids = set()
+    for i in range(0, len(folder_ids), _GET_CHUNK):
+        where = {"folder_id": {"$in": folder_ids[i:i + _GET_CHUNK]}}
+        file_ids.update(meta["file_id"] for meta in iter_metadatas(collection, where))
+    return file_ids
+
+
+def reachable_folders(root, folder_parents):
+    """root から folder_parents をたどって届くフォルダ（root を含む）"""
+    children = defaultdict(list)
+    for folder, parent in folder_parents.items():
+        children[parent].append(folder)
+    reached, stack = {root}, [root]
+    while stack:
+        for child in children[stack.pop()]:
+            if child not in reached:
+                reached.add(child)
+                stack.append(child)
+    return reached
+
+
+def delete_files(collection, file_ids):
+    file_ids = list(file_ids)
+    for i in range(0, len(file_ids), _GET_CHUNK):
+        collection.delete(where={"file_id": {"$in": file_ids[i:i + _GET_CHUNK]}})
+
+
+def full_sync(crawler, vectorstore, folder_id):
+    """フォルダ全体を取り込み、Drive から消えたファイルを削除する"""
+    # クロール中の変更も次回の差分で拾えるよう、先にトークンを取得しておく
+    start_page_token = crawler.get_start_page_token()
+    failed = []
+    file_ids = embed_to_chroma(crawler.crawl(folder_id), vectorstore=vectorstore, failed=failed)
+
+    collection = vectorstore._collection
+    stale = {meta["file_id"] for meta in iter_metadatas(collection, {"source": "google_drive"})} - file_ids
+    delete_files(collection, stale)
+    print(f"{len(stale)}件の削除済みファイルを Chroma から削除しました")
+    rebuild_permission_index(collection)
+
+    return {
+        "folder_id": folder_id,
+        "folder_ids": sorted(crawler.visited_folders),
+        "folder_parents": crawler.folder_parents,
+        "start_page_token": start_page_token,
+        "retry_files": failed,
+    }
+
+
+def incremental_sync(crawler, vectorstore, state):
+    """前回の startPageToken 以降に変更されたファイルだけを反映する
+
+    - 削除・ゴミ箱・対象フォルダ外への移動: Chroma から削除
+    - modifiedTime が変わったファイル: 本文と権限を取り直して再埋め込み
+    - modifiedTime が同じファイル: 権限だけ取り直し、変わっていればメタデータのみ更新
+    - 前回本文を取得できなかったファイル（state の retry_files）: 変更が無くても取り直す
+    - 対象フォルダ内に移動・作成されたフォルダ: 配下をクロールして取り込む
+    - 対象外に移動・削除されたフォルダ: 配下のフォルダも含めて対象から外し、そのファイルを削除する
+    """
+    changes, new_start_page_token = crawler.list_changes(state["start_page_token"])
+    latest = {}
+    for change in changes:
+        latest[change["fileId"]] = change  # 同じファイルの変更は最後のものだけ見ればよい
+
+    # フォルダの木を更新し、ルートから届くフォルダを対象にする
+    root = state["folder_id"]
+    old_folders = set(state["folder_ids"])
+    folder_parents = dict(state["folder_parents"])
+    for file_id, change in latest.items():
+        file = change.get("file") or {}
+        if file.get("mimeType") != FOLDER_MIME_TYPE and not (change.get("removed") and file_id in old_folders):
+            continue
+        if file_id == root:
+            continue
+        parents = [] if change.get("removed") or file.get("trashed") else file.get("parents", [])
+        if parents:
+            folder_parents[file_id] = parents[0]
+        else:
+            folder_parents.pop(file_id, None)
+    folder_ids = reachable_folders(root, folder_parents)
+    # 対象に入ったフォルダは配下が分からないので、一番上のフォルダからクロールする
+    entered = [f for f in folder_ids - old_folders if folder_parents.get(f) not in folder_ids - old_folders]
+    left = old_folders - folder_ids
+    for folder_id in left:
+        folder_parents.pop(folder_id, None)
+
+    collection = vectorstore._collection
+    entered_files = set()
+    crawled = []
+    for folder_id in entered:
+        for file in crawler.crawl(folder_id):
+            entered_files.add(file["id"])
+            crawled.append(file)
+    folder_parents.update(crawler.folder_parents)
+    folder_ids = reachable_folders(root, folder_parents)
+
+    candidates = [fid for fid, c in latest.items()
+                  if (c.get("file") or {}).get("mimeType") != FOLDER_MIME_TYPE and fid not in entered_files]
+    stored = stored_metadata(collection, candidates)
+
+    to_delete, to_reembed, to_recheck = [], [], []
+    for file_id in candidates:
+        change = latest[file_id]
+        file = change.get("file") or {}
+        in_scope = (not change.get("removed") and not file.get("trashed")
+                    and bool(folder_ids & set(file.get("parents", []))))
+        if not in_scope:
+            if file_id in stored:
+                to_delete.append(file_id)
+        elif file_id in stored and stored[file_id][0][1].get("modified_time") == file.get("modifiedTime"):
+            to_recheck.append(file_id)
+        else:
+            to_reembed.append(file)
+    to_reembed.extend(file for file in state.get("retry_files", [])
+                      if file["id"] not in latest and file["id"] not in entered_files)
+    # 対象外になったフォルダのファイルは、ファイル自体に変更が無くても削除する
+    to_delete.extend(files_in_folders(collection, left) - set(to_delete) - entered_files)
+
+    delete_files(collection, to_delete)
+
+    failed = []
+    touched = set(to_delete) | {file["id"] for file in to_reembed} | entered_files
+    with ThreadPoolExecutor(max_workers=crawler.max_workers) as executor:
+        latest_permissions = dict(zip(to_recheck, executor.map(crawler.list_permissions, to_recheck)))
+        embed_to_chroma(chain(crawled, executor.map(crawler.fetch_file, to_reembed)), vectorstore=vectorstore,
+                        failed=failed)
+
+    acl_updated = 0
+    for file_id, permissions in latest_permissions.items():
+        # 本文が変わらずにフォルダ間を移動したファイルは、folder_id も書き直す
+        update = {"permissions": permissions_json(permissions),
+                  "folder_id": (latest[file_id]["file"].get("parents") or [""])[0]}
+        records = [(id_, meta) for id_, meta in stored[file_id]
+                   if any(meta.get(key) != value for key, value in update.items())]
+        if not records:
+            continue
+        collection.update(
+            ids=[id_ for id_, _ in records],
+            metadatas=[{**meta, **update} for _, meta in records],
+        )
+        acl_updated += 1
+        touched.add(file_id)
+
+    print(f"変更 {len(latest)}件: 削除 {len(to_delete)}件 / 再埋め込み {len(to_reembed)}件"
+          f" / メタデータのみ更新 {acl_updated}件 / 対象に入ったフォルダのファイル {len(entered_files)}件"
+          f" / 対象外になったフォルダ {len(left)}件")
+    # 変更のあったファイルの ACL だけを読み直す
+    refresh_permission_index(collection, (f"drive:{file_id}" for file_id in touched))
+
+    return {
+        **state,
+        "folder_ids": sorted(folder_ids),
+        "folder_parents": folder_parents,
+        "start_page_token": new_start_page_token,
+        "retry_files": failed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Google Drive の差分再インデックス")
+    parser.add_argument("--full", action="store_true", help="フォルダ全体を取り込み直す")
+    args = parser.parse_args()
+
+    state = load_sync_state()
+    crawler = create_crawler()
+    vectorstore = open_vectorstore()
+    if state is not None and "folder_parents" not in state and not args.full:
+        # フォルダの木（と Drive のレコードの folder_id）が無い古い同期状態では、フォルダの移動を追えない
+        print("同期状態にフォルダの構成が無いため、フォルダ全体を取り込み直します")
+        args.full = True
+    if args.full or state is None:
+        folder_id = state["folder_id"] if state else input("Google Drive Folder ID を入力してください: ").strip()
+        print("Google Driveからファイルとパーミッションを取得し、Chroma に保存中...")
+        state = full_sync(crawler, vectorstore, folder_id)
+    else:
+        print("Google Drive の変更を取得中...")
+        state = incremental_sync(crawler, vectorstore, state)
+    save_sync_state(state)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+# 取得 → 埋め込み → 書き込みを並行に流す非同期の取り込みパイプライン
+#
+#   [Slack / Drive の取得] --queue--> [バッチ埋め込み x N] --queue--> [Chroma 書き込み x 1]
+#
+# キューには上限があるため、下流が詰まると上流の取得も待たされる（バックプレッシャ）。
+# 各ステージの処理件数・スループットとキューの深さを定期的に表示する。
+#
+#   uv run ingest_pipeline.py slack
+#   uv run ingest_pipeline.py drive <フォルダID>
+
+import argparse
+import asyncio
+import concurrent.futures
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+import chromadb
+
+from instrumentation import NULL_METRICS, Metrics
+from permission_index import refresh_permission_index, resource_key
+from shared_collection import COLLECTION_NAME, EMBEDDING_MODEL, PERSIST_DIRECTORY, check_embedding_model
+
+_DONE = object()
+
+
+@dataclass
+class IngestItem:
+    """取得ステージから流れてくる1単位（Slack は1チャンネル分、Drive は1ファイル分）"""
+    ids: List[str]
+    texts: List[str]
+    metadatas: List[Dict]
+    # 書き込み前に削除する where 句（Drive の古いチャンクなど）
+    replace_where: Optional[Dict] = None
+    # 書き込み完了後に呼ぶ処理（同期状態の保存など）
+    on_written: Optional[Callable[[], None]] = None
+
+
+@dataclass
+class EmbeddedBatch:
+    items: List[IngestItem]
+    embeddings: List[List[float]]
+
+
+@dataclass
+class StageStats:
+    name: str
+    records: int = 0
+    busy_seconds: float = 0.0
+    started: float = field(default_factory=time.perf_counter)
+
+    def add(self, records, seconds):
+        self.records += records
+        self.busy_seconds += seconds
+
+    def throughput(self):
+        elapsed = time.perf_counter() - self.started
+        return self.records / elapsed if elapsed else 0.0
+
+
+class RateLimiter:
+    """1秒あたりの呼び出し回数を制限するトークンバケット"""
+
+    def __init__(self, rate: Optional[float], burst: int = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class IngestPipeline:
+    def __init__(self, embeddings, collection, batch_size: int = 100, embed_concurrency: int = 4,
+                 embed_rate: Optional[float] = None, queue_size: int = 64, report_interval: float = 5.0,
+                 metrics: Metrics = NULL_METRICS):
+        self.embeddings = embeddings
+        self.collection = collection
+        self.batch_size = batch_size
+        self.embed_concurrency = embed_concurrency
+        self.embed_rate = embed_rate
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.metrics = metrics
+        self.stats: Dict[str, StageStats] = {}
+
+    def _record(self, stage: str, records: int, seconds: float):
+        self.stats[stage].add(records, seconds)
+        self.metrics.observe("ingest_stage_seconds", seconds, source="pipeline", stage=stage)
+        self.metrics.inc("ingest_records_total", records, source="pipeline", stage=stage)
+
+    async def _fetch(self, source: Iterable[IngestItem], out: asyncio.Queue):
+        """同期のジェネレータを別スレッドで回し、取得した順にキューへ入れる"""
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+
+        def run():
+            start = time.perf_counter()
+            for item in source:
+                self._record("fetch", len(item.ids), time.perf_counter() - start)
+                # キューが満杯なら空くまで待つ。パイプラインが中断されたらやめる
+                future = asyncio.run_coroutine_threadsafe(out.put(item), loop)
+                while True:
+                    try:
+                        future.result(timeout=0.5)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        if stop.is_set():
+                            future.cancel()
+                            return
+                start = time.perf_counter()
+
+        try:
+            await asyncio.to_thread(run)
+        except asyncio.CancelledError:
+            stop.set()
+            raise
+
+    async def _embed(self, inp: asyncio.Queue, out: asyncio.Queue):
+        while True:
+            item = await inp.get()
+            if item is _DONE:
+                await inp.put(_DONE)  # 他の埋め込みワーカーにも終了を伝える
+                return
+            items = [item]
+            count = len(item.ids)
+            # すでに届いている分はまとめて1バッチにする
+            while count < self.batch_size and not inp.empty():
+                nxt = inp.get_nowait()
+                if nxt is _DONE:
+                    await inp.put(_DONE)
+                    break
+                items.append(nxt)
+                count += len(nxt.ids)
+
+            texts = [t for it in items for t in it.texts]
+            embeddings = []
+            for i in range(0, len(texts), self.batch_size):
+                await self.limiter.acquire()
+                start = time.perf_counter()
+                embeddings.extend(await asyncio.to_thread(self.embeddings.embed_documents, texts[i:i + self.batch_size]))
+                self._record("embed", len(texts[i:i + self.batch_size]), time.perf_counter() - start)
+            await out.put(EmbeddedBatch(items, embeddings))
+
+    async def _write(self, inp: asyncio.Queue):
+        while True:
+            batch = await inp.get()
+            if batch is _DONE:
+                return
+            start = time.perf_counter()
+            await asyncio.to_thread(self._write_batch, batch)
+            self._record("write", len(batch.embeddings), time.perf_counter() - start)
+            for item in batch.items:
+                if item.on_written:
+                    item.on_written()
+
+    def _write_batch(self, batch: EmbeddedBatch):
+        for item in batch.items:
+            if item.replace_where:
+                self.collection.delete(where=item.replace_where)
+        if not batch.embeddings:
+            return
+        self.collection.upsert(
+            ids=[i for it in batch.items for i in it.ids],
+            embeddings=batch.embeddings,
+            documents=[t for it in batch.items for t in it.texts],
+            metadatas=[m for it in batch.items for m in it.metadatas],
+        )
+
+    async def _report(self, queues: Dict[str, asyncio.Queue]):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            print(self.format_report(queues))
+
+    def format_report(self, queues: Optional[Dict[str, asyncio.Queue]] = None) -> str:
+        parts = [f"{s.name}: {s.records}件 ({s.throughput():.1f}/s)" for s in self.stats.values()]
+        if queues:
+            parts += [f"queue[{name}]={q.qsize()}" for name, q in queues.items()]
+        return " | ".join(parts)
+
+    async def run(self, sources: List[Iterable[IngestItem]]):
+        self.stats = {name: StageStats(name) for name in ("fetch", "embed", "write")}
+        self.limiter = RateLimiter(self.embed_rate)
+        to_embed = asyncio.Queue(maxsize=self.queue_size)
+        to_write = asyncio.Queue(maxsize=max(self.queue_size // 4, 1))
+        queues = {"embed": to_embed, "write": to_write}
+        # どこかのステージで例外が出たら TaskGroup が残りのタスクを止める
+        async with asyncio.TaskGroup() as tg:
+            reporter = tg.create_task(self._report(queues))
+            embedders = [tg.create_task(self._embed(to_embed, to_write)) for _ in range(self.embed_concurrency)]
+            writer = tg.create_task(self._write(to_write))
+            await asyncio.gather(*(self._fetch(source, to_embed) for source in sources))
+            await to_embed.put(_DONE)
+            await asyncio.gather(*embedders)
+            await to_write.put(_DONE)
+            await writer
+            reporter.cancel()
+        print(self.format_report())
+        return {name: {"records": s.records, "per_second": s.throughput(), "busy_seconds": s.busy_seconds}
+                for name, s in self.stats.items()}
+
+
+# ======= 取得ステージ =======
+
+def slack_source(sync_state, save_state=None):
+    """参加チャンネルごとに新しいメッセージを1単位として流す"""
+    from slack_embedding_message import fetch_messages, joined_channels
+
+    lock = threading.Lock()
+    for channel_id, channel_name, channel_type in joined_channels():
+        data, latest_ts, threads = fetch_messages(channel_id, channel_type, oldest=sync_state.get(channel_id),
+                                                  threads=sync_state.get("threads", {}).get(channel_id))
+
+        def mark_written(channel_id=channel_id, latest_ts=latest_ts, threads=threads):
+            # 書き込みが終わってから ts を進めるので、途中で落ちても取りこぼさない
+            with lock:
+                if latest_ts:
+                    sync_state[channel_id] = latest_ts
+                sync_state.setdefault("threads", {})[channel_id] = threads
+                if save_state:
+                    save_state(sync_state)
+
+        yield IngestItem(
+            ids=[d["id"] for d in data],
+            texts=[d["text"] for d in data],
+            metadatas=[d["metadata"] for d in data],
+            on_written=mark_written,
+        )
+
+
+def drive_source(crawler, folder_id, failed=None):
+    """取得できたファイルから順に、チャンク一式を1単位として流す
+
+    本文を取得できなかったファイル（error 付き）は保存済みのチャンクを消さないよう流さず、
+    failed（リスト）が渡されていれば、再取得用にファイルの情報を追加する（embed_to_chroma と同じ）。
+    """
+    from googledrive_embedding_documents import chunk_id, format_for_embedding, retry_entry
+
+    for file in crawler.crawl(folder_id):
+        if "error" in file:
+            print(f"  [!] {file['name']} ({file['id']}) の本文を取得できなかったため、保存済みの内容を残します: {file['error']}")
+            if failed is not None:
+                failed.append(retry_entry(file))
+            continue
+        documents, metadatas = format_for_embedding([file])
+        yield IngestItem(
+            ids=[chunk_id(m) for m in metadatas],
+            texts=documents,
+            metadatas=metadatas,
+            replace_where={"file_id": file["id"]},
+        )
+
+
+def save_drive_retries(crawler, folder_id, start_page_token, failed, touched):
+    """本文を取得できなかったファイルを googledrive_sync の retry_files に載せ、次回の差分同期で取り直す"""
+    from googledrive_sync import load_sync_state, save_sync_state
+
+    state = load_sync_state()
+    if state is None:
+        # 同期状態が無ければ、このクロールを googledrive_sync の全件同期の代わりにする
+        state = {"folder_id": folder_id, "folder_ids": sorted(crawler.visited_folders),
+                 "folder_parents": crawler.folder_parents, "start_page_token": start_page_token,
+                 "retry_files": []}
+    elif state["folder_id"] != folder_id:
+        if failed:
+            print(f"同期状態のフォルダ（{state['folder_id']}）と違うため、取得できなかった {len(failed)}件は"
+                  f"次回の同期で取り直しません")
+        return
+    failed_ids = {file["id"] for file in failed}
+    retry = [file for file in state.get("retry_files", [])
+             if file["id"] not in failed_ids and f"drive:{file['id']}" not in touched]
+    save_sync_state({**state, "retry_files": retry + failed})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="非同期の取り込みパイプライン")
+    parser.add_argument("source", choices=["slack", "drive"])
+    parser.add_argument("folder_id", nargs="?", help="drive の場合のフォルダID")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--embed-concurrency", type=int, default=4)
+    parser.add_argument("--embed-rate", type=float, default=None, help="埋め込み API の呼び出し回数/秒")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    from embedding_backends import create_embeddings
+    from embedding_cache import CachedEmbeddings
+
+    load_dotenv()
+    collection = chromadb.PersistentClient(path=PERSIST_DIRECTORY).get_or_create_collection(COLLECTION_NAME)
+    embeddings = create_embeddings(model=EMBEDDING_MODEL)
+    check_embedding_model(collection, embeddings, record=True)
+    metrics = Metrics.from_env()
+    pipeline = IngestPipeline(embeddings, collection, batch_size=args.batch_size,
+                              embed_concurrency=args.embed_concurrency, embed_rate=args.embed_rate, metrics=metrics)
+
+    if args.source == "slack":
+        from slack_embedding_message import load_sync_state, save_sync_state
+
+        source = slack_source(load_sync_state(), save_sync_state)
+    else:
+        from googledrive_embedding_documents import create_crawler
+
+        folder_id = args.folder_id or input("Google Drive Folder ID を入力してください: ").strip()
+        crawler = create_crawler()
+        start_page_token = crawler.get_start_page_token()
+        failed = []
+        source = drive_source(crawler, folder_id, failed)
+
+    touched = set()
+
+    def tracked(items):
+        # 取り込んだリソースを覚えておき、そのリソースの ACL だけを読み直す
+        for item in items:
+            touched.update(resource_key(m) for m in item.metadatas)
+            yield item
+
+    asyncio.run(pipeline.run([tracked(source)]))
+    if isinstance(embeddings, CachedEmbeddings):
+        print(f"埋め込みキャッシュ: {embeddings.stats()}")
+    refresh_permission_index(collection, touched)
+    if args.source == "drive":
+        save_drive_retries(crawler, folder_id, start_page_token, failed, touched)
+    metrics.save()
+
+
+if __name__ == "__main__":
+    main()
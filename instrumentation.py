@@ -0,0 +1,190 @@
+# 検索・取り込みの計測（オプトイン）と、検索候補ごとの監査ログ
+#
+# Metrics はステージごとの所要時間のヒストグラムとカウンタを集計し、Prometheus のテキスト形式で出力する。
+# 既定の NULL_METRICS は何も集計しないので、計測しない場合のオーバーヘッドはほぼ無い。
+# 取り込みスクリプトは環境変数 METRICS_FILE を指定すると、終了時にそのファイルへ書き出す。
+#
+#   METRICS_FILE=metrics.prom uv run slack_embedding_message.py
+#
+# AuditLog は検索候補ごとのログをサンプリングし、書き出しはバックグラウンドスレッドで行う。
+
+import bisect
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+# 秒単位のヒストグラムの上限値（100µs〜10秒）
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# メトリクス名 -> 説明（# HELP 行）
+METRIC_HELP = {
+    "acvdb_search_stage_seconds": "Time spent in each search stage (embed_query, query, filter, scan, rerank, total).",
+    "acvdb_search_candidates_fetched_total": "Candidates returned by the vector store before the ACL filter.",
+    "acvdb_search_candidates_accepted_total": "Candidates that passed the ACL filter.",
+    "acvdb_search_result_cache_hits_total": "Searches answered from the result cache.",
+    "ingest_stage_seconds": "Time spent in each ingestion stage.",
+    "ingest_records_total": "Records processed by each ingestion stage.",
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v).lower() if isinstance(v, bool) else str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 末尾は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """カウンタとヒストグラムの集計。enabled=False なら何もしない"""
+
+    def __init__(self, enabled: bool = True, path: Optional[str] = None, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.path = path
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "Metrics":
+        """環境変数 METRICS_FILE があれば、そこへ書き出す Metrics を返す"""
+        path = os.getenv("METRICS_FILE")
+        return cls(path=path) if path else NULL_METRICS
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式（exposition format 0.0.4）"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append(f"{name}{_format_labels(key)} {value:g}")
+            for name in sorted(self._histograms):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, hist in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for le, count in zip(list(hist.buckets) + ["+Inf"], hist.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, ('le', str(le)))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {hist.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        """path が指定されていれば render() の結果を書き出す"""
+        if not self.enabled or not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.path)
+
+
+NULL_METRICS = Metrics(enabled=False)
+
+
+class AuditLog:
+    """検索候補ごとの監査ログ
+
+    sample_rate の割合のクエリだけを記録し（1クエリの候補はまとめて記録するか、まとめて捨てる）、
+    asynchronous=True ならフォーマットと出力をバックグラウンドスレッドで行う。
+    キューがあふれた分は捨てて dropped に数える。
+    """
+
+    def __init__(self, logger: logging.Logger, sample_rate: float = 1.0, asynchronous: bool = True,
+                 queue_size: int = 10000, level: int = logging.INFO):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.asynchronous = asynchronous
+        self.level = level
+        self.dropped = 0
+        self._queue: "queue.Queue[Tuple[str, tuple]]" = queue.Queue(maxsize=queue_size)
+        self._worker: Optional[threading.Thread] = None
+
+    def sampled(self) -> bool:
+        """このクエリを記録するか"""
+        if self.sample_rate <= 0 or not self.logger.isEnabledFor(self.level):
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log(self, msg: str, *args):
+        if not self.asynchronous:
+            self.logger.log(self.level, msg, *args)
+            return
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="audit-log", daemon=True)
+            self._worker.start()
+        try:
+            self._queue.put_nowait((msg, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            msg, args = self._queue.get()
+            try:
+                self.logger.log(self.level, msg, *args)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """キューに溜まったログをすべて書き出すまで待つ"""
+        if self._worker is not None:
+            self._queue.join()
@@ -1,10 +1,23 @@
 import os
+import io
+import json
+import time
+import hashlib
+import tempfile
 import logging
-from typing import List, Set, Dict
-from dataclasses import dataclass, field
+from collections import Counter, OrderedDict
+from itertools import islice
+from typing import List, Set, Dict, Iterable, Optional
+from dataclasses import dataclass, field, replace
 from dotenv import load_dotenv
 import chromadb
-from langchain_openai import OpenAIEmbeddings
+import numpy as np
+from acl_shards import ShardedCollection
+from compact_index import CompactIndex
+from embedding_backends import create_embeddings
+from embedding_cache import QueryEmbeddingCache, model_name, normalize_query
+from instrumentation import NULL_METRICS, AuditLog
+from permission_columns import PermissionColumns
 
 # ログ設定
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -27,18 +40,194 @@ class Document:
     permissions: Dict[str, bool]  # {'owner': bool, 'group': bool, 'other': bool}
 
 class AccessControlledVectorDB:
-    def __init__(self, collection_name="acvdb_demo"):
-        self.documents: List[Document] = []
+    def __init__(self, collection_name="acvdb_demo", embeddings=None, keep_documents=True,
+                 query_cache_size=1024, query_cache_ttl=600.0, result_cache_size=4096, persist_directory=None,
+                 metrics=None, audit=None, sharded=False):
+        # doc_id -> Document。keep_documents=False の場合は保持せず Chroma のメタデータから復元する
+        self.documents: Dict[str, Document] = {}
+        self.keep_documents = keep_documents
         self.collection_name = collection_name
-        self.embeddings = OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"])
+        # 省略時は EMBEDDING_BACKEND（openai / local）で選んだ埋め込みを使う
+        self.embeddings = embeddings or create_embeddings()
+        # 同じクエリの埋め込みは使い回し、同時に来た同じクエリは1回の埋め込みにまとめる
+        self.query_embeddings = QueryEmbeddingCache(self.embeddings, query_cache_size, query_cache_ttl)
+        # 検索結果キャッシュ。文書や ACL が変わるたびに version を上げ、古い結果は使わない
+        self.version = 0
+        self.result_cache_size = result_cache_size
+        self._result_cache: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (version, hits)
+        self._owners: Counter = Counter()
+        self._groups: Counter = Counter()
+        # 検索候補の閲覧可否を NumPy でまとめて判定するための列指向の ACL（keep_documents によらず保持する）
+        self.acl = PermissionColumns()
+        # ステージごとの所要時間・候補数の計測（instrumentation.Metrics を渡したときだけ集計する）
+        self.metrics = metrics or NULL_METRICS
+        # 候補ごとの監査ログ。既定ではバックグラウンドスレッドで INFO ログに出す
+        self.audit = audit or AuditLog(logger)
+        # build_compact_index() で作る量子化インデックス。あれば検索はこれで候補を選び、float32 で並べ替える
+        self.compact: Optional[CompactIndex] = None
+        self.compact_rerank = 8
+        # persist_directory を指定すると既存のコレクションを開き直し、ACL はサイドカーファイルから読み込む
+        self.persist_directory = persist_directory
+        self._dirty = False
+        # sharded=True なら文書を ACL ごとのシャード（acl_shards.ShardedCollection）に分け、
+        # 検索ではユーザーが読める可能性のあるシャードだけを見る
+        self.sharded = sharded
+        if persist_directory:
+            self.chroma_client = chromadb.PersistentClient(path=persist_directory)
+            if sharded:
+                # doc_id -> シャードの対応はサイドカーから復元するので、ここではシャードのメタデータを読まない
+                self.collection = ShardedCollection(self.chroma_client, collection_name, scan=False)
+            else:
+                self.collection = self.chroma_client.get_or_create_collection(collection_name)
+            self._warm_start()
+            return
         self.chroma_client = chromadb.Client()
-        try:
-            self.chroma_client.delete_collection(collection_name)
-        except:
-            pass
-        self.collection = self.chroma_client.create_collection(collection_name)
+        if sharded:
+            self.collection = ShardedCollection(self.chroma_client, collection_name)
+            self.collection.drop()
+        else:
+            try:
+                self.chroma_client.delete_collection(collection_name)
+            except:
+                pass
+            self.collection = self.chroma_client.create_collection(collection_name)
         logger.info(f"Chroma collection '{collection_name}' initialized.")
 
+    # ===== 永続化モード =====
+    # <persist_directory>/<collection>.acl.npz   PermissionColumns の配列（sharded なら doc_id ごとのシャードも）
+    # <persist_directory>/<collection>.manifest.json
+    #     {model, dimension, count, checksum(acl.npz の sha256)}
+    # 文書の本文とメタデータは Chroma にあるので、サイドカーには ACL だけを持つ。
+    # 変更があるとマニフェストの count / checksum を消し（model / dimension は残す）、save() で書き直す。
+    # 途中で落ちて count / checksum が無い・合わない場合は Chroma のメタデータから ACL を作り直す。
+    # model / dimension はマニフェストがあれば常に検証するので、落ちた後に別のモデルで開くことはできない。
+
+    def _sidecar_path(self, suffix: str) -> str:
+        return os.path.join(self.persist_directory, f"{self.collection_name}{suffix}")
+
+    def _dimension(self) -> Optional[int]:
+        result = self.collection.get(limit=1, include=["embeddings"])
+        return len(result["embeddings"][0]) if result["ids"] else None
+
+    def _stored_count(self) -> int:
+        return self.collection.stored_count() if self.sharded else self.collection.count()
+
+    def _read_manifest(self) -> Optional[Dict]:
+        path = self._sidecar_path(".manifest.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: Dict):
+        path = self._sidecar_path(".manifest.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def _warm_start(self):
+        start = time.perf_counter()
+        count = self._stored_count()
+        manifest = self._read_manifest()
+        # モデルや次元が違うベクトルとは比較できないので、作り直しではなくエラーにする
+        if manifest is not None and count and manifest["model"] != model_name(self.embeddings):
+            raise ValueError(f"collection '{self.collection_name}' was embedded with {manifest['model']},"
+                             f" not {model_name(self.embeddings)}")
+        problem = self._load_sidecar(manifest, count)
+        if problem:
+            logger.warning(f"{problem}。Chroma のメタデータから ACL を作り直します")
+            if self.sharded:
+                self.collection.rescan()
+            self._rebuild_sidecar()
+            self._dirty = True
+        # sharded ではシャードの対応ができてからでないと埋め込みを読めないので、次元はここで確かめる
+        if manifest is not None and count and manifest["dimension"] is not None \
+                and manifest["dimension"] != self._dimension():
+            raise ValueError(f"collection '{self.collection_name}' has dimension {self._dimension()},"
+                             f" manifest says {manifest['dimension']}")
+        self.save()
+        logger.info(f"Chroma collection '{self.collection_name}' reopened: {count}件"
+                    f" ({(time.perf_counter() - start) * 1000:.1f} ms)")
+
+    def _load_sidecar(self, manifest: Optional[Dict], count: int) -> Optional[str]:
+        """サイドカーを読み込む。使えない場合はその理由を返す"""
+        if manifest is None or manifest["checksum"] is None:
+            if not count:
+                return None
+            return "マニフェストがありません" if manifest is None else "前回の変更が保存されていません"
+        if manifest["count"] != count:
+            return f"文書数が一致しません（マニフェスト {manifest['count']}件 / Chroma {count}件）"
+        path = self._sidecar_path(".acl.npz")
+        if not os.path.exists(path):
+            return "ACL ファイルがありません"
+        with open(path, "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != manifest["checksum"]:
+            return "ACL ファイルのチェックサムが一致しません"
+        with np.load(io.BytesIO(data)) as arrays:
+            if self.sharded and "shards" not in arrays:
+                return "シャードの割り当てがありません"
+            self.acl = PermissionColumns.from_arrays(arrays)
+            shards = arrays["shards"].tolist() if self.sharded else None
+        if len(self.acl) != count:
+            return f"ACL の件数が一致しません（{len(self.acl)}件 / Chroma {count}件）"
+        if self.sharded:
+            self.collection.restore(dict(zip(self.acl.row_ids, shards)), self.acl.entries())
+        owners, groups = self.acl.counts()
+        self._owners, self._groups = Counter(owners), Counter(groups)
+        return None
+
+    def _rebuild_sidecar(self, page_size: int = 5000):
+        self.acl = PermissionColumns()
+        self._owners.clear()
+        self._groups.clear()
+        offset = 0
+        while True:
+            page = self.collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            for meta in page["metadatas"]:
+                doc = self._document_from_record("", meta)
+                self.acl.set(doc.doc_id, doc.owner, doc.group, doc.permissions)
+                self._owners[doc.owner] += 1
+                self._groups[doc.group] += 1
+            offset += len(page["ids"])
+
+    def _mark_dirty(self):
+        if self.persist_directory and not self._dirty:
+            self._dirty = True
+            # 保存前に落ちても別のモデルで開けないよう、model / dimension は残して count / checksum だけ消す
+            model = model_name(self.embeddings)
+            manifest = self._read_manifest()
+            dimension = manifest["dimension"] if manifest is not None and manifest["model"] == model else None
+            self._write_manifest({"model": model, "dimension": dimension, "count": None, "checksum": None})
+
+    def save(self):
+        """永続化モードで、ACL のサイドカーとマニフェストを書き出す（変更が無ければ何もしない）"""
+        if not self.persist_directory or not self._dirty:
+            return
+        arrays = self.acl.to_arrays()
+        if self.sharded:
+            arrays["shards"] = np.array([self.collection.shard_of[d] for d in arrays["doc_ids"].tolist()], dtype=str)
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        data = buffer.getvalue()
+        path = self._sidecar_path(".acl.npz")
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+        manifest = {
+            "model": model_name(self.embeddings),
+            "dimension": self._dimension(),
+            "count": self.collection.count(),
+            "checksum": hashlib.sha256(data).hexdigest(),
+        }
+        self._write_manifest(manifest)
+        self._dirty = False
+
+    def close(self):
+        self.save()
+
     def _perm_str(self, doc: Document):
         p = doc.permissions
         return ''.join([
@@ -47,22 +236,138 @@ class AccessControlledVectorDB:
             'r' if p.get('other', False) else '-',
         ])
 
-    def add_document(self, doc: Document):
-        self.documents.append(doc)
-        meta = {
+    def _metadata(self, doc: Document) -> Dict:
+        p = doc.permissions
+        return {
             "doc_id": doc.doc_id,
+            "title": doc.title,
             "owner": doc.owner,
             "group": doc.group,
-            "permissions": self._perm_str(doc)
+            "permissions": self._perm_str(doc),
+            # where 句で絞り込めるように owner/group/other の読み取りビットを個別に持つ
+            "perm_owner": bool(p.get('owner', False)),
+            "perm_group": bool(p.get('group', False)),
+            "perm_other": bool(p.get('other', False)),
         }
-        text = f"{doc.title}\n{doc.content}"
+
+    def _text(self, doc: Document) -> str:
+        return f"{doc.title}\n{doc.content}"
+
+    def _document_from_record(self, text: str, meta: Dict) -> Document:
+        """Chroma に保存した本文とメタデータから Document を復元する"""
+        title, _, content = text.partition("\n")
+        return Document(
+            meta["doc_id"],
+            meta.get("title", title),
+            content,
+            meta["owner"],
+            meta["group"],
+            {'owner': meta["perm_owner"], 'group': meta["perm_group"], 'other': meta["perm_other"]},
+        )
+
+    def _track(self, doc: Document, delta: int):
+        """文書の owner / group の出現数を数えておく（有効なプリンシパルの判定用）"""
+        for counter, key in ((self._owners, doc.owner), (self._groups, doc.group)):
+            counter[key] += delta
+            if counter[key] <= 0:
+                del counter[key]
+        self.version += 1
+        self._mark_dirty()
+
+    def add_document(self, doc: Document):
+        if self.keep_documents:
+            self.documents[doc.doc_id] = doc
+        self._track(doc, 1)
+        self.acl.set(doc.doc_id, doc.owner, doc.group, doc.permissions)
+        text = self._text(doc)
+        with self.metrics.timer("ingest_stage_seconds", source="acvdb", stage="embed"):
+            embedding = self.embeddings.embed_query(text)
+        with self.metrics.timer("ingest_stage_seconds", source="acvdb", stage="write"):
+            self.collection.add(
+                embeddings=[embedding],
+                documents=[text],
+                metadatas=[self._metadata(doc)],
+                ids=[doc.doc_id]
+            )
+        self.metrics.inc("ingest_records_total", source="acvdb", stage="write")
+        self._encode_compact([doc.doc_id], [embedding])
+
+    def add_documents(self, docs: Iterable[Document], batch_size: int = 256) -> int:
+        """文書をまとめて追加する。埋め込みと Chroma への書き込みはバッチ単位で1回ずつ"""
+        start = time.perf_counter()
+        total = 0
+        it = iter(docs)
+        while batch := list(islice(it, batch_size)):
+            texts = [self._text(d) for d in batch]
+            with self.metrics.timer("ingest_stage_seconds", source="acvdb", stage="embed"):
+                embeddings = self.embeddings.embed_documents(texts)
+            with self.metrics.timer("ingest_stage_seconds", source="acvdb", stage="write"):
+                self.collection.add(
+                    embeddings=embeddings,
+                    documents=texts,
+                    metadatas=[self._metadata(d) for d in batch],
+                    ids=[d.doc_id for d in batch]
+                )
+            self.metrics.inc("ingest_records_total", len(batch), source="acvdb", stage="write")
+            if self.keep_documents:
+                self.documents.update((d.doc_id, d) for d in batch)
+            for d in batch:
+                self._track(d, 1)
+                self.acl.set(d.doc_id, d.owner, d.group, d.permissions)
+            self._encode_compact([d.doc_id for d in batch], embeddings)
+            total += len(batch)
+        self.save()
+        elapsed = time.perf_counter() - start
+        logger.info(f"{total}件の文書を追加しました ({elapsed:.2f}秒, {total / elapsed if elapsed else 0:.1f} docs/sec)")
+        return total
+
+    def update_document(self, doc: Document):
+        """同じ doc_id の文書を本文・アクセス権ごと置き換える"""
+        old = self.get_document(doc.doc_id)
+        if old is not None:
+            self._track(old, -1)
+        if self.keep_documents:
+            self.documents[doc.doc_id] = doc
+        self._track(doc, 1)
+        self.acl.set(doc.doc_id, doc.owner, doc.group, doc.permissions)
+        text = self._text(doc)
         embedding = self.embeddings.embed_query(text)
-        self.collection.add(
+        self.collection.upsert(
             embeddings=[embedding],
             documents=[text],
-            metadatas=[meta],
+            metadatas=[self._metadata(doc)],
             ids=[doc.doc_id]
         )
+        self._encode_compact([doc.doc_id], [embedding])
+
+    def update_permissions(self, doc_id: str, permissions: Dict[str, bool]):
+        """埋め込みはそのままで、アクセス権のメタデータだけを更新する"""
+        doc = self.get_document(doc_id)
+        if doc is None:
+            raise KeyError(doc_id)
+        doc = replace(doc, permissions=dict(permissions))
+        if self.keep_documents:
+            self.documents[doc_id] = doc
+        self.acl.set(doc_id, doc.owner, doc.group, doc.permissions)
+        self.collection.update(ids=[doc_id], metadatas=[self._metadata(doc)])
+        self.version += 1
+        self._mark_dirty()
+
+    def delete_document(self, doc_id: str):
+        doc = self.get_document(doc_id)
+        if doc is not None:
+            self._track(doc, -1)
+        self.documents.pop(doc_id, None)
+        self.acl.remove(doc_id)
+        self.collection.delete(ids=[doc_id])
+
+    def get_document(self, doc_id: str) -> Optional[Document]:
+        doc = self.documents.get(doc_id)
+        if doc is None:
+            result = self.collection.get(ids=[doc_id], include=["documents", "metadatas"])
+            if result["ids"]:
+                doc = self._document_from_record(result["documents"][0], result["metadatas"][0])
+        return doc
 
     def can_access(self, user: User, doc: Document) -> bool:
         if user.user_id == doc.owner:
@@ -80,25 +385,107 @@ class AccessControlledVectorDB:
             'r' if p.get('other', False) else '-',
         ])
 
-    def search(self, query: str, user: User, top_k: int = 3) -> List[Dict]:
-        """RAG検索＋アクセス可否をログで出す"""
-        logger.info(f"\n[検索ログ] Query: '{query}' User: {user.user_id}")
-        query_embedding = self.embeddings.embed_query(query)
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k * 4  # フィルタで減る可能性を考慮
-        )
+    def access_filter(self, user: User) -> Dict:
+        """can_access と同じ判定規則を Chroma の where 句に変換する"""
+        is_owner = {"owner": user.user_id}
+        not_owner = {"owner": {"$ne": user.user_id}}
+        clauses = [{"$and": [is_owner, {"perm_owner": True}]}]
+        if user.groups:
+            groups = sorted(user.groups)
+            clauses.append({"$and": [not_owner, {"group": {"$in": groups}}, {"perm_group": True}]})
+            clauses.append({"$and": [not_owner, {"group": {"$nin": groups}}, {"perm_other": True}]})
+        else:
+            clauses.append({"$and": [not_owner, {"perm_other": True}]})
+        return {"$or": clauses}
+
+    def effective_principal(self, user: User) -> tuple:
+        """検索結果を左右するユーザーの属性だけを取り出す
+
+        文書を1件も所有していないユーザーは user_id によらず結果が同じで、
+        どの文書にも付いていないグループも結果に影響しない。
+        例えば create_sample_data の david と guest は同じ値になる。
+        """
+        owner = user.user_id if user.user_id in self._owners else None
+        return owner, frozenset(g for g in user.groups if g in self._groups)
+
+    def search(self, query: str, user: User, top_k: int = 3, prefilter: bool = False) -> List[Dict]:
+        """RAG検索＋アクセス可否をログで出す
+
+        prefilter=True の場合はアクセス権を where 句として Chroma に渡し、
+        閲覧可能な文書だけを対象に top_k 件を取得する。
+        同じ（クエリ, 有効なプリンシパル, top_k）の結果は文書や ACL が変わるまでキャッシュから返す。
+        """
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="total"):
+            key = (normalize_query(query), self.effective_principal(user), top_k, prefilter)
+            cached = self._result_cache.get(key)
+            if cached is not None and cached[0] == self.version:
+                self._result_cache.move_to_end(key)
+                self.metrics.inc("acvdb_search_result_cache_hits_total")
+                logger.debug("[検索ログ] Query: '%s' User: %s (結果キャッシュ)", query, user.user_id)
+                return list(cached[1])
+
+            hits = self._search(query, user, top_k, prefilter)
+            if self.result_cache_size:
+                self._result_cache[key] = (self.version, hits)
+                self._result_cache.move_to_end(key)
+                while len(self._result_cache) > self.result_cache_size:
+                    self._result_cache.popitem(last=False)
+            return list(hits)
+
+    def _search(self, query: str, user: User, top_k: int, prefilter: bool) -> List[Dict]:
+        audit = self.audit.sampled()
+        if audit:
+            self.audit.log("\n[検索ログ] Query: '%s' User: %s", query, user.user_id)
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="embed_query"):
+            query_embedding = self.query_embeddings.embed_query(query)
+        if self.compact is not None:
+            ranked = self._compact_search(query_embedding, [user], top_k)[0]
+            if audit:
+                for doc_obj, dist in ranked:
+                    self.audit.log(
+                        "《〇》[%s] '%s' (owner:%s, group:%s, perm:%s) ... 類似度: %.4f",
+                        doc_obj.doc_id, doc_obj.title, doc_obj.owner, doc_obj.group, self._perm_str(doc_obj), 1 - dist,
+                    )
+            return [self._hit(doc_obj, dist) for doc_obj, dist in ranked]
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="query"):
+            if self.sharded:
+                # ユーザーが読める可能性のあるシャードだけを検索する。
+                # 読めない文書の分だけ多めに取るので、where 句を使わずに事前フィルタと同じ結果になる
+                results = self.collection.query(
+                    query_embeddings=[query_embedding],
+                    n_results=top_k,
+                    shards=self.collection.scope(user)
+                )
+            elif prefilter:
+                results = self.collection.query(
+                    query_embeddings=[query_embedding],
+                    n_results=top_k,
+                    where=self.access_filter(user)
+                )
+            else:
+                results = self.collection.query(
+                    query_embeddings=[query_embedding],
+                    n_results=top_k * 4  # フィルタで減る可能性を考慮
+                )
         hits = []
-        for doc_text, meta, dist in zip(
-            results["documents"][0], results["metadatas"][0], results["distances"][0]
+        metadatas = results["metadatas"][0]
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="filter"):
+            # 候補全体の閲覧可否を一度に判定する（can_access と同じ結果）
+            allowed = self.acl.mask_for(user, [meta["doc_id"] for meta in metadatas])
+        self.metrics.inc("acvdb_search_candidates_fetched_total", len(metadatas), prefilter=prefilter)
+        self.metrics.inc("acvdb_search_candidates_accepted_total", int(allowed.sum()), prefilter=prefilter)
+        for doc_text, meta, dist, can in zip(
+            results["documents"][0], metadatas, results["distances"][0], allowed.tolist()
         ):
-            doc_obj = next(d for d in self.documents if d.doc_id == meta["doc_id"])
-            can = self.can_access(user, doc_obj)
-            logger.info(
-                f"《{'〇' if can else '×'}》[{doc_obj.doc_id}] '{doc_obj.title}'"
-                f" (owner:{doc_obj.owner}, group:{doc_obj.group}, perm:{self._perm_str(doc_obj)})"
-                f" ... 類似度: {1-dist:.4f}"
-            )
+            if not (can or audit):
+                continue
+            doc_obj = self.documents.get(meta["doc_id"]) or self._document_from_record(doc_text, meta)
+            if audit:
+                self.audit.log(
+                    "《%s》[%s] '%s' (owner:%s, group:%s, perm:%s) ... 類似度: %.4f",
+                    '〇' if can else '×', doc_obj.doc_id, doc_obj.title, doc_obj.owner, doc_obj.group,
+                    self._perm_str(doc_obj), 1 - dist,
+                )
             if can:
                 hits.append({
                     "doc_id": doc_obj.doc_id,
@@ -108,6 +495,206 @@ class AccessControlledVectorDB:
                 })
         return hits[:top_k]
 
+    def search_many(self, query: str, users: List[User], top_k: int = 3, prefilter: bool = False,
+                    max_pool: int = 2000) -> Dict[str, List[Dict]]:
+        """同じクエリを複数のユーザーで検索する。user_id -> search() と同じ結果"""
+        return self.search_batch([query], users, top_k, prefilter, max_pool)[0]
+
+    def search_batch(self, queries: List[str], users: List[User], top_k: int = 3, prefilter: bool = False,
+                     max_pool: int = 2000) -> List[Dict[str, List[Dict]]]:
+        """queries x users の検索をまとめて行う。クエリごとに user_id -> search() と同じ結果
+
+        クエリの埋め込みと Chroma の検索はクエリごとに1回で、取得した候補プールを全ユーザーで共有する。
+        閲覧可否はユーザー x 候補の行列として PermissionColumns.mask_many で一度に判定する。
+        prefilter=True では、最も閲覧範囲の狭いユーザーでも top_k 件が残る大きさのプールを取得し、
+        足りなければ広げて取り直す。プールが max_pool 件を超えるユーザーだけは個別に search() する。
+        結果キャッシュと監査ログは使わない。
+        """
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="embed_query"):
+            embeddings = [self.query_embeddings.embed_query(q) for q in queries]
+        if self.compact is not None:
+            return [
+                {user.user_id: [self._hit(doc_obj, dist) for doc_obj, dist in ranked]
+                 for user, ranked in zip(users, self._compact_search(embedding, users, top_k))}
+                for embedding in embeddings
+            ]
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="query"):
+            if self.sharded:
+                pools, fallback = self._sharded_pools(embeddings, users, top_k, prefilter), set()
+            elif prefilter:
+                pools, fallback = self._prefilter_pools(embeddings, users, top_k, max_pool)
+            else:
+                pools, fallback = self._pools(embeddings, users, top_k * 4, prefilter), set()
+
+        # 上位 top_k に入った文書だけを復元する
+        winners = {}
+        for ids, distances, allowed in pools:
+            for row in allowed:
+                for i in np.flatnonzero(row)[:top_k]:
+                    winners[ids[i]] = None
+        documents = {doc_id: self.documents[doc_id] for doc_id in winners if doc_id in self.documents}
+        missing = [doc_id for doc_id in winners if doc_id not in documents]
+        if missing:
+            records = self.collection.get(ids=missing, include=["documents", "metadatas"])
+            for doc_id, text, meta in zip(records["ids"], records["documents"], records["metadatas"]):
+                documents[doc_id] = self._document_from_record(text, meta)
+
+        results = []
+        for query, (ids, distances, allowed) in zip(queries, pools):
+            by_user = {}
+            for user, row in zip(users, allowed):
+                if user.user_id in fallback:
+                    by_user[user.user_id] = self._search(query, user, top_k, prefilter)
+                    continue
+                by_user[user.user_id] = [
+                    {
+                        "doc_id": ids[i],
+                        "title": documents[ids[i]].title,
+                        "content": documents[ids[i]].content,
+                        "similarity": 1 - distances[i],
+                    }
+                    for i in np.flatnonzero(row)[:top_k]
+                ]
+            results.append(by_user)
+        return results
+
+    def _pool(self, ids: List[str], distances: List[float], users: List[User], prefilter: bool) -> tuple:
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="filter"):
+            allowed = self.acl.mask_many(users, self.acl.row_indices(ids))
+        self.metrics.inc("acvdb_search_candidates_fetched_total", len(ids) * len(users), prefilter=prefilter)
+        self.metrics.inc("acvdb_search_candidates_accepted_total", int(allowed.sum()), prefilter=prefilter)
+        return ids, distances, allowed
+
+    def _pools(self, embeddings, users: List[User], n_results: int, prefilter: bool) -> List[tuple]:
+        """クエリごとの候補（doc_id, 距離, ユーザー x 候補の閲覧可否）"""
+        results = self.collection.query(query_embeddings=embeddings, n_results=n_results, include=["distances"])
+        return [self._pool(ids, distances, users, prefilter)
+                for ids, distances in zip(results["ids"], results["distances"])]
+
+    def _sharded_pools(self, embeddings, users: List[User], top_k: int, prefilter: bool) -> List[tuple]:
+        # 全ユーザーの scope をまとめて1回で検索する（各ユーザーの scope で取れる文書はすべて含まれる）
+        results = self.collection.query(embeddings, n_results=top_k, shards=self.collection.scope_many(users),
+                                        include=["distances"])
+        return [self._pool(ids, distances, users, prefilter)
+                for ids, distances in zip(results["ids"], results["distances"])]
+
+    def _prefilter_pools(self, embeddings, users: List[User], top_k: int, max_pool: int) -> tuple:
+        """事前フィルタと同じ結果になる候補プールと、個別に検索するユーザー
+
+        閲覧可能な文書の割合から、そのユーザーの top_k 件が入るプールの大きさを見積もる（2倍の余裕を持たせる）。
+        全文書を閲覧可能な文書数より多く取っても足りないユーザーがいるクエリは、プールを倍にして取り直す。
+        """
+        total = self.collection.count()
+        readable = self.acl.readable_counts(users)
+        wanted = np.minimum(top_k, readable)
+        need = np.where(readable > 0, np.ceil(2 * wanted * total / np.maximum(readable, 1)), 0)
+        # プール全体を取っても足りない（閲覧可能な文書が少なすぎる）ユーザーは個別に検索する
+        fallback = {user.user_id for user, n in zip(users, need) if n > max_pool and n > top_k * 4}
+        batch_need = [n for user, n in zip(users, need) if user.user_id not in fallback]
+        n_results = int(min(total, max([top_k * 4] + batch_need)))
+        pools: List[Optional[tuple]] = [None] * len(embeddings)
+        pending = list(range(len(embeddings)))
+        in_batch = np.array([user.user_id not in fallback for user in users], dtype=bool)
+        while pending and n_results:
+            results = self.collection.query(query_embeddings=[embeddings[i] for i in pending],
+                                            n_results=n_results, include=["distances"])
+            retry = []
+            for i, ids, distances in zip(pending, results["ids"], results["distances"]):
+                pools[i] = self._pool(ids, distances, users, True)
+                short = in_batch & (pools[i][2].sum(axis=1) < wanted)
+                if short.any() and n_results < total:
+                    if n_results * 2 > max_pool:
+                        fallback.update(user.user_id for user, s in zip(users, short) if s)
+                        in_batch &= ~short
+                    else:
+                        retry.append(i)
+            pending, n_results = retry, min(total, n_results * 2)
+        for i, pool in enumerate(pools):
+            if pool is None:
+                pools[i] = ([], [], np.zeros((len(users), 0), dtype=bool))
+        return pools, fallback
+
+    # ===== 量子化インデックス =====
+
+    def build_compact_index(self, kind: str = "int8", path: Optional[str] = None, subspaces: Optional[int] = None,
+                            rerank: int = 8, train_size: int = 20000, page_size: int = 5000) -> CompactIndex:
+        """Chroma の埋め込みから量子化インデックス（compact_index.CompactIndex）を作る
+
+        以後の検索は、閲覧可能な文書の近似距離から top_k * rerank 件の候補を選び、
+        Chroma の float32 の埋め込みで並べ替える（prefilter の指定によらず閲覧可能な文書だけが対象）。
+        追加・更新した文書も符号化する。path を省略すると永続化ディレクトリ（無ければ一時ディレクトリ）に置く。
+        """
+        dim = self._dimension()
+        if dim is None:
+            raise ValueError(f"collection '{self.collection_name}' is empty")
+        if path is None:
+            directory = self.persist_directory or tempfile.mkdtemp(prefix="acvdb_compact_")
+            path = os.path.join(directory, f"{self.collection_name}.compact")
+        start = time.perf_counter()
+        index = CompactIndex(path, dim, kind, subspaces)
+        sample = self.collection.get(include=["embeddings"], limit=train_size)
+        index.train(np.asarray(sample["embeddings"], dtype=np.float32))
+        index.reserve(len(self.acl.row_ids))
+        offset = 0
+        while True:
+            page = self.collection.get(include=["embeddings"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            index.set(self.acl.row_indices(page["ids"]), page["embeddings"])
+            offset += len(page["ids"])
+        index.flush()
+        if self.compact is not None and self.compact.path != path:
+            self.compact.remove_files()
+        self.compact, self.compact_rerank = index, rerank
+        self.version += 1
+        logger.info(f"量子化インデックス（{kind}）を作成しました: {offset}件, {index.nbytes() / 2**20:.1f} MB"
+                    f" ({(time.perf_counter() - start):.2f}秒)")
+        return index
+
+    def _encode_compact(self, doc_ids: List[str], embeddings):
+        if self.compact is not None:
+            self.compact.set(self.acl.row_indices(doc_ids), embeddings)
+
+    def _hit(self, doc_obj: Document, dist: float) -> Dict:
+        return {"doc_id": doc_obj.doc_id, "title": doc_obj.title, "content": doc_obj.content, "similarity": 1 - dist}
+
+    def _compact_search(self, query_embedding, users: List[User], top_k: int) -> List[List[tuple]]:
+        """量子化インデックスで、users それぞれの閲覧可能な上位 top_k 件の (Document, 距離) を求める"""
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="filter"):
+            readable = [self.acl.readable_rows(user) for user in users]
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="scan"):
+            if len(users) == 1:
+                approx = [self.compact.distances(query_embedding, readable[0])]
+            else:
+                # 全行の近似距離を1回だけ計算し、ユーザーごとに閲覧可能な行を取り出す
+                everything = self.compact.distances(query_embedding, np.arange(len(self.acl.row_ids)))
+                approx = [everything[rows] for rows in readable]
+            shortlists = []
+            for rows, dists in zip(readable, approx):
+                k = min(len(rows), top_k * self.compact_rerank)
+                shortlists.append(rows[np.argpartition(dists, k - 1)[:k]] if k else rows[:0])
+        with self.metrics.timer("acvdb_search_stage_seconds", stage="rerank"):
+            ids = list(dict.fromkeys(self.acl.row_ids[r] for rows in shortlists for r in rows))
+            # 誰も読める文書が無ければ取得しない（Chroma の get は空の ids を受け付けない）
+            if not ids:
+                return [[] for _ in users]
+            records = self.collection.get(ids=ids, include=["embeddings", "documents", "metadatas"])
+            query = np.asarray(query_embedding, dtype=np.float32)
+            vectors = np.asarray(records["embeddings"], dtype=np.float32).reshape(len(records["ids"]), -1)
+            exact = dict(zip(records["ids"], ((vectors - query) ** 2).sum(axis=1).tolist()))
+            docs = {
+                doc_id: self.documents.get(doc_id) or self._document_from_record(text, meta)
+                for doc_id, text, meta in zip(records["ids"], records["documents"], records["metadatas"])
+            }
+        self.metrics.inc("acvdb_search_candidates_fetched_total", sum(len(rows) for rows in shortlists),
+                         prefilter=True)
+        results = []
+        for rows in shortlists:
+            ranked = sorted((exact[self.acl.row_ids[r]], self.acl.row_ids[r]) for r in rows)[:top_k]
+            self.metrics.inc("acvdb_search_candidates_accepted_total", len(ranked), prefilter=True)
+            results.append([(docs[doc_id], dist) for dist, doc_id in ranked])
+        return results
+
 def create_sample_data():
     docs = [
         Document("doc1", "プロジェクト設計書", "これは秘密の設計書です", "alice", "eng", {'owner': True, 'group': False, 'other': False}),
@@ -136,19 +723,17 @@ def show_sample_data(docs, users, db):
     print("\n▼【アクセス権マトリクス（r=可）】")
     header = ["user/doc"] + [d.doc_id for d in docs]
     print(" | ".join(f"{h:8}" for h in header))
-    for u in users:
-        line = [u.user_id]
-        for d in docs:
-            mark = "r" if db.can_access(u, d) else "-"
-            line.append(mark)
+    # ユーザー x 文書の閲覧可否をまとめて判定する（can_access と同じ結果）
+    matrix = db.acl.mask_many(users, db.acl.row_indices(d.doc_id for d in docs))
+    for u, row in zip(users, matrix.tolist()):
+        line = [u.user_id] + ["r" if can else "-" for can in row]
         print(" | ".join(f"{x:8}" for x in line))
     print("\n" + "-" * 60)
 
 def main():
     db = AccessControlledVectorDB()
     docs, users = create_sample_data()
-    for doc in docs:
-        db.add_document(doc)
+    db.add_documents(docs)
     show_sample_data(docs, users, db)
     test_cases = [
         ("API", "alice"),    # engグループ、API仕様書(group:r)、可
@@ -163,11 +748,16 @@ def main():
         print(f"\n■テストケース{i}：「{query}」 by {user_id}")
         user = next(u for u in users if u.user_id == user_id)
         results = db.search(query, user)
+        db.audit.flush()  # 監査ログは別スレッドで出力されるので、結果の表示より先に出し切る
         if not results:
             print(" → アクセス可能な一致文書はありません\n")
         else:
             for r in results:
                 print(f" → ヒット: [{r['doc_id']}] {r['title']} : {r['content']} (類似度: {r['similarity']:.4f})\n")
+    print("\n▼【一括検索】「API」を全ユーザーで検索")
+    for user_id, results in db.search_many("API", users).items():
+        print(f" {user_id:7} → {', '.join(r['doc_id'] for r in results) or '(なし)'}")
+    print(f"\nクエリ埋め込みキャッシュ: {db.query_embeddings.stats()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
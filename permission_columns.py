@@ -0,0 +1,182 @@
+# AccessControlledVectorDB の ACL を列指向で持ち、候補文書の閲覧可否を NumPy でまとめて判定する
+#
+# owner / group は文字列を整数 ID に変換（intern）した int32 配列、
+# owner / group / other の読み取りビットは uint8 配列（r-- = 4, -r- = 2, --r = 1）に詰めて持つ。
+# 判定規則は AccessControlledVectorDB.can_access と同じで、
+#   owner なら owner ビット、owner でなく group に所属していれば group ビット、それ以外は other ビットを見る。
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+OWNER_BIT = 4
+GROUP_BIT = 2
+OTHER_BIT = 1
+
+
+def permission_bits(permissions: Dict[str, bool]) -> int:
+    return ((OWNER_BIT if permissions.get('owner', False) else 0)
+            | (GROUP_BIT if permissions.get('group', False) else 0)
+            | (OTHER_BIT if permissions.get('other', False) else 0))
+
+
+class PermissionColumns:
+    """doc_id -> 行番号 と、行ごとの owner ID / group ID / 権限ビットの配列"""
+
+    def __init__(self, capacity: int = 1024):
+        self.rows: Dict[str, int] = {}
+        self.row_ids: List[Optional[str]] = []  # 行番号 -> doc_id（削除済みの行は None）
+        self.owner_ids = np.full(capacity, -1, dtype=np.int32)
+        self.group_ids = np.full(capacity, -1, dtype=np.int32)
+        self.bits = np.zeros(capacity, dtype=np.uint8)
+        self._owners: Dict[str, int] = {}
+        self._groups: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._size = 0
+
+    def _grow(self, needed: int):
+        capacity = len(self.bits)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        pad = capacity - len(self.bits)
+        self.owner_ids = np.concatenate([self.owner_ids, np.full(pad, -1, dtype=np.int32)])
+        self.group_ids = np.concatenate([self.group_ids, np.full(pad, -1, dtype=np.int32)])
+        self.bits = np.concatenate([self.bits, np.zeros(pad, dtype=np.uint8)])
+
+    @staticmethod
+    def _intern(table: Dict[str, int], value: str) -> int:
+        return table.setdefault(value, len(table))
+
+    def set(self, doc_id: str, owner: str, group: str, permissions: Dict[str, bool]):
+        row = self.rows.get(doc_id)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                row = self._size
+                self._size += 1
+                self._grow(self._size)
+                self.row_ids.append(None)
+            self.rows[doc_id] = row
+            self.row_ids[row] = doc_id
+        self.owner_ids[row] = self._intern(self._owners, owner)
+        self.group_ids[row] = self._intern(self._groups, group)
+        self.bits[row] = permission_bits(permissions)
+
+    def remove(self, doc_id: str):
+        row = self.rows.pop(doc_id, None)
+        if row is not None:
+            self.row_ids[row] = None
+            self.owner_ids[row] = self.group_ids[row] = -1
+            self.bits[row] = 0
+            self._free.append(row)
+
+    def row_indices(self, doc_ids: Iterable[str]) -> np.ndarray:
+        """doc_id の列に対応する行番号（未登録は -1）"""
+        return np.array([self.rows.get(d, -1) for d in doc_ids], dtype=np.int64)
+
+    def mask(self, user, rows: np.ndarray) -> np.ndarray:
+        """rows の各文書を user が閲覧できるか（bool 配列）。未登録の行（-1）は False"""
+        rows = np.asarray(rows, dtype=np.int64)
+        valid = rows >= 0
+        safe = np.where(valid, rows, 0)
+        # group ID -> 所属しているか の表。末尾は削除済みの行（group ID = -1）用で常に False
+        member = np.zeros(len(self._groups) + 1, dtype=bool)
+        member[[self._groups[g] for g in user.groups if g in self._groups]] = True
+        required = np.where(member[self.group_ids[safe]], GROUP_BIT, OTHER_BIT).astype(np.uint8)
+        owner_id = self._owners.get(user.user_id)
+        if owner_id is not None:
+            required[self.owner_ids[safe] == owner_id] = OWNER_BIT
+        return valid & ((self.bits[safe] & required) != 0)
+
+    def mask_for(self, user, doc_ids: Iterable[str]) -> np.ndarray:
+        return self.mask(user, self.row_indices(doc_ids))
+
+    def readable_rows(self, user) -> np.ndarray:
+        """user が閲覧できる文書の行番号"""
+        return np.flatnonzero(self.mask(user, np.arange(self._size)))
+
+    def _principals(self, users):
+        """ユーザーごとの group ID -> 所属しているか の表と、owner ID（文書を所有していなければ -2）"""
+        member = np.zeros((len(users), len(self._groups) + 1), dtype=bool)
+        owner_ids = np.full(len(users), -2, dtype=np.int32)
+        for i, user in enumerate(users):
+            member[i, [self._groups[g] for g in user.groups if g in self._groups]] = True
+            owner_ids[i] = self._owners.get(user.user_id, -2)
+        return member, owner_ids
+
+    def _mask_many(self, users, owner_ids: np.ndarray, group_ids: np.ndarray, bits: np.ndarray) -> np.ndarray:
+        member, user_owner_ids = self._principals(users)
+        required = np.where(member[:, group_ids], GROUP_BIT, OTHER_BIT).astype(np.uint8)
+        required[user_owner_ids[:, None] == owner_ids[None, :]] = OWNER_BIT
+        return (bits & required) != 0
+
+    def mask_many(self, users, rows: np.ndarray) -> np.ndarray:
+        """users x rows の閲覧可否（bool の2次元配列）。ユーザーごとに mask を呼ぶのと同じ結果"""
+        rows = np.asarray(rows, dtype=np.int64)
+        valid = rows >= 0
+        safe = np.where(valid, rows, 0)
+        return valid & self._mask_many(users, self.owner_ids[safe], self.group_ids[safe], self.bits[safe])
+
+    def readable_counts(self, users) -> np.ndarray:
+        """ユーザーごとの閲覧可能な文書数
+
+        (owner, group, 権限) の組ごとに文書数をまとめてから判定するので、文書数ではなく組の数に比例する。
+        """
+        live = np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows))
+        combos, counts = np.unique(np.stack([self.owner_ids[live], self.group_ids[live], self.bits[live]]),
+                                   axis=1, return_counts=True)
+        mask = self._mask_many(users, combos[0], combos[1], combos[2].astype(np.uint8))
+        return mask.astype(np.int64) @ counts
+
+    def counts(self):
+        """owner 名 -> 文書数, group 名 -> 文書数"""
+        live = np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows))
+        result = []
+        for table, ids in ((self._owners, self.owner_ids), (self._groups, self.group_ids)):
+            names = list(table)
+            counts = np.bincount(ids[live], minlength=len(names))
+            result.append({names[i]: int(counts[i]) for i in np.flatnonzero(counts)})
+        return tuple(result)
+
+    def entries(self) -> Dict[str, Tuple[str, str, bool, bool]]:
+        """doc_id -> (owner, group, owner ビット, group ビット)"""
+        live = np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows))
+        owners = np.array(list(self._owners) or [""], dtype=object)[self.owner_ids[live]]
+        groups = np.array(list(self._groups) or [""], dtype=object)[self.group_ids[live]]
+        bits = self.bits[live]
+        return dict(zip(self.rows, zip(owners.tolist(), groups.tolist(),
+                                       (bits & OWNER_BIT).astype(bool).tolist(),
+                                       (bits & GROUP_BIT).astype(bool).tolist())))
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """削除済みの行を詰めた配列（np.savez でそのまま保存できる形）"""
+        doc_ids = list(self.rows)
+        live = np.fromiter(self.rows.values(), dtype=np.int64, count=len(doc_ids))
+        return {
+            "doc_ids": np.array(doc_ids, dtype=str),
+            "owner_ids": self.owner_ids[live],
+            "group_ids": self.group_ids[live],
+            "bits": self.bits[live],
+            "owners": np.array(list(self._owners), dtype=str),
+            "groups": np.array(list(self._groups), dtype=str),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "PermissionColumns":
+        columns = cls(capacity=max(len(arrays["doc_ids"]), 1))
+        n = len(arrays["doc_ids"])
+        columns.row_ids = arrays["doc_ids"].tolist()
+        columns.rows = dict(zip(columns.row_ids, range(n)))
+        columns.owner_ids[:n] = arrays["owner_ids"]
+        columns.group_ids[:n] = arrays["group_ids"]
+        columns.bits[:n] = arrays["bits"]
+        columns._owners = {name: i for i, name in enumerate(arrays["owners"].tolist())}
+        columns._groups = {name: i for i, name in enumerate(arrays["groups"].tolist())}
+        columns._size = n
+        return columns
+
+    def __len__(self):
+        return len(self.rows)
@@ -0,0 +1,248 @@
+# Slack / Google Drive のアクセス権をまとめた権限インデックス
+#
+# メタデータに文字列で保存された ACL（Drive の permissions JSON、Slack の permitted_user_ids）を
+# 取り込み時に「プリンシパル -> 閲覧可能なリソース番号の配列」（CSR 形式）にコンパイルしておく。
+# 検索時は JSON のデコードや文字列分割をせずに、ユーザーが見られるリソースのマスクを求められる。
+#
+# リソースは ACL の単位（Drive はファイル、Slack はチャンネル）で、
+# プリンシパルは以下の文字列で表す。
+#   anyone / user:<email> / group:<email> / domain:<domain> / slack:<user_id>
+#
+# 同じリソースのレコードでも ACL が違う場合（Slack の差分取り込みでは古いメッセージに古いメンバー一覧が残る）は、
+# 最も新しいレコード（Slack は ts、Drive は modified_time）の ACL を使う。
+#
+#   uv run permission_index.py   # .chroma から再構築して保存
+
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+DEFAULT_INDEX_PATH = ".chroma_permission_index.npz"
+
+ANYONE = "anyone"
+
+
+def resource_key(meta: Dict) -> Optional[str]:
+    source = meta.get("source")
+    if source == "google_drive":
+        return f"drive:{meta['file_id']}"
+    if source == "slack":
+        return f"slack:{meta['channel_id']}"
+    return None
+
+
+def resource_where(keys: Iterable[str]) -> Optional[Dict]:
+    """リソースのレコードをまとめて取得する Chroma の where 句"""
+    file_ids, channel_ids = [], []
+    for key in keys:
+        kind, _, value = key.partition(":")
+        (file_ids if kind == "drive" else channel_ids).append(value)
+    clauses = []
+    if file_ids:
+        clauses.append({"$and": [{"source": "google_drive"}, {"file_id": {"$in": file_ids}}]})
+    if channel_ids:
+        clauses.append({"$and": [{"source": "slack"}, {"channel_id": {"$in": channel_ids}}]})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def acl_version(meta: Dict):
+    """同じリソースのレコードのうち、どれの ACL が新しいかを比べるための値"""
+    if meta.get("source") == "slack":
+        return float(meta.get("ts") or 0)
+    return meta.get("modified_time") or ""
+
+
+def latest_acls(metadatas: Iterable[Dict]) -> Dict[str, List[str]]:
+    """リソース -> 最も新しいレコードの ACL（プリンシパルの一覧）"""
+    newest: Dict[str, tuple] = {}
+    for meta in metadatas:
+        key = resource_key(meta)
+        if key is None:
+            continue
+        version = acl_version(meta)
+        if key not in newest or version > newest[key][0]:
+            newest[key] = (version, meta)
+    # ACL の解析はリソースごとに1回だけ行う
+    return {key: metadata_principals(meta) for key, (_, meta) in newest.items()}
+
+
+def iter_metadatas(collection, where: Optional[Dict] = None, page_size: int = 1000) -> Iterable[Dict]:
+    offset = 0
+    while True:
+        page = collection.get(where=where, include=["metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        yield from page["metadatas"]
+        offset += len(page["ids"])
+
+
+def metadata_principals(meta: Dict) -> List[str]:
+    """メタデータに保存された ACL をプリンシパルの一覧に変換する"""
+    source = meta.get("source")
+    if source == "slack":
+        permitted = meta.get("permitted_user_ids", "")
+        return [f"slack:{uid}" for uid in permitted.split(",") if uid]
+    if source == "google_drive":
+        principals = []
+        for perm in json.loads(meta.get("permissions", "[]")):
+            perm_type = perm.get("type")
+            if perm_type == "anyone":
+                principals.append(ANYONE)
+            elif perm_type in ("user", "group"):
+                principals.append(f"{perm_type}:{perm.get('email', '').lower()}")
+            elif perm_type == "domain" and perm.get("domain"):
+                principals.append(f"domain:{perm['domain'].lower()}")
+        return principals
+    return []
+
+
+def identity_principals(email: Optional[str] = None, slack_user_id: Optional[str] = None,
+                        groups: Iterable[str] = ()) -> List[str]:
+    """呼び出し元ユーザーが該当するプリンシパルの一覧"""
+    principals = [ANYONE]
+    if email:
+        email = email.lower()
+        principals.append(f"user:{email}")
+        principals.append(f"domain:{email.rsplit('@', 1)[-1]}")
+    principals.extend(f"group:{g.lower()}" for g in groups)
+    if slack_user_id:
+        principals.append(f"slack:{slack_user_id}")
+    return principals
+
+
+class PermissionIndex:
+    """プリンシパル -> リソース番号の配列（CSR 形式）
+
+    principals[i] が閲覧できるリソース番号は indices[indptr[i]:indptr[i + 1]]。
+    """
+
+    def __init__(self, resources: np.ndarray, principals: np.ndarray, indptr: np.ndarray, indices: np.ndarray):
+        self.resources = resources
+        self.principals = principals
+        self.indptr = indptr
+        self.indices = indices
+        self._resource_pos = {r: i for i, r in enumerate(resources.tolist())}
+        self._principal_pos = {p: i for i, p in enumerate(principals.tolist())}
+
+    @classmethod
+    def build(cls, metadatas: Iterable[Dict]) -> "PermissionIndex":
+        return cls.from_acls(latest_acls(metadatas))
+
+    @classmethod
+    def from_acls(cls, acl: Dict[str, List[str]]) -> "PermissionIndex":
+        resources = sorted(acl)
+        members: Dict[str, List[int]] = {}
+        for pos, key in enumerate(resources):
+            for principal in set(acl[key]):
+                members.setdefault(principal, []).append(pos)
+
+        principals = sorted(members)
+        indptr = np.zeros(len(principals) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(members[p]) for p in principals])
+        indices = np.fromiter((pos for p in principals for pos in members[p]), dtype=np.int32, count=indptr[-1])
+        return cls(np.array(resources, dtype=str), np.array(principals, dtype=str), indptr, indices)
+
+    @classmethod
+    def from_collection(cls, collection, page_size: int = 1000) -> "PermissionIndex":
+        return cls.build(iter_metadatas(collection, page_size=page_size))
+
+    def acls(self) -> Dict[str, List[str]]:
+        """リソース -> プリンシパルの一覧（CSR を展開する）"""
+        resources = self.resources.tolist()
+        acl: Dict[str, List[str]] = {r: [] for r in resources}
+        owners = np.repeat(np.arange(len(self.principals)), np.diff(self.indptr))
+        for principal, pos in zip(self.principals[owners].tolist(), self.indices.tolist()):
+            acl[resources[pos]].append(principal)
+        return acl
+
+    def updated(self, changes: Dict[str, Optional[List[str]]]) -> "PermissionIndex":
+        """changes のリソースの ACL を置き換えた（None なら取り除いた）インデックスを返す"""
+        acl = self.acls()
+        for key, principals in changes.items():
+            if principals is None:
+                acl.pop(key, None)
+            else:
+                acl[key] = principals
+        return self.from_acls(acl)
+
+    def save(self, path: str = DEFAULT_INDEX_PATH):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, resources=self.resources, principals=self.principals,
+                 indptr=self.indptr, indices=self.indices)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_INDEX_PATH) -> "PermissionIndex":
+        with np.load(path) as data:
+            return cls(data["resources"], data["principals"], data["indptr"], data["indices"])
+
+    def visible_mask(self, principals: Iterable[str]) -> np.ndarray:
+        """リソースごとの閲覧可否（bool 配列）"""
+        mask = np.zeros(len(self.resources), dtype=bool)
+        for principal in principals:
+            i = self._principal_pos.get(principal)
+            if i is not None:
+                mask[self.indices[self.indptr[i]:self.indptr[i + 1]]] = True
+        return mask
+
+    def visible_resources(self, principals: Iterable[str]) -> List[str]:
+        return self.resources[self.visible_mask(principals)].tolist()
+
+    def candidate_mask(self, metadatas: List[Dict], principals: Iterable[str] = (),
+                       visible: Optional[np.ndarray] = None) -> np.ndarray:
+        """検索候補のメタデータ列に対する閲覧可否（インデックスにないリソースは不可）
+
+        visible（visible_mask の戻り値）を渡せば principals からマスクを作り直さない。
+        """
+        if visible is None:
+            visible = self.visible_mask(principals)
+        positions = np.array([self._resource_pos.get(resource_key(m), -1) for m in metadatas], dtype=np.int64)
+        return (positions >= 0) & visible[positions]
+
+    def where_filter(self, principals: Iterable[str] = (), visible: Optional[np.ndarray] = None) -> Optional[Dict]:
+        """閲覧可能なリソースだけに絞り込む Chroma の where 句。見られるものが無ければ None
+
+        where 句の大きさは閲覧可能なリソース数に比例するので、閲覧範囲の広いユーザーには
+        where 句を使わずに候補を多めに取り、candidate_mask で絞り込む（api.QueryService.search）。
+        """
+        if visible is None:
+            visible = self.visible_mask(principals)
+        return resource_where(self.resources[visible].tolist())
+
+
+def rebuild_permission_index(collection, path: str = DEFAULT_INDEX_PATH) -> PermissionIndex:
+    index = PermissionIndex.from_collection(collection)
+    index.save(path)
+    print(f"権限インデックスを更新しました: リソース {len(index.resources)}件 / プリンシパル {len(index.principals)}件")
+    return index
+
+
+def refresh_permission_index(collection, resources: Iterable[str], path: str = DEFAULT_INDEX_PATH,
+                             chunk_size: int = 100) -> PermissionIndex:
+    """差分取り込みで変更のあったリソースだけ ACL を読み直して、保存済みのインデックスを更新する
+
+    読むのは resources のレコードのメタデータだけ。インデックスがまだ無ければコレクション全体から作る。
+    レコードが残っていないリソースはインデックスから取り除く。
+    """
+    if not os.path.exists(path):
+        return rebuild_permission_index(collection, path)
+    resources = sorted(set(resources))
+    changes: Dict[str, Optional[List[str]]] = dict.fromkeys(resources)
+    for i in range(0, len(resources), chunk_size):
+        changes.update(latest_acls(iter_metadatas(collection, resource_where(resources[i:i + chunk_size]))))
+    index = PermissionIndex.load(path).updated(changes)
+    index.save(path)
+    print(f"権限インデックスを更新しました: 変更 {len(resources)}リソース"
+          f" / リソース {len(index.resources)}件 / プリンシパル {len(index.principals)}件")
+    return index
+
+
+if __name__ == "__main__":
+    import chromadb
+
+    client = chromadb.PersistentClient(path=".chroma")
+    rebuild_permission_index(client.get_collection("default"))
@@ -0,0 +1,34 @@
+# Slack / Google Drive 共通コレクション（.chroma の default）の設定
+#
+# 取り込み（googledrive_embedding_documents / googledrive_sync / slack_embedding_message / ingest_pipeline）と
+# 検索（api.py）は同じ埋め込みモデルを使わないと、違うモデルのベクトル同士の距離を比べることになる。
+# モデル名はここで1つだけ決め、コレクションのメタデータにも記録して、違うモデルで読み書きしたらエラーにする。
+
+from typing import Dict
+
+from embedding_cache import model_name
+
+PERSIST_DIRECTORY = ".chroma"
+COLLECTION_NAME = "default"
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# コレクションのメタデータに書く埋め込みモデル名のキー
+MODEL_METADATA_KEY = "embedding_model"
+
+
+def check_embedding_model(collection, embeddings, record: bool = False):
+    """collection に記録された埋め込みモデルが embeddings と同じか確かめる
+
+    record=True（書き込み側）では、まだ記録されていなければ embeddings のモデル名を記録する。
+    """
+    model = model_name(embeddings)
+    metadata: Dict = collection.metadata or {}
+    stored = metadata.get(MODEL_METADATA_KEY)
+    if stored is None:
+        if record:
+            # hnsw:* は作成後に変更できない（値は Chroma の設定に残る）ので、それ以外のメタデータに加える
+            collection.modify(metadata={**{k: v for k, v in metadata.items() if not k.startswith("hnsw:")},
+                                        MODEL_METADATA_KEY: model})
+        return
+    if stored != model:
+        raise ValueError(f"collection '{collection.name}' was embedded with {stored}, not {model}")
@@ -1,62 +1,234 @@
-# show_documents.py
-# 統一された表示プログラム（Google Drive, Slack, 今後の拡張も可能）
+# 共通コレクション（.chroma の default）の中身を確認・書き出す（Google Drive, Slack, AccessControlledVectorDB）
+#
+# limit/offset でページングしながら読むので、件数によらずメモリ使用量は1ページ分で、埋め込みの API も呼ばない。
+# source / channel は Chroma の where 句で、owner は読み込んだメタデータで絞り込む。
+#
+#   uv run show_chromadb.py                                  # 先頭から表示
+#   uv run show_chromadb.py --source slack --channel C0123 --limit 20
+#   uv run show_chromadb.py --owner alice@example.com --offset 100 --limit 50
+#   uv run show_chromadb.py --format jsonl --output export.jsonl
+#   uv run show_chromadb.py --format parquet --output export.parquet   # ページごとのファイルを置くディレクトリ
 
-from langchain.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
+import argparse
+import json
+import os
+import sys
+from typing import Dict, Iterator, List, Optional
 
-# ヘルパー関数
+PAGE_SIZE = 1000
 
-def format_permissions(perm_data):
-    if isinstance(perm_data, list):
-        return "\n".join(f"  - {p}" for p in perm_data)
-    elif isinstance(perm_data, str):
-        return f"  - {perm_data}"
-    else:
-        return "  - [Unknown format]"
-
-# Chroma 初期化（共通コレクション）
-embedding_model = OpenAIEmbeddings(model="text-embedding-3-small")
-vectorstore = Chroma(
-    collection_name="default",
-    embedding_function=embedding_model,
-    persist_directory=".chroma"
-)
-
-# ドキュメント取得（全件）
-documents = vectorstore.similarity_search("", k=100)
-print(f"Total documents: {len(documents)}\n")
-
-# ドキュメントごとの表示
-for i, doc in enumerate(documents):
-    meta = doc.metadata
-    source = meta.get("source", "unknown")
+# Parquet に書き出す列（メタデータの残りは metadata 列に JSON 文字列で入れる）
+PARQUET_COLUMNS = ["id", "source", "owner", "channel_id", "file_id", "document", "metadata"]
 
-    print(f"--- Document {i + 1} ---")
-    print(f"Source: {source}")
 
+def record_owners(meta: Dict) -> List[str]:
+    """レコードの所有者（Slack は投稿者、Drive は role=owner のメールアドレス、ACVDB は owner）"""
+    source = meta.get("source")
     if source == "slack":
-        print(f"Text: {doc.page_content}")
-        print("Metadata:")
-        print(f"  - Channel: {meta.get('channel')} ({meta.get('channel_type')})")
-        print(f"  - Posted By: {meta.get('posted_by')}")
-        print(f"  - Permitted Users (Saved):")
-        print(format_permissions(meta.get("permitted_users_saved")))
-        print(f"  - Permitted Users (Latest):")
-        print(format_permissions(meta.get("permitted_users_latest")))
+        return [meta["posted_by"]] if meta.get("posted_by") else []
+    if source == "google_drive":
+        try:
+            permissions = json.loads(meta.get("permissions", "[]"))
+        except json.JSONDecodeError:
+            return []
+        return [p.get("email", "") for p in permissions if isinstance(p, dict) and p.get("role") == "owner"]
+    return [meta["owner"]] if meta.get("owner") else []
+
+
+def build_where(source: Optional[str] = None, channel: Optional[str] = None) -> Optional[Dict]:
+    conditions = []
+    if source:
+        conditions.append({"source": source})
+    if channel:
+        conditions.append({"channel_id": channel})
+    if len(conditions) > 1:
+        return {"$and": conditions}
+    return conditions[0] if conditions else None
+
 
+def iter_records(collection, source: Optional[str] = None, channel: Optional[str] = None,
+                 owner: Optional[str] = None, offset: int = 0, limit: Optional[int] = None,
+                 page_size: int = PAGE_SIZE, include_documents: bool = True) -> Iterator[Dict]:
+    """条件に合うレコードを {id, document, metadata} として順に返す
+
+    offset / limit は絞り込んだ後のレコードに対する位置と件数。owner はメタデータで判定するので、
+    owner を指定した場合の offset はページを読み飛ばしながら数える。
+    """
+    where = build_where(source, channel)
+    include = ["documents", "metadatas"] if include_documents else ["metadatas"]
+    # owner で絞り込まない場合は offset をそのまま Chroma に渡せる
+    position, skip = (offset, 0) if owner is None else (0, offset)
+    emitted = 0
+    while limit is None or emitted < limit:
+        size = page_size if limit is None or owner is not None else min(page_size, limit - emitted)
+        page = collection.get(where=where, include=include, limit=size, offset=position)
+        if not page["ids"]:
+            break
+        position += len(page["ids"])
+        documents = page["documents"] if include_documents else [None] * len(page["ids"])
+        for id_, document, meta in zip(page["ids"], documents, page["metadatas"]):
+            meta = meta or {}
+            if owner is not None and owner not in record_owners(meta):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            yield {"id": id_, "document": document, "metadata": meta}
+            emitted += 1
+            if limit is not None and emitted >= limit:
+                return
+
+
+def format_permissions(meta: Dict) -> str:
+    """保存されている ACL（Slack は permitted_user_ids、Drive は permissions の JSON）"""
+    source = meta.get("source")
+    if source == "slack":
+        permitted = meta.get("permitted_user_ids", "")
+        return "\n".join(f"  - {uid}" for uid in permitted.split(",") if uid) or "  - (none)"
+    if source == "google_drive":
+        try:
+            permissions = json.loads(meta.get("permissions", "[]"))
+        except json.JSONDecodeError:
+            return "  - [Invalid format]"
+        return "\n".join(f"  - {p.get('type')}: {p.get('email', p.get('domain', 'N/A'))} ({p.get('role')})"
+                         for p in permissions) or "  - (none)"
+    return f"  - {meta.get('permissions', '[Unknown format]')}"
+
+
+def print_record(i: int, record: Dict, out=sys.stdout):
+    meta = record["metadata"]
+    source = meta.get("source", "unknown")
+    print(f"--- Document {i} ({record['id']}) ---", file=out)
+    print(f"Source: {source}", file=out)
+    if source == "slack":
+        print(f"Channel: {meta.get('channel_id')} ({meta.get('channel_type')})", file=out)
+        print(f"Posted By: {meta.get('posted_by')}  ts: {meta.get('ts')}", file=out)
     elif source == "google_drive":
-        print(f"File Name: {meta.get('file_name')}")
-        print(f"MIME Type: {meta.get('mime_type', 'unknown')}")
-        print(f"File ID: {meta.get('file_id')}")
-        print("Saved Permissions:")
-        print(format_permissions(meta.get("permissions_saved")))
-        print("Latest Permissions:")
-        print(format_permissions(meta.get("permissions_latest")))
-        print("\nSummary Text:")
-        print(f"{doc.page_content}")
+        print(f"File Name: {meta.get('file_name')}", file=out)
+        print(f"MIME Type: {meta.get('mime_type', 'unknown')}", file=out)
+        print(f"File ID: {meta.get('file_id')}  chunk: {meta.get('chunk_index', 0)}/{meta.get('chunk_count', 1)}",
+              file=out)
+    else:
+        print(f"Owner: {meta.get('owner')}  Group: {meta.get('group')}", file=out)
+    print("Saved Permissions:", file=out)
+    print(format_permissions(meta), file=out)
+    if record["document"] is not None:
+        print(f"Content:\n{record['document']}", file=out)
+    print(file=out)
+
+
+def write_jsonl(records: Iterator[Dict], out) -> int:
+    count = 0
+    for record in records:
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
 
+def _parquet_row(record: Dict) -> Dict:
+    meta = record["metadata"]
+    owners = record_owners(meta)
+    return {
+        "id": record["id"],
+        "source": meta.get("source"),
+        "owner": owners[0] if owners else None,
+        "channel_id": meta.get("channel_id"),
+        "file_id": meta.get("file_id"),
+        "document": record["document"],
+        "metadata": json.dumps(meta, ensure_ascii=False),
+    }
+
+
+def parquet_engine() -> str:
+    """DataFrame.to_parquet が使うエンジン（pyarrow / fastparquet）。どちらも無ければ ImportError"""
+    import importlib.util
+
+    for engine in ("pyarrow", "fastparquet"):
+        if importlib.util.find_spec(engine) is not None:
+            return engine
+    raise ImportError("--format parquet requires pyarrow (or fastparquet): uv sync / pip install pyarrow")
+
+
+def write_parquet(records: Iterator[Dict], directory: str, rows_per_file: int = 100000) -> int:
+    """rows_per_file 件ごとに directory/part-NNNNN.parquet を書く（pandas.read_parquet(directory) で読める）
+
+    records は読みながら書くので、エンジンが無い場合はレコードを読み始める前にエラーにする。
+    """
+    engine = parquet_engine()
+    import pandas as pd
+
+    os.makedirs(directory, exist_ok=True)
+    count = part = 0
+    rows = []
+
+    def flush():
+        nonlocal part
+        frame = pd.DataFrame(rows, columns=PARQUET_COLUMNS)
+        frame.to_parquet(os.path.join(directory, f"part-{part:05d}.parquet"), engine=engine, index=False)
+        part += 1
+        rows.clear()
+
+    for record in records:
+        rows.append(_parquet_row(record))
+        count += 1
+        if len(rows) >= rows_per_file:
+            flush()
+    if rows or not part:
+        flush()
+    return count
+
+
+def print_records(records: Iterator[Dict], out, start: int = 1) -> int:
+    count = 0
+    for count, record in enumerate(records, 1):
+        print_record(start + count - 1, record, out)
+    return count
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Chroma の共通コレクションの確認・書き出し")
+    parser.add_argument("--source", choices=["slack", "google_drive"], help="source で絞り込む")
+    parser.add_argument("--channel", help="Slack の channel_id で絞り込む")
+    parser.add_argument("--owner", help="所有者（Slack の投稿者 ID / Drive の owner のメールアドレス）で絞り込む")
+    parser.add_argument("--offset", type=int, default=0)
+    parser.add_argument("--limit", type=int, default=None, help="件数（表示の既定は 100 件、書き出しは全件）")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--format", choices=["text", "jsonl", "parquet"], default="text")
+    parser.add_argument("--output", help="出力先（parquet では必須のディレクトリ、省略時は標準出力）")
+    parser.add_argument("--no-documents", action="store_true", help="本文を読まない（メタデータのみ）")
+    parser.add_argument("--persist-directory", default=".chroma")
+    parser.add_argument("--collection", default="default")
+    args = parser.parse_args(argv)
+    if args.format == "parquet":
+        if not args.output:
+            parser.error("--format parquet requires --output")
+        try:
+            parquet_engine()
+        except ImportError as e:
+            parser.error(str(e))
+
+    import chromadb
+
+    collection = chromadb.PersistentClient(path=args.persist_directory).get_or_create_collection(args.collection)
+    limit = args.limit if args.limit is not None or args.format != "text" else 100
+    records = iter_records(collection, source=args.source, channel=args.channel, owner=args.owner,
+                           offset=args.offset, limit=limit, page_size=args.page_size,
+                           include_documents=not args.no_documents)
+
+    if args.format == "parquet":
+        count = write_parquet(records, args.output)
     else:
-        print("[!] Unknown source or unsupported document type.")
-        print(f"Content:\n{doc.page_content}")
+        out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+        try:
+            if args.format == "jsonl":
+                count = write_jsonl(records, out)
+            else:
+                count = print_records(records, out, start=args.offset + 1)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    print(f"{count} records (collection total: {collection.count()})", file=sys.stderr)
+
 
-    print("\n")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -2,69 +2,164 @@ from slack_sdk import WebClient
 from dotenv import load_dotenv
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
+from embedding_cache import CachedEmbeddings
+from instrumentation import Metrics
+from permission_index import refresh_permission_index, resource_key
+from shared_collection import COLLECTION_NAME, EMBEDDING_MODEL, PERSIST_DIRECTORY, check_embedding_model
+from slack_export import SlackScheduler, fetch_members, fetch_replies, is_thread_parent
+from slack_export import joined_channels as list_joined_channels
+import json
 import os
+import time
 
 load_dotenv()
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 client = WebClient(token=SLACK_BOT_TOKEN)
+# Tier ごとの呼び出し間隔と Retry-After を守って Slack API を呼ぶ
+scheduler = SlackScheduler(client)
 
-def fetch_messages(channel_id, channel_type, limit=100):
-    messages = client.conversations_history(channel=channel_id, limit=limit).get('messages', [])
-    members = client.conversations_members(channel=channel_id).get('members', [])
+# チャンネルごとに取り込み済みの最新 ts を保存するファイル
+# "threads" にはチャンネルごとに {スレッドの ts: 取り込み済みの最新の返信の ts} を保存する
+SYNC_STATE_PATH = ".slack_sync_state.json"
+
+# 最後の返信からこの日数が経ったスレッドは、差分取り込みで新しい返信を確認しない
+THREAD_WATCH_DAYS = 14
+
+def load_sync_state(path=SYNC_STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_sync_state(state, path=SYNC_STATE_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def message_id(channel_id, ts):
+    """再実行しても同じ ID になるので upsert で重複しない"""
+    return f"{channel_id}:{ts}"
+
+def fetch_messages(channel_id, channel_type, oldest=None, limit=200, threads=None, watch_days=THREAD_WATCH_DAYS):
+    """oldest より新しいメッセージとそのスレッド返信をページングしながらすべて取得する
+
+    取り込み済みのメッセージにも後から返信が付くので、履歴は watch_days 日前から読み直し、
+    親メッセージの latest_reply が threads（{スレッドの ts: 取り込み済みの最新の返信の ts}）より新しい
+    スレッドの返信も取得する。(結果, チャンネルの最新 ts, 更新後の threads) を返す。
+    """
+    cutoff = time.time() - watch_days * 86400
+    history_oldest = f"{min(float(oldest), cutoff):.6f}" if oldest else None
+    history = list(scheduler.pages("conversations_history", "messages",
+                                   channel=channel_id, limit=limit, oldest=history_oldest))
+    messages = [m for m in history if oldest is None or float(m["ts"]) > float(oldest)]
+    # 動きの無くなったスレッドは追跡をやめる（履歴を読み直す範囲から外れる）
+    threads = {ts: latest for ts, latest in (threads or {}).items() if float(latest) >= cutoff}
+    new_ts = {m["ts"] for m in messages}
+    replies = []
+    for m in history:
+        if not is_thread_parent(m):
+            continue
+        if m["ts"] in new_ts:
+            known = None  # 新しい親メッセージは返信をすべて取得する
+        else:
+            # 取り込み済みの親メッセージ。追跡していないスレッドは、親より後の返信をすべて取得する
+            known = threads.get(m["ts"], m["ts"])
+            if float(m.get("latest_reply", 0)) <= float(known):
+                continue
+        new_replies = [r for r in fetch_replies(scheduler, channel_id, m["ts"], oldest=known)
+                       if known is None or float(r["ts"]) > float(known)]
+        replies.extend(new_replies)
+        threads[m["ts"]] = max((r["ts"] for r in new_replies), key=float, default=known or m["ts"])
+    # 親メッセージが読み直す範囲より古く、最近も返信のあったスレッドは直接確認する
+    in_history = {m["ts"] for m in history}
+    for thread_ts, known in list(threads.items()):
+        if thread_ts in in_history:
+            continue
+        new_replies = [r for r in fetch_replies(scheduler, channel_id, thread_ts, oldest=known)
+                       if float(r["ts"]) > float(known)]
+        replies.extend(new_replies)
+        threads[thread_ts] = max((r["ts"] for r in new_replies), key=float, default=known)
+
+    members = fetch_members(scheduler, channel_id)
     permitted_str = ",".join(members)
 
     results = []
-    for m in messages:
+    for m in messages + replies:
         if not m.get("text"):
             continue
+        metadata = {
+            "source": "slack",
+            "channel_id": channel_id,
+            "channel_type": channel_type,
+            "permitted_user_ids": permitted_str,
+            "posted_by": m.get("user", "unknown"),
+            "ts": m["ts"]
+        }
+        if m.get("thread_ts"):
+            metadata["thread_ts"] = m["thread_ts"]
         results.append({
+            "id": message_id(channel_id, m["ts"]),
             "text": m["text"],
-            "metadata": {
-                "source": "slack",
-                "channel_id": channel_id,
-                "channel_type": channel_type,
-                "permitted_user_ids": permitted_str,
-                "posted_by": m.get("user", "unknown")
-            }
+            "metadata": metadata
         })
-    return results
+    # スレッド返信は親より新しい ts を持つことがあるので、チャンネルの履歴だけで進める
+    latest_ts = max((m["ts"] for m in messages), key=float, default=oldest)
+    return results, latest_ts, threads
+
+def joined_channels():
+    """Botが参加しているチャンネルの (channel_id, channel_name, channel_type) を返す"""
+    return list_joined_channels(scheduler)
 
-def embed_messages_from_all_joined_channels():
+def embed_messages_from_all_joined_channels(metrics=None):
+    # METRICS_FILE を指定すると、ステージごとの所要時間と件数を Prometheus 形式で書き出す
+    metrics = metrics or Metrics.from_env()
     print("チャンネル一覧を取得中...")
-    channels_response = client.conversations_list(types="public_channel,private_channel")
-    channels = channels_response.get("channels", [])
+    channels = joined_channels()
 
-    embedding_model = OpenAIEmbeddings()
+    # Drive と同じコレクションなので、同じ埋め込みモデルで書き込む
+    embedding_model = CachedEmbeddings(OpenAIEmbeddings(model=EMBEDDING_MODEL))
     vectorstore = Chroma(
-        collection_name="default",
+        collection_name=COLLECTION_NAME,
         embedding_function=embedding_model,
-        persist_directory=".chroma"
+        persist_directory=PERSIST_DIRECTORY
     )
+    check_embedding_model(vectorstore._collection, embedding_model, record=True)
+    sync_state = load_sync_state()
 
     total_embedded = 0
-    for ch in channels:
-        if not ch.get("is_member", False):
-            continue  # Botが参加していないチャンネルはスキップ
-
-        channel_id = ch["id"]
-        channel_name = ch.get("name", "unknown")
-        channel_type = "private" if ch.get("is_private", False) else "public"
-
+    touched = set()
+    for channel_id, channel_name, channel_type in channels:
         print(f"{channel_name} ({channel_id}) を処理中...")
 
-        data = fetch_messages(channel_id, channel_type)
-        if not data:
-            print("  メッセージが存在しません")
-            continue
+        with metrics.timer("ingest_stage_seconds", source="slack", stage="fetch"):
+            data, latest_ts, threads = fetch_messages(channel_id, channel_type, oldest=sync_state.get(channel_id),
+                                                      threads=sync_state.get("threads", {}).get(channel_id))
+        metrics.inc("ingest_records_total", len(data), source="slack", stage="fetch")
+        if data:
+            texts = [d["text"] for d in data]
+            metadatas = [d["metadata"] for d in data]
+            ids = [d["id"] for d in data]
 
-        texts = [d["text"] for d in data]
-        metadatas = [d["metadata"] for d in data]
+            with metrics.timer("ingest_stage_seconds", source="slack", stage="embed_write"):
+                vectorstore.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+            metrics.inc("ingest_records_total", len(texts), source="slack", stage="embed_write")
+            print(f"  {len(texts)}件を埋め込みました")
+            total_embedded += len(texts)
+            touched.update(resource_key(m) for m in metadatas)
+        else:
+            print("  新しいメッセージはありません")
 
-        vectorstore.add_texts(texts=texts, metadatas=metadatas)
-        print(f"  {len(texts)}件を埋め込みました")
-        total_embedded += len(texts)
+        if latest_ts:
+            sync_state[channel_id] = latest_ts
+        sync_state.setdefault("threads", {})[channel_id] = threads
+        save_sync_state(sync_state)
 
     print(f"合計 {total_embedded} 件のメッセージを Chroma に埋め込みました")
+    print(f"埋め込みキャッシュ: {embedding_model.stats()}")
+    # 新しいメッセージのあったチャンネルの ACL だけを読み直す
+    refresh_permission_index(vectorstore._collection, touched)
+    metrics.save()
 
 if __name__ == "__main__":
-    embed_messages_from_all_joined_channels()
\ No newline at end of file
+    embed_messages_from_all_joined_channels()
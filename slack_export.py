@@ -0,0 +1,245 @@
+# Slack の参加チャンネルの履歴・スレッド返信・メンバーをすべてエクスポートする
+#
+# - conversations_history / conversations_replies / conversations_members はすべてページングして取得する
+# - API メソッドごとに Slack の Tier に合わせたトークンバケットで呼び出し間隔を制御し、
+#   429 が返ったら Retry-After の秒数だけそのメソッドの呼び出しを止めてから再試行する
+# - チャンネル単位で並列に取得し、ページごとにチェックポイントを書き出すので、
+#   途中で落ちても再実行すれば続きから再開できる
+#
+#   uv run slack_export.py                   # .slack_export/ に出力
+#   uv run slack_export.py --workers 8
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from slack_identity import iter_pages
+
+EXPORT_DIRECTORY = ".slack_export"
+
+# 1分あたりの呼び出し上限（https://api.slack.com/apis/rate-limits）
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    "conversations_list": 2,
+    "users_list": 2,
+    "conversations_history": 3,
+    "conversations_replies": 3,
+    "conversations_info": 3,
+    "conversations_members": 4,
+}
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット。トークンが足りなければ前借りして、その分だけ待つ"""
+
+    def __init__(self, per_minute: float, burst: int = 5):
+        self.rate = per_minute / 60
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.blocked_until - now, 0.0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, seconds: float):
+        """Retry-After を受け取ったら、その間はこのメソッドを誰も呼ばないようにする"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class SlackScheduler:
+    def __init__(self, client: WebClient, tier_limits: Dict[int, float] = TIER_LIMITS, burst: int = 5,
+                 max_retries: int = 5):
+        self.client = client
+        self.tier_limits = tier_limits
+        self.burst = burst
+        self.max_retries = max_retries
+        self.calls = 0
+        self.rate_limited = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, method: str) -> TokenBucket:
+        with self._lock:
+            if method not in self._buckets:
+                per_minute = self.tier_limits[METHOD_TIERS.get(method, 3)]
+                self._buckets[method] = TokenBucket(per_minute, self.burst)
+            return self._buckets[method]
+
+    def call(self, method: str, **kwargs):
+        bucket = self._bucket(method)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            with self._lock:
+                self.calls += 1
+            try:
+                return getattr(self.client, method)(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+                with self._lock:
+                    self.rate_limited += 1
+                print(f"  {method} がレート制限されました。{retry_after:.0f}秒待って再試行します")
+                bucket.block(retry_after)
+
+    def pages(self, method: str, key: str, **kwargs) -> Iterator[Dict]:
+        return iter_pages(partial(self.call, method), key, **kwargs)
+
+
+def is_thread_parent(message: Dict) -> bool:
+    return bool(message.get("reply_count")) and message.get("thread_ts") == message.get("ts")
+
+
+def fetch_replies(scheduler: SlackScheduler, channel_id: str, thread_ts: str,
+                  oldest: Optional[str] = None) -> List[Dict]:
+    """スレッドの返信（親メッセージは除く）。oldest を指定するとそれ以降の返信だけ"""
+    kwargs = {"oldest": oldest} if oldest else {}
+    replies = scheduler.pages("conversations_replies", "messages", channel=channel_id, ts=thread_ts, limit=200,
+                              **kwargs)
+    return [r for r in replies if r.get("ts") != thread_ts]
+
+
+def fetch_members(scheduler: SlackScheduler, channel_id: str) -> List[str]:
+    return list(scheduler.pages("conversations_members", "members", channel=channel_id, limit=1000))
+
+
+def joined_channels(scheduler: SlackScheduler):
+    """Botが参加しているチャンネルの (channel_id, channel_name, channel_type) を返す"""
+    joined = []
+    for ch in scheduler.pages("conversations_list", "channels", types="public_channel,private_channel", limit=1000):
+        if not ch.get("is_member", False):
+            continue  # Botが参加していないチャンネルはスキップ
+        channel_type = "private" if ch.get("is_private", False) else "public"
+        joined.append((ch["id"], ch.get("name", "unknown"), channel_type))
+    return joined
+
+
+class SlackExporter:
+    """チャンネルごとに <export_dir>/<channel_id>.jsonl（メッセージ）と .state.json（チェックポイント）を書き出す"""
+
+    def __init__(self, scheduler: SlackScheduler, export_dir: str = EXPORT_DIRECTORY, max_workers: int = 4,
+                 page_size: int = 200):
+        self.scheduler = scheduler
+        self.export_dir = export_dir
+        self.max_workers = max_workers
+        self.page_size = page_size
+        os.makedirs(export_dir, exist_ok=True)
+
+    def _path(self, channel_id: str, suffix: str) -> str:
+        return os.path.join(self.export_dir, f"{channel_id}{suffix}")
+
+    def load_state(self, channel_id: str) -> Optional[Dict]:
+        path = self._path(channel_id, ".state.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_state(self, state: Dict):
+        path = self._path(state["channel_id"], ".state.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def _append(self, channel_id: str, messages: List[Dict]):
+        # チェックポイントより先に書くので、再開時に同じページを取り直すと重複し得る（読み込み時に ts で除く）
+        with open(self._path(channel_id, ".jsonl"), "a", encoding="utf-8") as f:
+            for m in messages:
+                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+
+    def export_channel(self, channel_id: str, channel_name: str, channel_type: str) -> Dict:
+        state = self.load_state(channel_id) or {
+            "channel_id": channel_id,
+            "channel_name": channel_name,
+            "channel_type": channel_type,
+            "members": None,
+            "history_cursor": None,
+            "history_done": False,
+            "pending_threads": [],
+            "messages": 0,
+            "done": False,
+        }
+        if state["done"]:
+            return state
+
+        if state["members"] is None:
+            state["members"] = fetch_members(self.scheduler, channel_id)
+            self._save_state(state)
+
+        while not state["history_done"]:
+            response = self.scheduler.call("conversations_history", channel=channel_id, limit=self.page_size,
+                                           cursor=state["history_cursor"])
+            messages = response.get("messages", [])
+            self._append(channel_id, messages)
+            state["messages"] += len(messages)
+            state["pending_threads"] += [m["ts"] for m in messages if is_thread_parent(m)]
+            state["history_cursor"] = response.get("response_metadata", {}).get("next_cursor") or None
+            state["history_done"] = state["history_cursor"] is None
+            self._save_state(state)
+
+        while state["pending_threads"]:
+            thread_ts = state["pending_threads"][0]
+            replies = fetch_replies(self.scheduler, channel_id, thread_ts)
+            self._append(channel_id, replies)
+            state["messages"] += len(replies)
+            state["pending_threads"].pop(0)
+            self._save_state(state)
+
+        state["done"] = True
+        self._save_state(state)
+        print(f"{channel_name} ({channel_id}): {state['messages']}件 / メンバー {len(state['members'])}人")
+        return state
+
+    def export_all(self, channels=None) -> List[Dict]:
+        channels = channels if channels is not None else joined_channels(self.scheduler)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda ch: self.export_channel(*ch), channels))
+
+    def read_channel(self, channel_id: str) -> List[Dict]:
+        """エクスポート済みメッセージ（ts で重複を除いたもの）"""
+        messages = {}
+        path = self._path(channel_id, ".jsonl")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    m = json.loads(line)
+                    messages[m["ts"]] = m
+        return sorted(messages.values(), key=lambda m: float(m["ts"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Slack の履歴・スレッド・メンバーのエクスポート")
+    parser.add_argument("--export-dir", default=EXPORT_DIRECTORY)
+    parser.add_argument("--workers", type=int, default=4, help="並列に処理するチャンネル数")
+    args = parser.parse_args()
+
+    load_dotenv()
+    scheduler = SlackScheduler(WebClient(token=os.getenv("SLACK_BOT_TOKEN")))
+    exporter = SlackExporter(scheduler, export_dir=args.export_dir, max_workers=args.workers)
+    states = exporter.export_all()
+    print(f"{len(states)}チャンネル / {sum(s['messages'] for s in states)}件をエクスポートしました"
+          f"（API 呼び出し {scheduler.calls}回 / レート制限 {scheduler.rate_limited}回）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Slack のユーザー名・チャンネル名・チャンネルメンバーをまとめて取得してキャッシュする
+#
+# メッセージ単位で users_info / conversations_members を呼ぶ代わりに、
+# users_list を1回、メンバー一覧はチャンネルごとに1回だけ取得する。
+# 結果は TTL 付きでディスクに保存し、次回以降の実行でも使い回す。
+
+import json
+import os
+import time
+from typing import Dict, Iterator, List
+
+SLACK_IDENTITY_CACHE_PATH = ".slack_identity_cache.json"
+
+
+def iter_pages(method, key: str, **kwargs) -> Iterator[Dict]:
+    """cursor をたどって Slack API の全ページの key の要素を返す"""
+    cursor = None
+    while True:
+        response = method(cursor=cursor, **kwargs)
+        yield from response.get(key, [])
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            break
+
+
+def display_name(user: Dict) -> str:
+    return user.get("real_name") or user.get("profile", {}).get("real_name") or user.get("name") or user["id"]
+
+
+class SlackDirectory:
+    def __init__(self, client, path: str = SLACK_IDENTITY_CACHE_PATH, ttl: float = 3600.0):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.api_calls = 0
+        self._cache = self._load()
+
+    def _load(self) -> Dict:
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        return {"users": None, "channels": None, "members": {}}
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _fresh(self, entry) -> bool:
+        return entry is not None and time.time() - entry["fetched_at"] < self.ttl
+
+    def _call(self, method):
+        def counted(**kwargs):
+            self.api_calls += 1
+            return method(**kwargs)
+        return counted
+
+    def user_names(self) -> Dict[str, str]:
+        """ユーザー ID -> 表示名（users_list を全ページ取得）"""
+        if not self._fresh(self._cache["users"]):
+            users = iter_pages(self._call(self.client.users_list), "members", limit=1000)
+            self._cache["users"] = {"fetched_at": time.time(), "data": {u["id"]: display_name(u) for u in users}}
+        return self._cache["users"]["data"]
+
+    def channel_names(self) -> Dict[str, str]:
+        if not self._fresh(self._cache["channels"]):
+            channels = iter_pages(self._call(self.client.conversations_list), "channels",
+                                  types="public_channel,private_channel", limit=1000)
+            self._cache["channels"] = {"fetched_at": time.time(), "data": {c["id"]: c["name"] for c in channels}}
+        return self._cache["channels"]["data"]
+
+    def channel_members(self, channel_id: str) -> List[str]:
+        """チャンネルのメンバー ID の一覧
+
+        取得に失敗した場合はキャッシュしない（空のメンバー一覧を保存すると、TTL の間メンバーがいないことになる）。
+        期限切れでも以前の値があればそれを返し、無ければ例外をそのまま送出する。
+        """
+        entry = self._cache["members"].get(channel_id)
+        if not self._fresh(entry):
+            try:
+                members = list(iter_pages(self._call(self.client.conversations_members), "members",
+                                          channel=channel_id, limit=1000))
+            except Exception:
+                if entry is None:
+                    raise
+                return entry["data"]
+            entry = self._cache["members"][channel_id] = {"fetched_at": time.time(), "data": members}
+        return entry["data"]
+
+    def user_name(self, user_id: str) -> str:
+        return self.user_names().get(user_id, user_id)
+
+    def channel_name(self, channel_id: str) -> str:
+        return self.channel_names().get(channel_id, channel_id)
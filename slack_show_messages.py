@@ -1,60 +1,50 @@
 import os
 from dotenv import load_dotenv
 from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
 
+from shared_collection import COLLECTION_NAME, EMBEDDING_MODEL, PERSIST_DIRECTORY
+from show_chromadb import iter_records
+from slack_identity import SlackDirectory
+
 load_dotenv()
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 client = WebClient(token=SLACK_BOT_TOKEN)
 
-# キャッシュ用
-user_cache = {}
-channel_cache = {}
+# ユーザー名・チャンネル名・メンバー一覧はまとめて取得し、.slack_identity_cache.json に TTL 付きで保存する
+directory = SlackDirectory(client)
+
+PAGE_SIZE = 1000
 
 def get_user_name(user_id):
-    if user_id in user_cache:
-        return user_cache[user_id]
-    try:
-        info = client.users_info(user=user_id)
-        name = info["user"]["real_name"]
-        user_cache[user_id] = name
-        return name
-    except Exception:
-        return user_id
+    return directory.user_name(user_id)
 
 def get_channel_name(channel_id):
-    if channel_id in channel_cache:
-        return channel_cache[channel_id]
-    try:
-        info = client.conversations_info(channel=channel_id)
-        name = info["channel"]["name"]
-        channel_cache[channel_id] = name
-        return name
-    except Exception:
-        return channel_id
+    return directory.channel_name(channel_id)
 
 def get_latest_channel_members(channel_id):
     try:
-        response = client.conversations_members(channel=channel_id)
-        return [get_user_name(uid) for uid in response.get("members", [])]
-    except Exception:
-        return []
+        return [get_user_name(uid) for uid in directory.channel_members(channel_id)]
+    except SlackApiError as e:
+        return [f"(取得できませんでした: {e.response.get('error')})"]
+
+def iter_slack_records(vectorstore, page_size=PAGE_SIZE):
+    for record in iter_records(vectorstore, source="slack", page_size=page_size):
+        yield record["document"], record["metadata"]
 
 def display_embeddings():
     vectorstore = Chroma(
-        collection_name="default",
-        embedding_function=OpenAIEmbeddings(),
-        persist_directory=".chroma"
+        collection_name=COLLECTION_NAME,
+        embedding_function=OpenAIEmbeddings(model=EMBEDDING_MODEL),
+        persist_directory=PERSIST_DIRECTORY
     )
 
     print("Chroma に保存された Slack メッセージの埋め込み内容を確認します...")
 
-    results = vectorstore.get(include=["documents", "metadatas"])
-    documents = results["documents"]
-    metadatas = results["metadatas"]
-
-    for i, (doc, meta) in enumerate(zip(documents, metadatas), 1):
+    latest_members = {}
+    for i, (doc, meta) in enumerate(iter_slack_records(vectorstore), 1):
         channel_id = meta.get("channel_id", "N/A")
         channel_name = get_channel_name(channel_id)
         channel_type = meta.get("channel_type", "N/A")
@@ -62,7 +52,8 @@ def display_embeddings():
         permitted_raw = meta.get("permitted_user_ids", "")
         permitted_list = permitted_raw.split(",") if permitted_raw else []
         permitted_names = [get_user_name(uid) for uid in permitted_list]
-        latest_members = get_latest_channel_members(channel_id)
+        if channel_id not in latest_members:
+            latest_members[channel_id] = get_latest_channel_members(channel_id)
 
         print(f"--- Slack Document {i} ---")
         print(f"Text: {doc}")
@@ -71,7 +62,10 @@ def display_embeddings():
         print(f"  - Channel Type: {channel_type}")
         print(f"  - Posted By: {posted_by}")
         print(f"  - Permitted Users (Saved): {', '.join(permitted_names)}")
-        print(f"  - Permitted Users (Latest): {', '.join(latest_members)}\n")
+        print(f"  - Permitted Users (Latest): {', '.join(latest_members[channel_id])}\n")
+
+    directory.save()
+    print(f"Slack API 呼び出し: {directory.api_calls}回")
 
 if __name__ == "__main__":
-    display_embeddings()
\ No newline at end of file
+    display_embeddings()
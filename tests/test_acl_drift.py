@@ -0,0 +1,49 @@
+import chromadb
+from slack_sdk.errors import SlackApiError
+
+from acl_drift import apply_fixes, diff_acls, fixed_resources, stored_acls
+
+
+def make_collection(tmp_path):
+    collection = chromadb.PersistentClient(path=str(tmp_path)).get_or_create_collection("default")
+    collection.add(
+        ids=["s1", "s2", "s3", "d1"],
+        embeddings=[[0.0, 1.0]] * 4,
+        metadatas=[
+            {"source": "slack", "channel_id": "C1", "permitted_user_ids": "U1,U2"},
+            {"source": "slack", "channel_id": "C1", "permitted_user_ids": "U2,U1"},
+            {"source": "slack", "channel_id": "C2", "permitted_user_ids": "U1"},
+            {"source": "google_drive", "file_id": "F1",
+             "permissions": '[{"type": "user", "email": "alice@example.com"}]'},
+        ],
+    )
+    return collection
+
+
+def test_member_order_is_not_drift(tmp_path):
+    resources = stored_acls(make_collection(tmp_path))
+    assert diff_acls(resources, {"slack:C1": "U2,U1"}) == []
+
+    drift = diff_acls(resources, {"slack:C1": "U1,U3"})
+    assert [(d["status"], d["stale_records"], d["added"], d["removed"]) for d in drift] == [
+        ("changed", 2, ["slack:U3"], ["slack:U2"]),
+    ]
+
+
+def test_missing_resources_are_cleared_or_deleted(tmp_path):
+    collection = make_collection(tmp_path)
+    resources = stored_acls(collection)
+    gone = SlackApiError("not_in_channel", {"ok": False, "error": "not_in_channel"})
+    drift = diff_acls(resources, {"slack:C1": "U1,U2", "slack:C2": gone})
+    assert [(d["resource"], d["status"]) for d in drift] == [("slack:C2", "missing")]
+
+    assert fixed_resources(drift, "keep") == []
+    assert apply_fixes(collection, resources, drift, "keep") == {"updated": 0, "cleared": 0, "deleted": 0}
+
+    assert apply_fixes(collection, resources, drift) == {"updated": 0, "cleared": 1, "deleted": 0}
+    assert collection.get(ids=["s3"])["metadatas"][0]["permitted_user_ids"] == ""
+
+    assert fixed_resources(drift, "delete") == ["slack:C2"]
+    assert apply_fixes(collection, resources, drift, "delete") == {"updated": 0, "cleared": 0, "deleted": 1}
+    assert collection.get(ids=["s3"])["ids"] == []
+    assert collection.count() == 3
@@ -0,0 +1,102 @@
+import json
+
+import chromadb
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+from embedding_backends import HashingEmbeddings
+from permission_index import rebuild_permission_index
+from shared_collection import check_embedding_model
+
+
+@pytest.fixture
+def client(tmp_path):
+    groups_path = tmp_path / "groups.json"
+    groups_path.write_text(json.dumps({"eng@example.com": ["alice@example.com"]}), encoding="utf-8")
+    index_path = str(tmp_path / "index.npz")
+    embeddings = HashingEmbeddings(size=64)
+    service = api.QueryService(persist_directory=str(tmp_path / "chroma"), index_path=index_path,
+                               embeddings=embeddings, groups_path=str(groups_path))
+    permissions = json.dumps([{"type": "group", "email": "eng@example.com", "role": "reader"}])
+    service.collection.add(
+        ids=["F1:0"],
+        documents=["設計メモ"],
+        embeddings=embeddings.embed_documents(["設計メモ"]),
+        metadatas=[{"source": "google_drive", "file_id": "F1", "modified_time": "2025-01-01",
+                    "permissions": permissions}],
+    )
+    rebuild_permission_index(service.collection, index_path)
+    api.app.state.service = service
+    api.app.state.auth = api.TrustedProxyAuth(secret="s3cret")
+    return TestClient(api.app)
+
+
+def search(client, **headers):
+    return client.get("/search", params={"q": "設計"}, headers=headers)
+
+
+def test_requests_without_proxy_identity_are_rejected(client):
+    assert search(client).status_code == 401
+    assert search(client, **{"X-Forwarded-Email": "alice@example.com"}).status_code == 401
+    assert search(client, **{"X-Forwarded-Email": "alice@example.com", "X-Proxy-Secret": "wrong"}).status_code == 401
+    assert search(client, **{"X-Proxy-Secret": "s3cret"}).status_code == 401
+
+
+def test_groups_come_from_server_side_directory(client):
+    member = search(client, **{"X-Forwarded-Email": "alice@example.com", "X-Proxy-Secret": "s3cret"})
+    assert [hit["id"] for hit in member.json()["results"]] == ["F1:0"]
+    # クライアントが送ったグループは使わない
+    outsider = search(client, **{"X-Forwarded-Email": "bob@example.com", "X-Proxy-Secret": "s3cret",
+                                 "X-User-Groups": "eng@example.com"})
+    assert outsider.status_code == 200 and outsider.json()["results"] == []
+
+
+def test_service_refuses_collection_embedded_with_another_model(tmp_path):
+    persist_directory = str(tmp_path / "chroma")
+    collection = chromadb.PersistentClient(path=persist_directory).get_or_create_collection(api.COLLECTION_NAME)
+    check_embedding_model(collection, HashingEmbeddings(size=64, seed=1), record=True)
+    with pytest.raises(ValueError, match="embedded with"):
+        api.QueryService(persist_directory=persist_directory, index_path=str(tmp_path / "index.npz"),
+                         embeddings=HashingEmbeddings(size=64))
+
+
+def test_wide_visibility_filters_after_ranking(tmp_path, monkeypatch):
+    embeddings = HashingEmbeddings(size=64)
+    index_path = str(tmp_path / "index.npz")
+    service = api.QueryService(persist_directory=str(tmp_path / "chroma"), index_path=index_path,
+                               embeddings=embeddings)
+    public = json.dumps([{"type": "anyone", "role": "reader"}])
+    private = json.dumps([{"type": "user", "email": "alice@example.com", "role": "owner"}])
+    texts = [f"設計メモ {i}" for i in range(60)]
+    service.collection.add(
+        ids=[f"F{i}:0" for i in range(60)],
+        documents=texts,
+        embeddings=embeddings.embed_documents(texts),
+        metadatas=[{"source": "google_drive", "file_id": f"F{i}", "modified_time": "2025-01-01",
+                    "permissions": private if i % 3 else public} for i in range(60)],
+    )
+    rebuild_permission_index(service.collection, index_path)
+
+    queries = []
+    query = service.collection.query
+
+    def spy(**kwargs):
+        queries.append(kwargs)
+        return query(**kwargs)
+
+    monkeypatch.setattr(service.collection, "query", spy)
+    expected = {}
+    monkeypatch.setattr(api, "WHERE_MAX_RESOURCES", 1000)
+    for email in ("alice@example.com", "bob@example.com"):
+        expected[email] = [hit.id for hit in service.search("設計メモ 7", email, top_k=5).results]
+    assert all("where" in q for q in queries)
+    assert len(expected["bob@example.com"]) == 5
+
+    queries.clear()
+    monkeypatch.setattr(api, "WHERE_MAX_RESOURCES", 0)
+    monkeypatch.setattr(api, "POOL_FACTOR", 2)
+    for email in ("alice@example.com", "bob@example.com"):
+        assert [hit.id for hit in service.search("設計メモ 7", email, top_k=5).results] == expected[email]
+    # 閲覧範囲が広いと where 句を使わずに候補を広げて取り直す
+    assert not any("where" in q for q in queries)
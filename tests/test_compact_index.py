@@ -0,0 +1,27 @@
+import pytest
+
+from embedding_backends import HashingEmbeddings
+from main import AccessControlledVectorDB, User, create_sample_data
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_user_who_can_read_nothing(sharded):
+    docs, users = create_sample_data()
+    private = [d for d in docs if not d.permissions["other"]]
+    db = AccessControlledVectorDB("compact_blind", embeddings=HashingEmbeddings(size=64), keep_documents=False,
+                                  result_cache_size=0, sharded=sharded)
+    db.audit.sample_rate = 0
+    db.add_documents(private)
+    db.build_compact_index("int8")
+    nobody = User("nobody", set())
+
+    assert db.search("設計書", nobody) == []
+    assert db.search_many("設計書", [nobody], top_k=3) == {"nobody": []}
+    assert db.search_batch(["設計書", "API"], [nobody], top_k=3) == [{"nobody": []}, {"nobody": []}]
+
+    # 読める文書のあるユーザーと一緒に検索しても、そのユーザーの結果は変わらない
+    alice = next(u for u in users if u.user_id == "alice")
+    many = db.search_many("設計書", [nobody, alice], top_k=3)
+    assert many["nobody"] == []
+    assert many["alice"] == db.search("設計書", alice, top_k=3)
+    assert many["alice"]
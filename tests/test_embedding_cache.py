@@ -0,0 +1,24 @@
+from embedding_cache import QueryEmbeddingCache
+
+
+class RecordingEmbeddings:
+    model = "recording"
+
+    def __init__(self):
+        self.queries = []
+
+    def embed_query(self, text):
+        self.queries.append(text)
+        return [float(len(text))]
+
+
+def test_embeds_original_query_and_shares_normalized_key():
+    embeddings = RecordingEmbeddings()
+    cache = QueryEmbeddingCache(embeddings)
+    first = cache.embed_query("ＡＰＩ　の認証")
+    assert embeddings.queries == ["ＡＰＩ　の認証"]
+
+    # 正規化すると同じクエリはキャッシュから返す
+    assert cache.embed_query("API の認証") == first
+    assert embeddings.queries == ["ＡＰＩ　の認証"]
+    assert (cache.hits, cache.misses) == (1, 1)
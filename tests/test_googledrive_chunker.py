@@ -0,0 +1,49 @@
+from googledrive_chunker import DocsChunker
+
+
+class ByteEncoding:
+    """tiktoken の代わりに UTF-8 の1バイトを1トークンとして数える"""
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode_bytes(self, tokens):
+        return bytes(tokens)
+
+
+def make_document(paragraphs):
+    return {"body": {"content": [
+        {"paragraph": {
+            "elements": [{"textRun": {"content": text + "\n"}}],
+            "paragraphStyle": {"namedStyleType": "HEADING_1" if heading else "NORMAL_TEXT"},
+        }}
+        for heading, text in paragraphs
+    ]}}
+
+
+def make_chunker(max_tokens=20, overlap_tokens=5):
+    chunker = DocsChunker(max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+    chunker._encoding = ByteEncoding()
+    return chunker
+
+
+def test_heading_is_not_flushed_alone_before_long_paragraph():
+    chunks = list(make_chunker().chunk(make_document([(True, "H1"), (False, "x" * 50)])))
+    assert chunks[0]["text"].startswith("H1\nx")
+    assert all(chunk["text"] != "H1" for chunk in chunks)
+    assert sum(chunk["text"].startswith("H1") for chunk in chunks) == 1
+    assert [chunk["chunk_index"] for chunk in chunks] == list(range(len(chunks)))
+
+
+def test_no_overlap_only_chunk():
+    chunker = make_chunker()
+    chunks = list(chunker.chunk(make_document([(True, "H2"), (False, "y" * 8), (False, "z" * 15)])))
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert not previous["text"].endswith(chunk["text"])
+
+
+def test_sections_and_budget():
+    chunks = list(make_chunker().chunk(make_document(
+        [(True, "A"), (False, "a" * 10), (True, "B"), (False, "b" * 10), (False, "c" * 10)])))
+    assert [chunk["section"] for chunk in chunks] == ["A", "B", "B"]
+    assert all(len(chunk["text"].encode("utf-8")) <= 20 for chunk in chunks)
@@ -0,0 +1,118 @@
+import chromadb
+import pytest
+
+import googledrive_sync
+from embedding_backends import HashingEmbeddings
+from googledrive_embedding_documents import DOCUMENT_MIME_TYPE, FOLDER_MIME_TYPE
+
+PERMISSIONS = [{"type": "user", "emailAddress": "alice@example.com", "role": "owner"}]
+
+
+class FakeDrive:
+    """フォルダ -> 親、ファイル -> 親 だけを持つ Drive"""
+
+    def __init__(self, folders, files):
+        self.folders = dict(folders)
+        self.files = dict(files)
+        self.changes = []
+
+
+class FakeCrawler:
+    max_workers = 2
+
+    def __init__(self, drive):
+        self.drive = drive
+        self.visited_folders = set()
+        self.folder_parents = {}
+
+    def get_start_page_token(self):
+        return "token"
+
+    def list_changes(self, page_token):
+        return self.drive.changes, "next-token"
+
+    def list_permissions(self, file_id):
+        return PERMISSIONS
+
+    def fetch_file(self, file):
+        return {"id": file["id"], "name": file["id"], "mimeType": DOCUMENT_MIME_TYPE, "modifiedTime": "1",
+                "parents": file.get("parents", []), "permissions": PERMISSIONS,
+                "chunks": [{"text": f"{file['id']} の本文", "section": "", "chunk_index": 0}]}
+
+    def crawl(self, folder_id):
+        folders = [folder_id]
+        while folders:
+            current = folders.pop()
+            self.visited_folders.add(current)
+            for child, parent in self.drive.folders.items():
+                if parent == current:
+                    self.folder_parents[child] = current
+                    folders.append(child)
+            for file_id, parent in self.drive.files.items():
+                if parent == current:
+                    yield self.fetch_file({"id": file_id, "parents": [current]})
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self.client = chromadb.EphemeralClient()
+        self._collection = self.client.get_or_create_collection("drive-sync-test")
+        self.embeddings = HashingEmbeddings(size=32)
+
+    def add_texts(self, texts, metadatas, ids):
+        self._collection.upsert(ids=ids, documents=texts, metadatas=metadatas,
+                                embeddings=self.embeddings.embed_documents(texts))
+
+
+def stored_files(vectorstore):
+    return {meta["file_id"] for meta in vectorstore._collection.get(include=["metadatas"])["metadatas"]}
+
+
+@pytest.fixture
+def vectorstore(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # 権限インデックスは作業ディレクトリに書かれる
+    store = FakeVectorStore()
+    yield store
+    store.client.delete_collection(store._collection.name)
+
+
+def folder_change(folder_id, parent):
+    return {"fileId": folder_id, "file": {"id": folder_id, "mimeType": FOLDER_MIME_TYPE, "parents": [parent]}}
+
+
+def test_folder_moves_add_and_remove_their_subtrees(vectorstore):
+    # root/A/D と、対象外の X/B/C
+    drive = FakeDrive(folders={"A": "root", "D": "A", "B": "X", "C": "B"},
+                      files={"a1": "A", "d1": "D", "b1": "B", "c1": "C"})
+    state = googledrive_sync.full_sync(FakeCrawler(drive), vectorstore, "root")
+    assert stored_files(vectorstore) == {"a1", "d1"}
+    assert set(state["folder_ids"]) == {"root", "A", "D"}
+
+    # A を対象外へ、B を対象内へ移動する（配下のファイル自体には変更が無い）
+    drive.folders.update(A="X", B="root")
+    drive.changes = [folder_change("A", "X"), folder_change("B", "root")]
+    state = googledrive_sync.incremental_sync(FakeCrawler(drive), vectorstore, state)
+    assert stored_files(vectorstore) == {"b1", "c1"}
+    assert set(state["folder_ids"]) == {"root", "B", "C"}
+    assert state["folder_parents"] == {"B": "root", "C": "B"}
+
+    # B をゴミ箱に入れると配下のファイルも消える
+    drive.changes = [{"fileId": "B", "file": {"id": "B", "mimeType": FOLDER_MIME_TYPE, "parents": ["root"],
+                                               "trashed": True}}]
+    state = googledrive_sync.incremental_sync(FakeCrawler(drive), vectorstore, state)
+    assert stored_files(vectorstore) == set()
+    assert state["folder_ids"] == ["root"]
+
+
+def test_file_moved_between_tracked_folders_updates_folder_id(vectorstore):
+    drive = FakeDrive(folders={"A": "root", "B": "root"}, files={"f": "A"})
+    state = googledrive_sync.full_sync(FakeCrawler(drive), vectorstore, "root")
+    drive.files["f"] = "B"
+    drive.changes = [{"fileId": "f", "file": {"id": "f", "mimeType": DOCUMENT_MIME_TYPE, "modifiedTime": "1",
+                                               "parents": ["B"]}}]
+    state = googledrive_sync.incremental_sync(FakeCrawler(drive), vectorstore, state)
+
+    drive.folders["A"] = "X"
+    drive.changes = [folder_change("A", "X")]
+    googledrive_sync.incremental_sync(FakeCrawler(drive), vectorstore, state)
+    assert stored_files(vectorstore) == {"f"}
@@ -0,0 +1,46 @@
+import googledrive_sync
+from ingest_pipeline import drive_source, save_drive_retries
+
+PERMISSIONS = [{"type": "user", "emailAddress": "alice@example.com", "role": "owner"}]
+
+
+class FakeCrawler:
+    def __init__(self, files):
+        self.files = files
+        self.visited_folders = {"root"}
+        self.folder_parents = {}
+
+    def crawl(self, folder_id):
+        yield from self.files
+
+
+def drive_file(file_id, **extra):
+    return {"id": file_id, "name": f"{file_id}.doc", "mimeType": "application/vnd.google-apps.document",
+            "modifiedTime": "2026-01-01T00:00:00Z", "parents": ["root"], "permissions": PERMISSIONS, **extra}
+
+
+def test_drive_source_skips_files_that_failed_to_fetch():
+    crawler = FakeCrawler([
+        drive_file("ok", chunks=[{"text": "本文", "section": "", "chunk_index": 0}]),
+        drive_file("broken", error="HttpError: 500"),
+    ])
+    failed = []
+    items = list(drive_source(crawler, "root", failed))
+    assert [item.replace_where for item in items] == [{"file_id": "ok"}]
+    assert failed == [{"id": "broken", "name": "broken.doc", "mimeType": "application/vnd.google-apps.document",
+                       "modifiedTime": "2026-01-01T00:00:00Z", "parents": ["root"]}]
+
+
+def test_failed_files_become_retry_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # 同期状態は作業ディレクトリの .drive_sync_state.json
+    crawler = FakeCrawler([])
+    save_drive_retries(crawler, "root", "token-1", [{"id": "broken"}], {"drive:ok"})
+    state = googledrive_sync.load_sync_state()
+    assert state["start_page_token"] == "token-1"
+    assert state["retry_files"] == [{"id": "broken"}]
+
+    # 次のクロールで取り込めたファイルは外し、新たに失敗したファイルを加える
+    save_drive_retries(crawler, "root", "token-2", [{"id": "other"}], {"drive:broken"})
+    state = googledrive_sync.load_sync_state()
+    assert state["start_page_token"] == "token-1"
+    assert state["retry_files"] == [{"id": "other"}]
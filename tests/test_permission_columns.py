@@ -0,0 +1,23 @@
+import pytest
+
+from benchmark import check_permission_columns
+from main import User
+from permission_columns import PermissionColumns
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_columns_match_can_access(seed):
+    n_docs, n_users = check_permission_columns(n_docs=500, n_users=20, rounds=10, seed=seed)
+    assert n_docs > 0 and n_users == 21
+
+
+def test_removed_rows_are_reused_and_unreadable():
+    columns = PermissionColumns(capacity=1)
+    columns.set("a", "alice", "eng", {"owner": True, "group": True, "other": True})
+    columns.set("b", "bob", "eng", {"owner": True, "group": False, "other": False})
+    row = columns.rows["a"]
+    columns.remove("a")
+    assert columns.mask_for(User("carol", set()), ["a"]).tolist() == [False]
+    columns.set("c", "carol", "hr", {"owner": True, "group": False, "other": False})
+    assert columns.rows["c"] == row
+    assert columns.row_ids[row] == "c"
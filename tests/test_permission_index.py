@@ -0,0 +1,56 @@
+import json
+
+import chromadb
+import pytest
+
+from permission_index import PermissionIndex, refresh_permission_index
+
+
+def slack(channel, ts, members):
+    return {"source": "slack", "channel_id": channel, "ts": ts, "permitted_user_ids": ",".join(members)}
+
+
+def drive(file_id, modified_time, emails):
+    permissions = [{"type": "user", "email": email, "role": "reader"} for email in emails]
+    return {"source": "google_drive", "file_id": file_id, "modified_time": modified_time,
+            "permissions": json.dumps(permissions)}
+
+
+def test_newest_record_acl_wins_regardless_of_order():
+    records = [slack("C1", "2.0", ["U1", "U2"]), slack("C1", "1.0", ["U1"]), slack("C1", "10.0", ["U2"])]
+    for metadatas in (records, records[::-1]):
+        index = PermissionIndex.build(metadatas)
+        assert index.visible_resources(["slack:U2"]) == ["slack:C1"]
+        assert index.visible_resources(["slack:U1"]) == []
+
+
+@pytest.fixture
+def collection(tmp_path):
+    client = chromadb.EphemeralClient()
+    name = f"perm_{tmp_path.name[-40:]}".replace("-", "_")
+    yield client.get_or_create_collection(name)
+    client.delete_collection(name)
+
+
+def add(collection, id_, meta):
+    collection.add(ids=[id_], embeddings=[[0.0, 1.0]], metadatas=[meta], documents=[id_])
+
+
+def test_refresh_updates_only_touched_resources(collection, tmp_path):
+    path = str(tmp_path / "index.npz")
+    add(collection, "C1:1", slack("C1", "1.0", ["U1"]))
+    add(collection, "C2:1", slack("C2", "1.0", ["U3"]))
+    add(collection, "F1:0", drive("F1", "2025-01-01", ["a@example.com"]))
+    refresh_permission_index(collection, [], path)  # インデックスが無ければ全件から作る
+
+    # C1 に U2 が加わった後のメッセージ、C2 は記録を変えただけで触れたことにしない
+    add(collection, "C1:2", slack("C1", "2.0", ["U1", "U2"]))
+    collection.update(ids=["C2:1"], metadatas=[slack("C2", "1.0", ["U4"])])
+    collection.delete(ids=["F1:0"])
+    index = refresh_permission_index(collection, ["slack:C1", "drive:F1"], path)
+
+    assert index.visible_resources(["slack:U2"]) == ["slack:C1"]
+    assert index.visible_resources(["slack:U3"]) == ["slack:C2"]
+    assert index.visible_resources(["user:a@example.com"]) == []
+    assert PermissionIndex.load(path).acls() == index.acls()
+    assert index.acls() == {"slack:C1": ["slack:U1", "slack:U2"], "slack:C2": ["slack:U3"]}
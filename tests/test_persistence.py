@@ -0,0 +1,70 @@
+import pytest
+
+from acl_shards import ShardedCollection
+from embedding_backends import HashingEmbeddings
+from main import AccessControlledVectorDB, create_sample_data
+
+
+def open_db(path, sharded=False, size=64, seed=0):
+    db = AccessControlledVectorDB("persist", embeddings=HashingEmbeddings(size=size, seed=seed),
+                                  keep_documents=False, result_cache_size=0, persist_directory=str(path),
+                                  sharded=sharded)
+    db.audit.sample_rate = 0
+    return db
+
+
+def results(db, users):
+    return [[hit["doc_id"] for hit in db.search("設計書", user, top_k=5)] for user in users]
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_unsaved_changes_still_reject_another_model(tmp_path, sharded):
+    docs, _ = create_sample_data()
+    db = open_db(tmp_path, sharded)
+    db.add_documents(docs[:3])
+    # 保存せずに落ちた状態（マニフェストには count / checksum が無い）
+    db.add_document(docs[3])
+    with pytest.raises(ValueError, match="embedded with"):
+        open_db(tmp_path, sharded, seed=1)
+    # 同じモデルなら Chroma から ACL を作り直して開ける
+    reopened = open_db(tmp_path, sharded)
+    assert reopened.collection.count() == 4
+
+
+def test_first_unsaved_write_records_model(tmp_path):
+    docs, _ = create_sample_data()
+    db = open_db(tmp_path)
+    db.add_document(docs[0])
+    with pytest.raises(ValueError, match="embedded with"):
+        open_db(tmp_path, seed=1)
+    reopened = open_db(tmp_path)
+    assert len(reopened.acl) == 1
+
+
+def test_sharded_reopen_restores_shards_without_scanning(tmp_path, monkeypatch):
+    docs, users = create_sample_data()
+    db = open_db(tmp_path, sharded=True)
+    db.add_documents(docs)
+    expected = results(db, users)
+    shard_of = dict(db.collection.shard_of)
+    db.close()
+
+    def fail(self, page_size=10000):
+        raise AssertionError("rescanned shard metadata")
+
+    monkeypatch.setattr(ShardedCollection, "rescan", fail)
+    reopened = open_db(tmp_path, sharded=True)
+    assert reopened.collection.shard_of == shard_of
+    assert results(reopened, users) == expected
+
+
+def test_sharded_reopen_after_crash_rescans(tmp_path):
+    docs, users = create_sample_data()
+    db = open_db(tmp_path, sharded=True)
+    db.add_documents(docs[:4])
+    db.add_document(docs[4])
+    expected = results(db, users)
+    reopened = open_db(tmp_path, sharded=True)
+    assert reopened.collection.count() == len(docs)
+    assert results(reopened, users) == expected
+    assert reopened._read_manifest()["checksum"] is not None
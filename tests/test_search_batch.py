@@ -0,0 +1,41 @@
+import pytest
+
+from benchmark import create_synthetic_users, iter_synthetic_documents
+from embedding_backends import HashingEmbeddings
+from main import AccessControlledVectorDB, create_sample_data
+
+QUERIES = ["設計書", "APIの認証", "リモートワーク", "Python", "マーケ施策"]
+
+
+def make_db(docs, sharded=False):
+    db = AccessControlledVectorDB("search_batch", embeddings=HashingEmbeddings(size=64), keep_documents=False,
+                                  result_cache_size=0, sharded=sharded)
+    db.audit.sample_rate = 0
+    db.add_documents(docs)
+    return db
+
+
+def assert_same_as_search(db, queries, users, top_k, prefilter):
+    expected = [{u.user_id: db.search(q, u, top_k=top_k, prefilter=prefilter) for u in users} for q in queries]
+    assert db.search_batch(queries, users, top_k=top_k, prefilter=prefilter) == expected
+    for query, per_user in zip(queries, expected):
+        assert db.search_many(query, users, top_k=top_k, prefilter=prefilter) == per_user
+
+
+@pytest.mark.parametrize("prefilter", [False, True])
+@pytest.mark.parametrize("top_k", [1, 3, 5])
+def test_sample_data_matches_search(prefilter, top_k):
+    docs, users = create_sample_data()
+    assert_same_as_search(make_db(docs), QUERIES, users, top_k, prefilter)
+
+
+def test_sample_data_matches_search_sharded():
+    docs, users = create_sample_data()
+    assert_same_as_search(make_db(docs, sharded=True), QUERIES, users, 3, False)
+
+
+@pytest.mark.parametrize("prefilter", [False, True])
+def test_synthetic_data_matches_search(prefilter):
+    users, groups = create_synthetic_users(20, n_groups=5)
+    db = make_db(iter_synthetic_documents(300, users, groups))
+    assert_same_as_search(db, QUERIES, users, 5, prefilter)
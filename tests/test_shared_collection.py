@@ -0,0 +1,27 @@
+import chromadb
+import pytest
+
+from embedding_backends import HashingEmbeddings
+from shared_collection import MODEL_METADATA_KEY, check_embedding_model
+
+
+def test_writer_records_model_and_mismatch_fails(tmp_path):
+    client = chromadb.PersistentClient(path=str(tmp_path))
+    collection = client.get_or_create_collection("default", metadata={"hnsw:space": "cosine"})
+    embeddings = HashingEmbeddings(size=64)
+
+    # 読み出し側は記録しない
+    check_embedding_model(collection, embeddings)
+    assert MODEL_METADATA_KEY not in (collection.metadata or {})
+
+    check_embedding_model(collection, embeddings, record=True)
+    reopened = chromadb.PersistentClient(path=str(tmp_path)).get_collection("default")
+    assert reopened.metadata[MODEL_METADATA_KEY] == embeddings.model
+    check_embedding_model(reopened, embeddings)
+    check_embedding_model(reopened, embeddings, record=True)
+
+    other = HashingEmbeddings(size=64, seed=1)
+    with pytest.raises(ValueError, match="embedded with"):
+        check_embedding_model(reopened, other)
+    with pytest.raises(ValueError, match="embedded with"):
+        check_embedding_model(reopened, other, record=True)
@@ -0,0 +1,37 @@
+import importlib.util
+
+import pandas as pd
+import pytest
+
+import show_chromadb
+
+
+def records(n):
+    for i in range(n):
+        yield {"id": f"r{i}", "document": f"本文 {i}", "metadata": {"source": "slack", "posted_by": "U1"}}
+
+
+def test_write_parquet_round_trip(tmp_path):
+    count = show_chromadb.write_parquet(records(5), str(tmp_path / "out"), rows_per_file=2)
+    frame = pd.read_parquet(tmp_path / "out")
+    assert count == 5
+    assert sorted(frame["id"]) == [f"r{i}" for i in range(5)]
+    assert set(frame["owner"]) == {"U1"}
+
+
+def test_missing_engine_fails_before_reading_records(tmp_path, monkeypatch):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec",
+                        lambda name, *args: None if name in ("pyarrow", "fastparquet") else find_spec(name, *args))
+    consumed = []
+
+    def tracked():
+        for record in records(3):
+            consumed.append(record)
+            yield record
+
+    with pytest.raises(ImportError, match="pyarrow"):
+        show_chromadb.write_parquet(tracked(), str(tmp_path / "out"))
+    assert consumed == []
+    with pytest.raises(SystemExit):
+        show_chromadb.main(["--format", "parquet", "--output", str(tmp_path / "out")])
@@ -0,0 +1,38 @@
+import time
+
+import pytest
+
+from slack_identity import SlackDirectory
+
+
+class FlakyClient:
+    def __init__(self):
+        self.fail = False
+
+    def conversations_members(self, channel, cursor=None, limit=None):
+        if self.fail:
+            raise RuntimeError("temporary failure")
+        return {"members": ["U1", "U2"]}
+
+
+def test_failures_are_not_cached(tmp_path):
+    client = FlakyClient()
+    directory = SlackDirectory(client, path=str(tmp_path / "cache.json"), ttl=60)
+    client.fail = True
+    with pytest.raises(RuntimeError):
+        directory.channel_members("C1")
+    assert "C1" not in directory._cache["members"]
+
+    client.fail = False
+    assert directory.channel_members("C1") == ["U1", "U2"]
+
+
+def test_stale_members_are_kept_when_refresh_fails(tmp_path):
+    client = FlakyClient()
+    directory = SlackDirectory(client, path=str(tmp_path / "cache.json"), ttl=60)
+    directory.channel_members("C1")
+    directory._cache["members"]["C1"]["fetched_at"] = time.time() - 120
+    client.fail = True
+    assert directory.channel_members("C1") == ["U1", "U2"]
+    directory.save()
+    assert SlackDirectory(client, path=str(tmp_path / "cache.json"))._cache["members"]["C1"]["data"] == ["U1", "U2"]
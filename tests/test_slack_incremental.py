@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import slack_embedding_message as sem
+
+
+class FakeSlack:
+    """conversations_history / conversations_replies / conversations_members だけを持つ偽の scheduler"""
+
+    def __init__(self):
+        self.messages = []  # 親メッセージ（スレッドの返信は含まない）
+        self.replies = {}  # thread_ts -> 返信
+        self.calls = []
+
+    def post(self, ts, thread_ts=None):
+        message = {"ts": ts, "text": f"message {ts}", "user": "U1"}
+        if thread_ts is None:
+            self.messages.append(message)
+            return
+        message["thread_ts"] = thread_ts
+        self.replies.setdefault(thread_ts, []).append(message)
+        parent = next(m for m in self.messages if m["ts"] == thread_ts)
+        parent.update(thread_ts=thread_ts, reply_count=len(self.replies[thread_ts]), latest_reply=ts)
+
+    def pages(self, method, key, channel, limit=None, oldest=None, ts=None):
+        self.calls.append(method)
+        after = float(oldest) if oldest else 0.0
+        if method == "conversations_history":
+            return iter([dict(m) for m in self.messages if float(m["ts"]) > after])
+        if method == "conversations_replies":
+            parent = next(m for m in self.messages if m["ts"] == ts)
+            return iter([dict(parent)] + [dict(r) for r in self.replies.get(ts, []) if float(r["ts"]) > after])
+        return iter(["U1"])
+
+
+@pytest.fixture
+def slack(monkeypatch):
+    fake = FakeSlack()
+    monkeypatch.setattr(sem, "scheduler", fake)
+    return fake
+
+
+def run(state):
+    data, latest_ts, threads = sem.fetch_messages("C1", "public", oldest=state.get("C1"), threads=state.get("threads"))
+    if latest_ts:
+        state["C1"] = latest_ts
+    state["threads"] = threads
+    return sorted(d["metadata"]["ts"] for d in data)
+
+
+def test_new_replies_to_previously_ingested_threads(slack):
+    now = time.time()
+    ts = [f"{now - 100 + i:.6f}" for i in range(10)]
+    slack.post(ts[0])
+    slack.post(ts[1])
+    slack.post(ts[2], thread_ts=ts[0])
+    state = {}
+    assert run(state) == ts[:3]
+
+    # 取り込み済みのスレッドへの返信と、返信の無かったメッセージに後から付いた返信
+    slack.post(ts[3], thread_ts=ts[0])
+    slack.post(ts[4], thread_ts=ts[1])
+    assert run(state) == [ts[3], ts[4]]
+    assert state["C1"] == ts[1]
+
+    # 新しい返信が無ければ何も取得しない
+    slack.calls.clear()
+    assert run(state) == []
+    assert "conversations_replies" not in slack.calls
+
+
+def test_threads_with_old_parents_are_polled(slack):
+    now = time.time()
+    old_parent = f"{now - 30 * 86400:.6f}"
+    slack.post(old_parent)
+    slack.post(f"{now - 60:.6f}", thread_ts=old_parent)
+    state = {}
+    run(state)
+    assert old_parent in state["threads"]
+
+    slack.post(f"{now - 30:.6f}", thread_ts=old_parent)
+    assert run(state) == [f"{now - 30:.6f}"]